@@ -0,0 +1,284 @@
+"""Database cache"""
+import time
+from typing import Any, Optional
+
+from sqlalchemy import event
+from sqlalchemy.future import select
+from sqlalchemy.orm import (
+    ORMExecuteState, Session, make_transient_to_detached,
+)
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import (
+    BinaryExpression, BindParameter, BooleanClauseList, ClauseElement,
+)
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database.models import User, Dialogue, Queue, Sponsor
+from app.database.context import UserContext
+from app.utils.cache import MemoryCache, CACHE_REQUESTS
+
+
+PENDING_KEY = 'invalidated_users'
+SPONSORS_KEY = 'invalidated_sponsors'
+
+
+def invalidate_users(session: AsyncSession | Session, *user_ids: int) -> None:
+    """
+    Invalidate cached users on the next commit. ORM changes and bulk
+    statements on users and the queue are tracked automatically, needed for
+    other changes of cached columns.
+
+    :param AsyncSession | Session session: Session
+    :param int user_ids: User ids
+    """
+
+    session.info.setdefault(PENDING_KEY, set()).update(user_ids)
+
+
+def get_key_values(
+    column: ClauseElement, where: Optional[ClauseElement],
+) -> Optional[list]:
+    """
+    Get values a WHERE clause limits a key column to with a plain
+    ``column == value`` or ``column.in_(values)`` criterion.
+
+    :param ClauseElement column: Key column
+    :param Optional[ClauseElement] where: WHERE clause
+    :return Optional[list]: Values, None if the rows are not limited so
+    """
+
+    if isinstance(where, BooleanClauseList) and where.operator is operators.and_:
+        clauses = where.clauses
+    else:
+        clauses = (where,)
+
+    for clause in clauses:
+        if (
+            isinstance(clause, BinaryExpression)
+            and isinstance(clause.right, BindParameter)
+            and clause.left.compare(column)
+        ):
+            if clause.operator is operators.eq:
+                return [clause.right.value]
+            if clause.operator is operators.in_op:
+                return list(clause.right.value)
+
+
+def invalidate_sponsors(session: AsyncSession | Session) -> None:
+    """
+    Invalidate the cached sponsor list on the next commit. Needed after bulk
+    statements, ORM changes are tracked automatically.
+
+    :param AsyncSession | Session session: Session
+    """
+
+    session.info[SPONSORS_KEY] = True
+
+
+class UserCache(object):
+    """
+    Cache of user contexts: user rows together with their queue membership.
+
+    Entries are column snapshots. A hit is turned back into a detached User
+    and attached to the session, so changes made by handlers are flushed as
+    plain UPDATEs of the changed columns.
+
+    Users are invalidated after commits changing them. A context is cached
+    with the version read before loading it, so a change committed while it
+    was loaded keeps the stale context out of the cache.
+    """
+
+    COLUMNS = tuple(column.key for column in User.__mapper__.column_attrs)
+
+    # Tables of the context, keyed by user id
+    TABLES = (User.__table__, Queue.__table__)
+
+    def __init__(self, cache: MemoryCache) -> None:
+        """
+        Initialize the UserCache class
+
+        :param MemoryCache cache: Cache backend
+        """
+
+        self.cache = cache
+        event.listen(Session, 'do_orm_execute', self.do_orm_execute)
+        event.listen(Session, 'after_flush', self.after_flush)
+        event.listen(Session, 'after_commit', self.after_commit)
+
+    def snapshot(self, context: UserContext) -> dict[str, Any]:
+        """
+        Get a cacheable snapshot of a user context.
+
+        :param UserContext context: Loaded context
+        :return dict[str, Any]: Column values and the queue membership
+        """
+
+        user = context.user
+        snapshot = {key: getattr(user, key) for key in self.COLUMNS}
+        snapshot['in_queue'] = context.in_queue
+        return snapshot
+
+    def restore(self, session: AsyncSession, snapshot: dict) -> UserContext:
+        """
+        Attach a cached user to the session without a query.
+
+        :param AsyncSession session: Session
+        :param dict snapshot: Snapshot made by UserCache.snapshot
+        :return UserContext: Context with a persistent user
+        """
+
+        snapshot = dict(snapshot)
+        in_queue = snapshot.pop('in_queue')
+        user = User(**snapshot)
+        make_transient_to_detached(user)
+        session.add(user)
+        return UserContext(user, in_queue)
+
+    async def get(
+        self, session: AsyncSession, user_id: int,
+    ) -> Optional[UserContext]:
+        """
+        Get a cached user context attached to the session.
+
+        :param AsyncSession session: Session
+        :param int user_id: User id
+        :return Optional[UserContext]: Context or None on a miss
+        """
+
+        snapshot = await self.cache.get(user_id)
+        if snapshot is None:
+            return None
+
+        user = session.sync_session.identity_map.get(
+            session.sync_session.identity_key(User, user_id),
+        )
+        if user is None:
+            return self.restore(session, snapshot)
+        return UserContext(user, snapshot['in_queue'])
+
+    async def version(self, user_id: int) -> int:
+        """
+        Get the cache version of a user, read before loading the context.
+
+        :param int user_id: User id
+        :return int: Version
+        """
+
+        return await self.cache.version(user_id)
+
+    async def set(self, context: UserContext, version: int) -> None:
+        """
+        Cache a loaded user context unless the user changed meanwhile.
+
+        :param UserContext context: Context loaded by load_context
+        :param int version: Version read before loading
+        """
+
+        await self.cache.set(
+            context.user.id, self.snapshot(context), version=version,
+        )
+
+    def do_orm_execute(self, state: ORMExecuteState) -> None:
+        """Collect users changed by bulk statements"""
+        if not (state.is_update or state.is_delete):
+            return
+
+        table = state.statement.table
+        if not any(table.compare(cached) for cached in self.TABLES):
+            return
+
+        # Bulk UPDATE by primary key
+        if isinstance(state.parameters, list):
+            user_ids = [params['id'] for params in state.parameters]
+        else:
+            user_ids = get_key_values(table.c.id, state.statement.whereclause)
+
+        # Rows may not match once changed, they are selected beforehand
+        if user_ids is None:
+            stmt = select(table.c.id)
+            if state.statement.whereclause is not None:
+                stmt = stmt.where(state.statement.whereclause)
+            user_ids = state.session.scalars(stmt).all()
+
+        invalidate_users(state.session, *user_ids)
+
+    def after_flush(self, session: Session, _) -> None:
+        """Collect users changed by the flush"""
+        user_ids = set()
+        for instance in (*session.new, *session.dirty, *session.deleted):
+            if isinstance(instance, (User, Queue)):
+                user_ids.add(instance.id)
+            elif isinstance(instance, Dialogue):
+                user_ids.update((instance.first, instance.second))
+
+        invalidate_users(session, *user_ids)
+
+    def after_commit(self, session: Session) -> None:
+        """Invalidate changed users once the changes are visible"""
+        user_ids = session.info.pop(PENDING_KEY, None)
+        if user_ids:
+            self.cache.delete_nowait(*user_ids)
+
+
+class SponsorCache(object):
+    """
+    Process-local cache of active sponsors.
+
+    The list is dropped on commits changing sponsors in this process, other
+    processes pick changes up once the TTL expires.
+    """
+
+    def __init__(self, ttl: float) -> None:
+        """
+        Initialize the SponsorCache class
+
+        :param float ttl: List time to live, in seconds
+        """
+
+        self.ttl = ttl
+        self.sponsors: Optional[list[Sponsor]] = None
+        self.expires = 0.0
+        event.listen(Session, 'after_flush', self.after_flush)
+        event.listen(Session, 'after_commit', self.after_commit)
+
+    async def get(self, session: AsyncSession) -> list[Sponsor]:
+        """
+        Get active sponsors, loading them on a miss.
+
+        :param AsyncSession session: Session
+        :return list[Sponsor]: Detached active sponsors
+        """
+
+        if self.sponsors is not None and self.expires > time.monotonic():
+            CACHE_REQUESTS.inc(cache='sponsors', result='hit')
+            return self.sponsors
+
+        CACHE_REQUESTS.inc(cache='sponsors', result='miss')
+        sponsors = await session.scalars(
+            select(Sponsor)
+            .where(Sponsor.is_active == True)
+        )
+        sponsors = sponsors.all()
+        for sponsor in sponsors:
+            session.expunge(sponsor)
+
+        self.sponsors = sponsors
+        self.expires = time.monotonic() + self.ttl
+        return sponsors
+
+    def invalidate(self) -> None:
+        """Drop the cached list"""
+        self.sponsors = None
+
+    def after_flush(self, session: Session, _) -> None:
+        """Check if the flush changed sponsors"""
+        if any(
+            isinstance(instance, Sponsor)
+            for instance in (*session.new, *session.dirty, *session.deleted)
+        ):
+            invalidate_sponsors(session)
+
+    def after_commit(self, session: Session) -> None:
+        """Drop the list once the changes are visible"""
+        if session.info.pop(SPONSORS_KEY, False):
+            self.invalidate()
@@ -0,0 +1,52 @@
+"""User context"""
+from typing import Optional
+
+from sqlalchemy.future import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database.models import User, Queue
+
+
+class UserContext(object):
+    """
+    Hot path state of the user of an update: the user row, the dialogue
+    partner, queue membership and the room.
+    """
+    __slots__ = ('user', 'partner_id', 'in_queue', 'room_id')
+
+    def __init__(self, user: User, in_queue: bool) -> None:
+        """
+        Initialize the UserContext class
+
+        :param User user: User
+        :param bool in_queue: True if the user is searching for a dialogue
+        """
+
+        self.user = user
+        self.partner_id: Optional[int] = user.partner_id
+        self.in_queue = in_queue
+        self.room_id: int = user.in_room
+
+
+async def load_context(
+    session: AsyncSession, user_id: int,
+) -> Optional[UserContext]:
+    """
+    Load a user with the queue membership in one statement.
+
+    :param AsyncSession session: Session
+    :param int user_id: User id
+    :return Optional[UserContext]: Context or None for an unknown user
+    """
+
+    row = (await session.execute(
+        select(User, Queue.id)
+        .outerjoin(Queue, Queue.id == User.id)
+        .where(User.id == user_id)
+    )).first()
+
+    if row is None:
+        return None
+
+    user, queue_id = row
+    return UserContext(user, queue_id is not None)
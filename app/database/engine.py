@@ -1,5 +1,6 @@
 """Database engine"""
 import logging
+from sqlalchemy import text
 from sqlalchemy.engine import URL
 from sqlalchemy.ext.asyncio import (
     AsyncEngine,
@@ -12,6 +13,52 @@ from app.database.models import Base
 
 logger = logging.getLogger('database.engine')
 
+# Moves the dialogue id sequence past ids allocated before it existed
+SYNC_DIALOGUE_ID = text("""
+SELECT setval('dialogue_id_seq', last_id)
+FROM (
+    SELECT GREATEST(
+        (SELECT max(dialogue_id) FROM dialogues_history),
+        (SELECT max(dialogue_id) FROM users)
+    ) AS last_id
+) AS allocated
+WHERE last_id >= (SELECT last_value FROM dialogue_id_seq)
+""")
+
+HAS_COLUMN = text("""
+SELECT 1 FROM information_schema.columns
+WHERE table_name = :table AND column_name = :column
+""")
+
+# Adds users.partner_id to databases created before it and fills it from
+# the dialogues table
+ADD_PARTNER_ID = (
+    text('ALTER TABLE users ADD COLUMN IF NOT EXISTS partner_id BIGINT'),
+    text(
+        'CREATE INDEX IF NOT EXISTS ix_users_partner_id '
+        'ON users (partner_id)'
+    ),
+    text("""
+    UPDATE users
+    SET partner_id = CASE
+        WHEN dialogues.first = users.id THEN dialogues.second
+        ELSE dialogues.first
+    END
+    FROM dialogues
+    WHERE users.id IN (dialogues.first, dialogues.second)
+    """),
+)
+
+# Adds queue.time to databases created before it, waiting users count from
+# the migration
+ADD_QUEUE_TIME = (
+    text(
+        'ALTER TABLE queue ADD COLUMN IF NOT EXISTS time '
+        'TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now()'
+    ),
+    text('ALTER TABLE queue ALTER COLUMN time DROP DEFAULT'),
+)
+
 
 async def create_tables(engine: AsyncEngine) -> None:
     """
@@ -24,6 +71,23 @@ async def create_tables(engine: AsyncEngine) -> None:
         await conn.run_sync(Base.metadata.create_all)
         logger.info('Tables created successfully')
 
+        if engine.dialect.name == 'postgresql':
+            migrations = (
+                ('users', 'partner_id', ADD_PARTNER_ID),
+                ('queue', 'time', ADD_QUEUE_TIME),
+            )
+            for table, column, statements in migrations:
+                if await conn.scalar(
+                    HAS_COLUMN, dict(table=table, column=column),
+                ):
+                    continue
+
+                for statement in statements:
+                    await conn.execute(statement)
+                logger.info('Added %s.%s', table, column)
+
+            await conn.execute(SYNC_DIALOGUE_ID)
+
 
 async def create_sessionmaker(database: DB) -> async_sessionmaker:
     """
@@ -0,0 +1,145 @@
+"""Dialogue history writer"""
+import time
+import asyncio
+import logging
+from datetime import datetime
+from contextlib import suppress
+from typing import Optional
+
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from app.database.models import DialogueHistory
+from app.utils.metrics import Counter, Gauge, Histogram
+
+logger = logging.getLogger('database.history')
+
+HISTORY_ROWS = Counter(
+    'history_rows_total', 'Dialogue history rows by write result',
+    ('result',),
+)
+HISTORY_FLUSH_SECONDS = Histogram(
+    'history_flush_seconds', 'Duration of a dialogue history flush',
+)
+HISTORY_PENDING = Gauge(
+    'history_pending', 'Dialogue history rows waiting to be written',
+)
+
+
+class HistoryWriter(object):
+    """
+    Write-behind buffer of dialogue history. Rows are inserted together,
+    as multi-row INSERT statements in one transaction, every ``interval``
+    seconds or as soon as ``batch_size`` rows are waiting.
+
+    At most ``max_pending`` rows are kept in memory, rows above are dropped
+    while the database is unavailable.
+    """
+
+    def __init__(
+        self, sessionmaker: async_sessionmaker, interval: float = 0.5,
+        batch_size: int = 500, max_pending: int = 50000,
+    ) -> None:
+        """
+        Initialize the HistoryWriter class
+
+        :param async_sessionmaker sessionmaker: Async sessionmaker
+        :param float interval: Flush interval, in seconds
+        :param int batch_size: Rows that trigger a flush right away
+        :param int max_pending: Maximum amount of rows in memory
+        """
+
+        self.sessionmaker = sessionmaker
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.rows: list[dict] = []
+        self._full = asyncio.Event()
+        self._closing = False
+        self._task: Optional[asyncio.Task] = None
+        HISTORY_PENDING.callback = lambda: len(self.rows)
+
+    def start(self) -> None:
+        """Start the writer"""
+        self._task = asyncio.create_task(self._writer())
+
+    async def close(self) -> None:
+        """Stop the writer and flush the rest"""
+        # A running flush is finished, cancelling it would lose its rows
+        self._closing = True
+        self._full.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.flush()
+
+    def add(
+        self, dialogue_id: int, first: int, second: int, message: str,
+        image_id: Optional[str] = None,
+    ) -> bool:
+        """
+        Buffer a history row. Returns False if the buffer is full.
+
+        :param int dialogue_id: Dialogue id
+        :param int first: Sender id
+        :param int second: Receiver id
+        :param str message: Message text
+        :param Optional[str] image_id: Archive name of a photo
+        :return bool: True if the row will be written
+        """
+
+        if len(self.rows) >= self.max_pending:
+            HISTORY_ROWS.inc(result='dropped')
+            return False
+
+        self.rows.append(dict(
+            dialogue_id=dialogue_id,
+            first=first,
+            second=second,
+            time=datetime.now(),
+            message=message,
+            image_id=image_id,
+        ))
+        if len(self.rows) >= self.batch_size:
+            self._full.set()
+        return True
+
+    async def flush(self) -> None:
+        """Write buffered rows"""
+        if not self.rows:
+            return
+
+        rows, self.rows = self.rows, []
+        started = time.perf_counter()
+        try:
+            async with self.sessionmaker() as session:
+                await session.execute(insert(DialogueHistory), rows)
+                await session.commit()
+
+        except BaseException:
+            # Keep rows for the next attempt, older ones first
+            rows += self.rows
+            self.rows = rows[:self.max_pending]
+            if len(rows) > self.max_pending:
+                HISTORY_ROWS.inc(
+                    len(rows) - self.max_pending, result='dropped',
+                )
+            raise
+
+        HISTORY_ROWS.inc(len(rows), result='written')
+        HISTORY_FLUSH_SECONDS.observe(time.perf_counter() - started)
+
+    async def _writer(self) -> None:
+        """Flush every interval or once a batch is full, until closed"""
+        while not self._closing:
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            self._full.clear()
+            if self._closing:
+                return
+
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception('History write failed')
+                await asyncio.sleep(self.interval)
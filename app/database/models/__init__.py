@@ -2,7 +2,7 @@
 from .base import Base
 from .advert import Advert
 from .bill import Bill
-from .dialogue import Dialogue
+from .dialogue import Dialogue, dialogue_id_seq
 from .history import History
 from .sponsor import Sponsor
 from .user import User
@@ -18,6 +18,7 @@ __all__ = [
     'Advert',
     'Bill',
     'Dialogue',
+    'dialogue_id_seq',
     'History',
     'Sponsor',
     'User',
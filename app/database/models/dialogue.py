@@ -1,9 +1,13 @@
 """Dialogue model"""
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, Sequence
 from sqlalchemy.orm import Mapped, mapped_column
 from .base import bigint, Base
 
 
+# Dialogue ids shared by users and dialogues_history
+dialogue_id_seq = Sequence('dialogue_id_seq', metadata=Base.metadata)
+
+
 class Dialogue(Base):
     """Dialogue model"""
     __tablename__ = 'dialogues'
@@ -1,5 +1,6 @@
 """Queue model"""
 from typing import Optional
+from datetime import datetime
 from sqlalchemy import ForeignKey
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from .base import bigint, Base
@@ -14,5 +15,6 @@ class Queue(Base):
     is_man: Mapped[bool]
     target_man: Mapped[Optional[bool]]
     is_adult: Mapped[bool]
+    time: Mapped[datetime] = mapped_column(default=datetime.now)
 
     user: Mapped["User"] = relationship()
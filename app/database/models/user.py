@@ -2,10 +2,9 @@
 import json
 from typing import Optional, List
 from datetime import datetime, timedelta
-from sqlalchemy.orm import Mapped, mapped_column, relationship
+from sqlalchemy.orm import Mapped, mapped_column
 from sqlalchemy import JSON
 from .base import bigint, Base
-from .dialogue import Dialogue
 
 
 class User(Base):
@@ -43,11 +42,9 @@ class User(Base):
 
     dialogue_id: Mapped[bigint] = mapped_column(nullable=True)
 
-    partner: Mapped[Optional["Dialogue"]] = relationship(
-        primaryjoin="or_("
-        "    User.id==Dialogue.first,"
-        "    User.id==Dialogue.second,"
-        ")",
+    # Current dialogue partner, mirrors the dialogues table
+    partner_id: Mapped[Optional[bigint]] = mapped_column(
+        index=True, default=None,
     )
 
     @property
@@ -79,10 +76,6 @@ class User(Base):
 
         self.friends = json.dumps(current_friends)
 
-    @property
-    def partner_id(self) -> int:
-        return self.partner.get_id(self.id)
-
     @property
     def is_vip(self) -> bool:
         return (
@@ -1,6 +1,6 @@
 """In dialogue filter"""
 from aiogram.filters import Filter
-from app.database.models import User
+from app.database.context import UserContext
 
 
 class InDialogue(Filter):
@@ -10,6 +10,6 @@ class InDialogue(Filter):
         """Initialize the InDialogue filter"""
         self.in_dialogue = in_dialogue
 
-    async def __call__(self, _, user: User) -> bool:
+    async def __call__(self, _, context: UserContext) -> bool:
         """Check if the user is in a dialogue"""
-        return (user.partner is not None) == self.in_dialogue
+        return (context.partner_id is not None) == self.in_dialogue
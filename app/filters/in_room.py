@@ -1,6 +1,6 @@
 """In room filter"""
 from aiogram.filters import Filter
-from app.database.models import User
+from app.database.context import UserContext
 
 
 class InRoom(Filter):
@@ -10,6 +10,6 @@ class InRoom(Filter):
         """Initialize the InRoom filter"""
         self.in_room = in_room
 
-    async def __call__(self, _, user: User) -> bool:
+    async def __call__(self, _, context: UserContext) -> bool:
         """Check if the user is in a room"""
-        return (user.in_room != 0) == self.in_room
+        return (context.room_id != 0) == self.in_room
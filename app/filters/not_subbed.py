@@ -1,4 +1,6 @@
 """Not subbed filter"""
+from typing import Any
+
 from aiogram.filters import Filter
 
 
@@ -9,6 +11,7 @@ class NotSubbed(Filter):
         """Initialize the NotSubbed filter"""
         pass
 
-    async def __call__(self, _, sponsors: list) -> bool:
-        """Check if user is subbed"""
-        return bool(sponsors)
+    async def __call__(self, _, sponsors: Any) -> bool | dict[str, list]:
+        """Check if user is subbed, resolving sponsors for the handler"""
+        sponsors = await sponsors
+        return {'sponsors': sponsors} if sponsors else False
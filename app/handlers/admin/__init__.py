@@ -10,6 +10,7 @@ from . import (
     mail,
     adverts,
     requests,
+    perf,
     # rooms,
 )
 
@@ -25,4 +26,5 @@ def setup(router: Router) -> None:
     subscribe.register(router)
     adverts.register(router)
     requests.register(router)
+    perf.register(router)
     # rooms.register(router)
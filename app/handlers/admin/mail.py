@@ -76,7 +76,7 @@ async def mailing_confirm(
 
 async def stop_mailing(call: types.CallbackQuery) -> None:
     """Stop mailing handler"""
-    MailerSingleton.get_instance().stop_mailing()
+    await MailerSingleton.get_instance().stop_mailing()
 
     await call.message.delete()
     await call.answer("Рассылка остановлена.")
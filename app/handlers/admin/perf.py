@@ -0,0 +1,34 @@
+"""Profiler handlers"""
+from typing import Optional
+
+from aiogram import Router, types
+from aiogram.filters import Command, CommandObject
+from aiogram.utils.markdown import html_decoration
+
+from app.utils.profiler import Profiler
+
+
+async def perf(
+    message: types.Message,
+    command: CommandObject,
+    profiler: Optional[Profiler] = None,
+) -> None:
+    """Profiler report handler"""
+    if profiler is None:
+        return await message.answer(
+            'Профайлер выключен. Включите его: <code>PROFILER_ENABLED=True</code>',
+        )
+
+    if command.args == 'reset':
+        profiler.reset()
+        return await message.answer('Статистика профайлера сброшена.')
+
+    report = profiler.report() if profiler.stages else 'Нет данных.'
+    await message.answer(
+        '<pre>%s</pre>' % html_decoration.quote(report[:4000]),
+    )
+
+
+def register(router: Router) -> None:
+    """Register profiler handlers"""
+    router.message.register(perf, Command('perf'))
@@ -1,26 +1,33 @@
 """Dialogue handlers"""
 import json
-from pathlib import Path
 from typing import Optional
 from datetime import datetime, timedelta
 from contextlib import suppress
 
 from aiogram import Router, Bot, types
 from aiogram.filters import Text, Command, StateFilter
-from aiogram.exceptions import TelegramAPIError, TelegramBadRequest
+from aiogram.exceptions import (
+    TelegramAPIError, TelegramBadRequest, TelegramForbiddenError,
+)
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
 from aiogram.utils.markdown import hlink
-from sqlalchemy import delete, or_, func, update
+from sqlalchemy import case, delete, or_, func, update
 from sqlalchemy.future import select
-from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 
 from prices import SHOW_CONTACTS_PRICE
 from app.filters import InDialogue
 from app.templates import texts
 from app.templates.keyboards import user as nav
 from app.utils.config import BaseSettings
+from app.utils.archive import PhotoArchiver
+from app.database.context import UserContext
+from app.database.history import HistoryWriter
+from app.matchmaking import AlreadyPaired, Matchmaker
+from app.matchmaking.base import REQUEUED
 from app.database.models import (
-    User, Dialogue, Queue, History, Advert, DialogueHistory
+    User, Dialogue, History, Advert, dialogue_id_seq
 )
 
 
@@ -116,150 +123,225 @@ async def show_ad(
 
 
 async def queue(
-    bot: Bot, session: AsyncSession, user: User, state: FSMContext,
-    target_man: Optional[bool] = None, is_adult: bool = False
+    bot: Bot, session: AsyncSession, matchmaker: Matchmaker, user: User,
+    state: FSMContext, target_man: Optional[bool] = None,
+    is_adult: bool = False
 ) -> None:
     """Queue handler"""
-    stmt = select(Queue) \
-        .where(Queue.id != user.id) \
-        .where(Queue.is_adult == is_adult) \
-        .where(
-            or_(
-                Queue.target_man == user.is_man,
-                Queue.target_man == None,
-            ),
-    )
-
-    if target_man is not None:
-        stmt = stmt.where(Queue.is_man == target_man)
-
     await state.update_data(
         is_adult=is_adult,
         target_man=target_man,
     )
-    match = await session.scalar(stmt)
-
-    if match:
-        return await create_dialogue(bot, session, user.id, match.id)
+    try:
+        partner_id = await matchmaker.search(
+            session, user, target_man, is_adult,
+        )
+    except AlreadyPaired:
+        return
 
-    await session.execute(
-        delete(Queue)
-        .where(Queue.id == user.id)
-    )
-    session.add(
-        Queue(
-            id=user.id,
-            is_man=user.is_man,
-            target_man=target_man,
-            is_adult=is_adult,
+    if partner_id is not None:
+        return await create_dialogue(
+            bot, session, matchmaker, user.id, partner_id,
+            storage=state.storage,
         )
-    )
-    await session.commit()
+
     await bot.send_message(
         user.id,
-        texts.user.DIALOGUE_SEARCH,
+        texts.user.DIALOGUE_SEARCH + get_wait_text(
+            matchmaker, user, target_man, is_adult,
+        ),
         reply_markup=nav.reply.SEARCH_MENU,
     )
 
 
+def get_wait_text(
+    matchmaker: Matchmaker, user: User, target_man: Optional[bool],
+    is_adult: bool
+) -> str:
+    """Get estimated wait line, empty if unknown"""
+    wait = matchmaker.estimate(is_adult, user.is_man, target_man)
+    if wait is None:
+        return ''
+
+    if wait < 60:
+        wait = texts.user.WAIT_SHORT
+    elif wait < 3600:
+        wait = texts.user.WAIT_MINUTES % round(wait / 60)
+    else:
+        wait = texts.user.WAIT_LONG
+    return texts.user.SEARCH_WAIT % wait
+
+
 async def get_dialogue_id(session: AsyncSession) -> int:
     """Get dialogue id"""
-    dialogue_id = await session.scalar(
-        select(func.max(DialogueHistory.dialogue_id))
+    return await session.scalar(select(dialogue_id_seq.next_value()))
+
+
+async def open_dialogue(
+    session: AsyncSession, matchmaker: Matchmaker, first: int, second: int
+) -> None:
+    """Dequeue both users and create the dialogue in one transaction"""
+    await matchmaker.leave(session, first, second)
+
+    dialogue_id = await get_dialogue_id(session)
+
+    await session.execute(
+        update(User)
+        .where(User.id.in_((first, second)))
+        .values(
+            dialogue_id=dialogue_id,
+            partner_id=case((User.id == first, second), else_=first),
+        )
     )
-    if dialogue_id is None:
-        return 1
 
-    return dialogue_id + 1
+    session.add(
+        Dialogue(
+            first=first,
+            second=second,
+        )
+    )
+    await session.commit()
+    await matchmaker.paired(first, second)
 
 
 async def create_dialogue(
-    bot: Bot, session: AsyncSession, first: int, second: int,
-    friend: bool = False
+    bot: Bot, session: AsyncSession, matchmaker: Matchmaker,
+    first: int, second: int, friend: bool = False,
+    storage: Optional[BaseStorage] = None
 ) -> None:
     """Create dialogue"""
+    await open_dialogue(session, matchmaker, first, second)
 
+    blocked = []
     for user_id in (first, second):
         with suppress(TelegramAPIError):
-            if friend:
-                await bot.send_message(
-                    user_id,
-                    texts.user.DIALOGUE_FRIEND,
-                    reply_markup=nav.reply.DIALOGUE_FRIEND_MENU,
-                )
-
-            else:
-                await bot.send_message(
-                    user_id,
-                    texts.user.DIALOGUE_FOUND,
-                    reply_markup=types.ReplyKeyboardRemove(),
-                )
+            try:
+                if friend:
+                    await bot.send_message(
+                        user_id,
+                        texts.user.DIALOGUE_FRIEND,
+                        reply_markup=nav.reply.DIALOGUE_FRIEND_MENU,
+                    )
+
+                else:
+                    await bot.send_message(
+                        user_id,
+                        texts.user.DIALOGUE_FOUND,
+                        reply_markup=types.ReplyKeyboardRemove(),
+                    )
+
+            except TelegramForbiddenError:
+                blocked.append(user_id)
+
+    if blocked:
+        await drop_blocked_partner(
+            bot, session, matchmaker, first, second, blocked,
+            None if friend else storage,
+        )
+
+
+async def drop_blocked_partner(
+    bot: Bot, session: AsyncSession, matchmaker: Matchmaker,
+    first: int, second: int, blocked: list[int],
+    storage: Optional[BaseStorage] = None
+) -> None:
+    """
+    Finish a new dialogue with a user who blocked the bot. The other user
+    searches again with previous preferences, without the storage the
+    dialogue just ends for them.
+    """
 
     await session.execute(
-        delete(Queue)
-        .where(Queue.id.in_((first, second)))
+        update(User)
+        .where(User.id.in_(blocked), User.block_date == None)
+        .values(block_date=datetime.now())
     )
+    await delete_dialogue(session, first)
 
-    dialogue_id = await get_dialogue_id(session)
+    if len(blocked) > 1:
+        return
 
-    for user_id in (first, second):
-        await session.execute(
-            update(User)
-            .where(User.id == user_id)
-            .values(dialogue_id=dialogue_id)
-        )
+    user = await session.get(User, second if first in blocked else first)
+    if storage is None:
+        with suppress(TelegramAPIError):
+            await bot.send_message(
+                user.id,
+                texts.user.DIALOGUE_END,
+                reply_markup=nav.reply.main_menu(user),
+            )
+        return
 
-    session.add(
-        Dialogue(
-            first=first,
-            second=second,
-        )
+    state = FSMContext(bot, storage, StorageKey(bot.id, user.id, user.id))
+    state_data = await state.get_data()
+    REQUEUED.inc()
+    await queue(
+        bot, session, matchmaker, user, state=state,
+        target_man=state_data.get('target_man'),
+        is_adult=state_data.get('is_adult', False),
     )
-    await session.commit()
+
+
+async def create_matched_dialogue(
+    bot: Bot, sessionmaker: async_sessionmaker, matchmaker: Matchmaker,
+    storage: BaseStorage, first: int, second: int
+) -> None:
+    """Create dialogue for users paired by the matchmaker"""
+    async with sessionmaker() as session:
+        await create_dialogue(
+            bot, session, matchmaker, first, second, storage=storage,
+        )
 
 
 async def delete_dialogue(session: AsyncSession, user_id: int) -> None:
 
-    await session.execute(
-        delete(Dialogue)
+    user_ids = await session.scalars(
+        update(User)
         .where(
             or_(
-                Dialogue.first == user_id,
-                Dialogue.second == user_id,
+                User.id == user_id,
+                User.partner_id == user_id,
             ),
+            User.partner_id != None,
         )
+        .values(partner_id=None)
+        .returning(User.id)
     )
+    user_ids = user_ids.all()
+
+    if user_ids:
+        await session.execute(
+            delete(Dialogue)
+            .where(
+                Dialogue.first.in_(user_ids),
+                Dialogue.second.in_(user_ids),
+            )
+        )
     await session.commit()
 
 
 async def finish_dialogue(
     message: types.Message, bot: Bot, state: FSMContext,
-    session: AsyncSession, user: User
+    session: AsyncSession, matchmaker: Matchmaker, user: User,
+    context: UserContext
 ) -> None:
     """Finish dialogue"""
     # Check if user is in a dialogue or in queue
-    is_in_queue = await session.scalar(
-        select(Queue).where(Queue.id == user.id)
-    )
-    
-    if not user.partner and not is_in_queue:
+    if not user.partner_id and not await matchmaker.is_waiting(context):
         return await message.answer(
             texts.user.NO_ACTIVE_CHAT,
             reply_markup=nav.reply.main_menu(user),
         )
         
     await message.answer(
-        texts.user.DIALOGUE_END_SELF if user.partner else texts.user.SEARCH_END,
+        texts.user.DIALOGUE_END_SELF if user.partner_id
+        else texts.user.SEARCH_END,
         reply_markup=nav.reply.main_menu(user),
     )
     await show_ad(bot, state, session, user)
 
-    await session.execute(
-        delete(Queue)
-        .where(Queue.id == user.id)
-    )
+    await matchmaker.leave(session, user.id)
 
-    if not user.partner:
+    if not user.partner_id:
         return await session.commit()
 
     second_user = await session.get(User, user.partner_id)
@@ -286,7 +368,7 @@ async def add_friend_request(
 ) -> None:
     """Add friend request"""
 
-    if not user.partner:
+    if not user.partner_id:
         return await session.commit()
 
     second_user = await session.get(User, user.partner_id)
@@ -315,7 +397,7 @@ async def accept_friend_request(
     call: types.CallbackQuery, bot: Bot, session: AsyncSession, user: User
 ) -> None:
     """Accept friend request"""
-    if not user.partner:
+    if not user.partner_id:
         await call.message.edit_text('Диалог уже завершен.')
         return await session.commit()
 
@@ -349,7 +431,7 @@ async def decline_friend_request(
     call: types.CallbackQuery, bot: Bot, session: AsyncSession, user: User
 ) -> None:
     """Decline friend request"""
-    if not user.partner:
+    if not user.partner_id:
         await call.message.edit_text('Диалог уже завершен.')
         return await session.commit()
 
@@ -382,7 +464,7 @@ async def view_complaint(
     """View complaint"""
     await state.clear()
 
-    if not user.partner:
+    if not user.partner_id:
         return await message.answer('Çat artıq dayandırılmışdır.')
 
     second_user = await session.get(User, user.partner_id)
@@ -403,7 +485,7 @@ async def complaint(
 ) -> None:
     """Complaint"""
 
-    if not user.partner:
+    if not user.partner_id:
         return await call.message.edit_text('Çat artıq dayandırılmışdır.')
 
     second_user = await session.get(User, user.partner_id)
@@ -434,7 +516,7 @@ async def decline_complaint(
     call: types.CallbackQuery, bot: Bot, session: AsyncSession, user: User
 ) -> None:
     """Decline complaint"""
-    if not user.partner:
+    if not user.partner_id:
         await call.message.edit_text('Çat artıq dayandırılmışdır.')
         return await session.commit()
 
@@ -467,7 +549,7 @@ async def show_contacts(
             'Недостаточно средств. Пополните баланс.',
         )
 
-    if not user.partner:
+    if not user.partner_id:
         return await call.message.edit_text('Диалог уже завершен.')
 
     second_user = await session.get(User, user.partner_id)
@@ -493,67 +575,60 @@ async def show_contacts(
 
 
 async def forward_message(
-    message: types.Message, bot: Bot, session: AsyncSession, user: User
+    message: types.Message, session: AsyncSession, archiver: PhotoArchiver,
+    history: HistoryWriter, user: User, context: UserContext
 ) -> None:
-    """Forward message"""
+    """Forward message, photos are archived in the background"""
     try:
-        try:
-            if message.photo:
-                file_id = message.photo[-1].file_id
-                file = await bot.get_file(file_id)
-
-                destination = Path(
-                    "photo", f"{user.id}_{file.file_unique_id}.jpg"
-                )
-                await bot.download_file(file.file_path, destination)
-                image_id = f"{user.id}_{file.file_unique_id}"
-
-            else:
-                image_id = None
-
-            session.add(
-                DialogueHistory(
-                    dialogue_id=user.dialogue_id,
-                    first=user.id,
-                    second=user.partner_id,
-                    message=message.text if message.text else message.caption,
-                    image_id=image_id
-                )
-            )
-
-            await session.commit()
-
-        except Exception:
-            pass
-
-        await message.copy_to(user.partner_id)
+        await message.copy_to(context.partner_id)
 
     except TelegramBadRequest:
         await message.answer(
             'Ваш собеседник заблокировал бота, диалог окончен!',
         )
-        await delete_dialogue(session, user.id)
+        return await delete_dialogue(session, user.id)
+
+    image_id = None
+    if message.photo:
+        photo = message.photo[-1]
+        image_id = f"{user.id}_{photo.file_unique_id}"
+        await archiver.put(photo.file_id, image_id)
+
+    text = message.text if message.text else message.caption
+    if text is None and image_id is None:
+        return
+
+    history.add(
+        dialogue_id=user.dialogue_id,
+        first=user.id,
+        second=context.partner_id,
+        message=text or '',
+        image_id=image_id
+    )
 
 
 async def random_normal(
-    _, bot: Bot, state: FSMContext, session: AsyncSession, user: User
+    _, bot: Bot, state: FSMContext, session: AsyncSession,
+    matchmaker: Matchmaker, user: User
 ) -> None:
     """Random normal"""
-    await queue(bot, session, user, state=state)
+    await queue(bot, session, matchmaker, user, state=state)
 
 
 async def male_normal(
-    _, bot: Bot, state: FSMContext, session: AsyncSession, user: User
+    _, bot: Bot, state: FSMContext, session: AsyncSession,
+    matchmaker: Matchmaker, user: User
 ) -> None:
     """Male normal"""
-    await queue(bot, session, user, target_man=True, state=state)
+    await queue(bot, session, matchmaker, user, target_man=True, state=state)
 
 
 async def female_normal(
-    _, bot: Bot, state: FSMContext, session: AsyncSession, user: User
+    _, bot: Bot, state: FSMContext, session: AsyncSession,
+    matchmaker: Matchmaker, user: User
 ) -> None:
     """Female normal"""
-    await queue(bot, session, user, target_man=False, state=state)
+    await queue(bot, session, matchmaker, user, target_man=False, state=state)
 
 
 async def pre_adult(message: types.Message) -> None:
@@ -566,54 +641,82 @@ async def pre_adult(message: types.Message) -> None:
 
 async def adult(
     call: types.CallbackQuery, bot: Bot, state: FSMContext,
-    session: AsyncSession, user: User
+    session: AsyncSession, matchmaker: Matchmaker, user: User
 ) -> None:
     """Adult"""
     target = call.data.split(':')[1]
     await call.message.delete()
     await queue(
-        bot, session, user, target_man=target == 'male',
+        bot, session, matchmaker, user, target_man=target == 'male',
         is_adult=True, state=state,
     )
 
 
 async def next(
     message: types.Message, bot: Bot, state: FSMContext,
-    session: AsyncSession, user: User
+    session: AsyncSession, matchmaker: Matchmaker, user: User,
+    context: UserContext
 ) -> None:
     """Next"""
     # Check if user is in an active dialogue
-    if user.partner:
-        # End the current dialogue first
-        await finish_dialogue(message, bot, state, session, user)
-        
-    # Check if the user is already in queue
-    is_in_queue = await session.scalar(
-        select(Queue).where(Queue.id == user.id)
-    )
-    
+    if user.partner_id:
+        # End the current dialogue first, it also leaves the queue
+        await finish_dialogue(
+            message, bot, state, session, matchmaker, user, context,
+        )
+
     # If user is already in queue, inform them they're already searching
-    if is_in_queue:
+    elif await matchmaker.is_waiting(context):
+        state_data = await state.get_data()
         return await message.answer(
-            texts.user.DIALOGUE_SEARCH_ALREADY_SEARCHING,
+            texts.user.DIALOGUE_SEARCH_ALREADY_SEARCHING + get_wait_text(
+                matchmaker, user,
+                state_data.get('target_man'),
+                state_data.get('is_adult', False),
+            ),
             reply_markup=nav.reply.SEARCH_MENU,
         )
     
     # Start a new search with previous preferences
     state_data = await state.get_data()
     await queue(
-        bot, session, user, state=state,
+        bot, session, matchmaker, user, state=state,
         target_man=state_data.get('target_man'),
         is_adult=state_data.get('is_adult', False),
     )
 
 
+async def status(
+    message: types.Message, state: FSMContext, matchmaker: Matchmaker,
+    user: User, context: UserContext
+) -> None:
+    """Search status, estimated from matchmaker rates"""
+    if user.partner_id:
+        return await message.answer(texts.user.STATUS_DIALOGUE)
+
+    if not await matchmaker.is_waiting(context):
+        return await message.answer(
+            texts.user.NO_ACTIVE_CHAT,
+            reply_markup=nav.reply.main_menu(user),
+        )
+
+    state_data = await state.get_data()
+    await message.answer(
+        texts.user.DIALOGUE_SEARCH + get_wait_text(
+            matchmaker, user,
+            state_data.get('target_man'),
+            state_data.get('is_adult', False),
+        ),
+        reply_markup=nav.reply.SEARCH_MENU,
+    )
+
+
 async def handle_default_command(
     message: types.Message, bot: Bot, session: AsyncSession, user: User
 ) -> None:
     """Handle default commands or random messages"""
     # If user is in a dialogue, forward the message (already handled by InDialogue filter)
-    if user.partner:
+    if user.partner_id:
         return
         
     # If user is not in a dialogue, show a default message
@@ -632,6 +735,7 @@ def register(router: Router) -> None:
     router.message.register(pre_adult, Text('18+ çat 🔞'))
     router.callback_query.register(adult, Text(startswith='adult:'))
     router.message.register(next, Command('next'))
+    router.message.register(status, Command('status'))
     router.message.register(finish_dialogue, Command('stop'))
     router.message.register(finish_dialogue, Text('Söhbəti bitir 🚫'))
     router.message.register(add_friend_request, Text('Добавить в друзья 👥'))
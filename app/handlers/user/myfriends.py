@@ -1,14 +1,13 @@
 """My friends handlers"""
 from aiogram import Router, types, Bot
 from aiogram.filters import Text
-from sqlalchemy.future import select
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import or_
 
 from app.templates import texts
 from app.templates.keyboards import user as nav
-from app.database.models import User, Dialogue
+from app.database.models import User
 from app.handlers.user.dialogue import create_dialogue
+from app.matchmaking import Matchmaker
 
 
 async def get_friend_list(session: AsyncSession, user: User) -> list:
@@ -19,17 +18,8 @@ async def get_friend_list(session: AsyncSession, user: User) -> list:
         if friend:
             status = '🔴' if friend.block_date else '🟢'
 
-            if not friend.block_date:
-                in_dialogue = await session.scalar(
-                    select(Dialogue).where(
-                        or_(
-                            Dialogue.second == friend.id,
-                            Dialogue.first == friend.id,
-                        )
-                    )
-                )
-                if in_dialogue:
-                    status = '🟡'
+            if not friend.block_date and friend.partner_id:
+                status = '🟡'
 
             friends.append({
                 'status': status,
@@ -66,17 +56,8 @@ async def get_friend_status(
     """Get friend status"""
     status = 3 if friend.block_date else 1
 
-    if not friend.block_date:
-        in_dialogue = await session.scalar(
-            select(Dialogue).where(
-                or_(
-                    Dialogue.second == friend.id,
-                    Dialogue.first == friend.id,
-                )
-            )
-        )
-        if in_dialogue:
-            status = 2
+    if not friend.block_date and friend.partner_id:
+        status = 2
 
     return status
 
@@ -184,6 +165,7 @@ async def accept_dialogue_request(
     call: types.CallbackQuery,
     bot: Bot,
     session: AsyncSession,
+    matchmaker: Matchmaker,
     user: User
 ) -> None:
     """Accept dialogue request handler"""
@@ -221,6 +203,7 @@ async def accept_dialogue_request(
         await create_dialogue(
             bot,
             session,
+            matchmaker,
             user.id, friend.id,
             friend=True
         )
@@ -1,7 +1,7 @@
 """Not subbed handlers"""
 from contextlib import suppress
 
-from aiogram import Router, types, exceptions
+from aiogram import Router, F, types, exceptions
 from aiogram.filters import Text
 
 from sqlalchemy import update
@@ -10,7 +10,11 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from app.templates import texts
 from app.templates.keyboards import user as nav
 from app.database.models import User, Sponsor
-from app.filters import NotSubbed
+from app.database.cache import invalidate_sponsors
+from app.filters import NotSubbed, InDialogue
+
+
+STOP_COMMANDS = ('/stop', 'Söhbəti bitir 🚫')
 
 
 async def notsubbed(
@@ -79,11 +83,16 @@ async def subbed(
             .where(Sponsor.limit != 0, Sponsor.visits >= Sponsor.limit)
             .values(is_active=False)
         )
+        invalidate_sponsors(session)
     await session.commit()
 
 
 def register(router: Router) -> None:
     """Register handlers"""
-    router.message.register(notsubbed, NotSubbed())
+    # Dialogue relays and leaving the queue skip the subscription check
+    router.message.register(
+        notsubbed, InDialogue(False),
+        ~F.text.in_(STOP_COMMANDS), NotSubbed(),
+    )
     router.callback_query.register(notsubbed_cb, NotSubbed())
     router.callback_query.register(subbed, Text('checksub'))
@@ -41,7 +41,7 @@ async def start(
             reply_markup=nav.reply.main_menu(user),
         )
 
-        if user.partner:
+        if user.partner_id:
             await delete_dialogue(session, message.from_user.id)
 
     if not command.args:
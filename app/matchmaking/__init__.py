@@ -0,0 +1,50 @@
+"""Matchmaking package"""
+from typing import Optional
+
+from redis.asyncio import Redis
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from app.utils.config import Matchmaking
+from .base import AlreadyPaired, Matchmaker
+from .database import DatabaseMatchmaker
+from .memory import MemoryMatchmaker
+from .redis import RedisMatchmaker
+from .recent import RecentPartners
+from .sweeper import QueueSweeper
+
+
+def create_matchmaker(
+    config: Matchmaking, sessionmaker: async_sessionmaker,
+    redis: Optional[Redis] = None,
+) -> Matchmaker:
+    """
+    Create the search queue selected by the config.
+
+    :param Matchmaking config: Matchmaking settings
+    :param async_sessionmaker sessionmaker: Async sessionmaker
+    :param Optional[Redis] redis: Redis client for the shared queue and
+    recent partners
+    :return Matchmaker: Search queue
+    """
+
+    recent = RecentPartners(
+        config.recent_size, config.recent_capacity, redis, config.recent_ttl,
+    )
+    if config.backend == 'database':
+        return DatabaseMatchmaker(recent)
+    if config.backend == 'memory':
+        return MemoryMatchmaker(
+            recent, sessionmaker, config.flush_interval,
+            config.tick_interval, config.tick_window, config.tick_limit,
+        )
+    if config.backend == 'redis':
+        if redis is None:
+            raise ValueError('MATCHMAKING_BACKEND=redis requires Redis')
+        return RedisMatchmaker(recent, redis, config.tick_window)
+    raise ValueError('Unknown matchmaking backend "%s"' % config.backend)
+
+
+__all__ = [
+    'AlreadyPaired', 'Matchmaker', 'DatabaseMatchmaker', 'MemoryMatchmaker',
+    'QueueSweeper', 'RecentPartners', 'RedisMatchmaker', 'create_matchmaker',
+]
@@ -0,0 +1,199 @@
+"""Matchmaking interface"""
+from functools import lru_cache
+from typing import Awaitable, Callable, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database.models import User
+from app.database.context import UserContext
+from app.utils.metrics import Counter, Gauge, Histogram
+from .rates import QueueRates
+from .recent import RecentPartners
+
+# Waiting users are bucketed by (is_adult, is_man, target_man)
+Bucket = tuple[bool, bool, Optional[bool]]
+
+MATCHES = Counter(
+    'matchmaking_matches_total', 'Matches by bucket of the waiting user',
+    ('bucket',),
+)
+WAIT_SECONDS = Histogram(
+    'matchmaking_wait_seconds', 'Time waited in the queue until a match',
+    ('bucket',), (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600),
+)
+WAITING = Gauge(
+    'matchmaking_waiting', 'Users waiting in the queue', ('bucket',),
+)
+TICK_SECONDS = Gauge(
+    'matchmaking_tick_seconds',
+    'Time spent pairing by the last batch matching tick, without yields',
+)
+TICK_PAIRS = Gauge(
+    'matchmaking_tick_pairs', 'Pairs made by the last batch matching tick',
+)
+SWEPT = Counter(
+    'matchmaking_swept_total', 'Users removed from the queue by the sweeper',
+    ('reason',),
+)
+REQUEUED = Counter(
+    'matchmaking_requeued_total',
+    'Users searching again after the partner blocked the bot',
+)
+
+
+class AlreadyPaired(Exception):
+    """The searching user was paired by a concurrent search"""
+
+
+def get_bucket(
+    is_adult: bool, is_man: bool, target_man: Optional[bool],
+) -> Bucket:
+    """Get bucket of a waiting user"""
+    return (is_adult, is_man, target_man)
+
+
+def get_partner_buckets(
+    is_adult: bool, is_man: bool, target_man: Optional[bool],
+) -> tuple[Bucket, ...]:
+    """
+    Get buckets of users compatible with a searching user.
+
+    :param bool is_adult: Adult search
+    :param bool is_man: Gender of the searching user
+    :param Optional[bool] target_man: Wanted gender, None for any
+    :return tuple[Bucket, ...]: Compatible buckets
+    """
+
+    genders = (True, False) if target_man is None else (target_man,)
+    return tuple(
+        (is_adult, gender, target)
+        for gender in genders
+        for target in (is_man, None)
+    )
+
+
+def is_compatible(first: Bucket, second: Bucket) -> bool:
+    """Check if users of two buckets may be paired"""
+    return (
+        first[0] == second[0]
+        and first[2] in (second[1], None)
+        and second[2] in (first[1], None)
+    )
+
+
+@lru_cache
+def get_bucket_name(bucket: Bucket) -> str:
+    """Get bucket label for metrics"""
+    is_adult, is_man, target_man = bucket
+    return '%s:%s:%s' % (
+        'adult' if is_adult else 'normal',
+        'man' if is_man else 'woman',
+        'any' if target_man is None else 'man' if target_man else 'woman',
+    )
+
+
+class Matchmaker(object):
+    """
+    Search queue interface. Implementations pair compatible users or keep
+    them waiting until a partner shows up.
+    """
+
+    # Called with both user ids for pairs made outside of a search
+    on_match: Optional[Callable[[int, int], Awaitable[None]]] = None
+
+    def __init__(self, recent: RecentPartners) -> None:
+        """
+        Initialize the Matchmaker class
+
+        :param RecentPartners recent: Recent partners, not paired again
+        """
+
+        self.recent = recent
+        self.rates = QueueRates()
+
+    def estimate(
+        self, is_adult: bool, is_man: bool, target_man: Optional[bool],
+    ) -> Optional[float]:
+        """
+        Estimate the wait of a searching user from the rates of this
+        instance, without queries.
+
+        :param bool is_adult: Adult search
+        :param bool is_man: Gender of the searching user
+        :param Optional[bool] target_man: Wanted gender, None for any
+        :return Optional[float]: Wait in seconds, None if unknown
+        """
+
+        return self.rates.estimate(
+            get_bucket(is_adult, is_man, target_man),
+            get_partner_buckets(is_adult, is_man, target_man),
+        )
+
+    async def start(self) -> None:
+        """Prepare the queue, called once on startup"""
+
+    async def close(self) -> None:
+        """Persist the queue, called once on shutdown"""
+
+    async def search(
+        self, session: AsyncSession, user: User,
+        target_man: Optional[bool], is_adult: bool,
+    ) -> Optional[int]:
+        """
+        Take a compatible partner out of the queue or enqueue the user. A
+        match must be committed in the same transaction as the dialogue.
+
+        :param AsyncSession session: Session
+        :param User user: Searching user
+        :param Optional[bool] target_man: Wanted gender, None for any
+        :param bool is_adult: Adult search
+        :return Optional[int]: Partner id, None if the user was enqueued
+        :raises AlreadyPaired: The user got a partner meanwhile
+        """
+
+        raise NotImplementedError
+
+    async def leave(self, session: AsyncSession, *user_ids: int) -> None:
+        """
+        Remove users from the queue. Database changes are committed by the
+        caller.
+
+        :param AsyncSession session: Session
+        :param int user_ids: User ids
+        """
+
+        raise NotImplementedError
+
+    async def sweep(
+        self, session: AsyncSession, max_wait: float,
+    ) -> tuple[list[int], list[int]]:
+        """
+        Remove users waiting for too long and users who blocked the bot.
+        Database changes are committed by the caller.
+
+        :param AsyncSession session: Session
+        :param float max_wait: Longest allowed wait, in seconds
+        :return tuple[list[int], list[int]]: Expired and pruned user ids
+        """
+
+        raise NotImplementedError
+
+    async def paired(self, first: int, second: int) -> None:
+        """
+        Called once a dialogue of two users is committed.
+
+        :param int first: First user id
+        :param int second: Second user id
+        """
+
+        await self.recent.add(first, second)
+
+    async def is_waiting(self, context: UserContext) -> bool:
+        """
+        Check if a user is in the queue.
+
+        :param UserContext context: User context
+        :return bool: True if the user is waiting for a partner
+        """
+
+        raise NotImplementedError
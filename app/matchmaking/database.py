@@ -0,0 +1,113 @@
+"""Database matchmaking"""
+from typing import Optional
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, or_
+from sqlalchemy.future import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database.models import User, Queue
+from app.database.context import UserContext
+from .base import (
+    AlreadyPaired, Matchmaker, MATCHES, WAIT_SECONDS, get_bucket,
+    get_bucket_name,
+)
+
+
+class DatabaseMatchmaker(Matchmaker):
+    """
+    Search queue kept in the queue table. Every search is a query, shared by
+    all instances.
+
+    A matched row stays locked until the caller commits the dialogue, other
+    searches skip it instead of pairing the same user twice.
+    """
+
+    async def search(
+        self, session: AsyncSession, user: User,
+        target_man: Optional[bool], is_adult: bool,
+    ) -> Optional[int]:
+        """Take a partner from the queue table or enqueue the user"""
+        # Waits for a concurrent search that is pairing this user
+        await self.leave(session, user.id)
+        paired = await session.scalar(
+            select(User.partner_id)
+            .where(User.id == user.id)
+        )
+        if paired is not None:
+            await session.commit()
+            raise AlreadyPaired()
+
+        self.rates.arrived(get_bucket(is_adult, user.is_man, target_man))
+        stmt = select(Queue) \
+            .where(Queue.id != user.id) \
+            .where(Queue.is_adult == is_adult) \
+            .where(
+                or_(
+                    Queue.target_man == user.is_man,
+                    Queue.target_man == None,
+                ),
+        )
+
+        if target_man is not None:
+            stmt = stmt.where(Queue.is_man == target_man)
+
+        recent = await self.recent.get(user.id)
+        if recent:
+            stmt = stmt.where(Queue.id.notin_(recent))
+
+        match = await session.scalar(
+            stmt.limit(1).with_for_update(skip_locked=True)
+        )
+        if match:
+            bucket = get_bucket(match.is_adult, match.is_man, match.target_man)
+            wait = max((datetime.now() - match.time).total_seconds(), 0)
+            MATCHES.inc(bucket=get_bucket_name(bucket))
+            WAIT_SECONDS.observe(wait, bucket=get_bucket_name(bucket))
+            self.rates.matched(bucket, wait)
+            return match.id
+
+        session.add(
+            Queue(
+                id=user.id,
+                is_man=user.is_man,
+                target_man=target_man,
+                is_adult=is_adult,
+            )
+        )
+        await session.commit()
+
+    async def leave(self, session: AsyncSession, *user_ids: int) -> None:
+        """Delete users from the queue table"""
+        await session.execute(
+            delete(Queue)
+            .where(Queue.id.in_(user_ids))
+        )
+
+    async def sweep(
+        self, session: AsyncSession, max_wait: float,
+    ) -> tuple[list[int], list[int]]:
+        """Delete queue rows of blocked users, then the oldest ones"""
+        pruned = await session.scalars(
+            delete(Queue)
+            .where(
+                Queue.id.in_(
+                    select(User.id)
+                    .where(User.block_date != None)
+                )
+            )
+            .returning(Queue.id)
+        )
+        pruned = pruned.all()
+
+        expired = await session.scalars(
+            delete(Queue)
+            .where(Queue.time < datetime.now() - timedelta(seconds=max_wait))
+            .returning(Queue.id)
+        )
+        expired = expired.all()
+        return expired, pruned
+
+    async def is_waiting(self, context: UserContext) -> bool:
+        """Queue membership is loaded with the context"""
+        return context.in_queue
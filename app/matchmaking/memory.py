@@ -0,0 +1,451 @@
+"""In-memory matchmaking"""
+import time
+import asyncio
+import logging
+from contextlib import suppress
+from itertools import islice
+from datetime import datetime, timedelta
+from collections import OrderedDict
+from typing import Optional
+
+from sqlalchemy import delete, insert
+from sqlalchemy.future import select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from app.database.models import User, Queue
+from app.database.context import UserContext
+from .recent import RecentPartners
+from .base import (
+    AlreadyPaired, Bucket, Matchmaker, MATCHES, WAIT_SECONDS, WAITING, TICK_SECONDS,
+    TICK_PAIRS, get_bucket, get_bucket_name, get_partner_buckets,
+    is_compatible,
+)
+
+logger = logging.getLogger('matchmaking')
+
+# Age gap from which a partner of an unknown age is preferred
+AGE_UNKNOWN = 10
+
+
+class Ticket(object):
+    """Waiting user"""
+    __slots__ = ('user_id', 'bucket', 'enqueued', 'age')
+
+    def __init__(
+        self, user_id: int, bucket: Bucket, enqueued: float,
+        age: Optional[int] = None,
+    ) -> None:
+        self.user_id = user_id
+        self.bucket = bucket
+        self.enqueued = enqueued
+        self.age = age
+
+
+class MemoryMatchmaker(Matchmaker):
+    """
+    Process-local search queue with a FIFO per bucket, a partner is found by
+    looking at the heads of at most four compatible buckets.
+
+    With a tick interval searches only enqueue, and every tick pairs the
+    waiting users of compatible buckets by age proximity instead. Buckets
+    are also indexed by age for that, so the closest age is a few lookups.
+
+    The queue table is written behind as a copy for restarts, so a single
+    process may own the queue.
+
+    A taken partner is claimed until the dialogue is committed, its own
+    search meanwhile fails. Users of a tick pair whose dialogue fails are
+    put back at the head of their buckets.
+    """
+
+    # Seconds a taken partner stays claimed if the dialogue never commits
+    CLAIM_TTL = 30
+
+    # Waiting users handled by a tick between yields to the event loop
+    TICK_CHUNK = 500
+
+    def __init__(
+        self, recent: RecentPartners, sessionmaker: async_sessionmaker,
+        flush_interval: float, tick_interval: float = 0, tick_window: int = 32,
+        tick_limit: int = 5000,
+    ) -> None:
+        """
+        Initialize the MemoryMatchmaker class
+
+        :param RecentPartners recent: Recent partners of users
+        :param async_sessionmaker sessionmaker: Async sessionmaker
+        :param float flush_interval: Queue table write interval, in seconds
+        :param float tick_interval: Batch matching interval, 0 disables it
+        :param int tick_window: Candidates looked at per age group
+        :param int tick_limit: Waiting users handled per tick
+        """
+
+        super().__init__(recent)
+        self.sessionmaker = sessionmaker
+        self.flush_interval = flush_interval
+        self.tick_interval = tick_interval
+        self.tick_window = tick_window
+        self.tick_limit = tick_limit
+        self.buckets: dict[Bucket, OrderedDict[int, Ticket]] = {}
+        self.ages: dict[Bucket, dict[Optional[int], OrderedDict]] = {}
+        self.tickets: dict[int, Ticket] = {}
+        # Taken users until their dialogue is committed: user id -> expiry
+        self.claimed: dict[int, float] = {}
+        # Tickets of claimed users, requeued if their dialogue fails
+        self.taken: dict[int, Ticket] = {}
+        # Last change per user: queue row values or None for a deletion
+        self.pending: dict[int, Optional[dict]] = {}
+        self._tasks: list[asyncio.Task] = []
+        self._closing = asyncio.Event()
+        WAITING.callback = self.waiting
+
+    async def start(self) -> None:
+        """Restore the queue from the table and start background jobs"""
+        async with self.sessionmaker() as session:
+            entries = await session.execute(
+                select(Queue, User.age)
+                .join(User, User.id == Queue.id)
+                .order_by(Queue.time)
+            )
+            # Waiting users keep their place and waited time
+            now, current_time = time.monotonic(), datetime.now()
+            for entry, age in entries:
+                self._enqueue(Ticket(
+                    entry.id,
+                    get_bucket(entry.is_adult, entry.is_man, entry.target_man),
+                    now - (current_time - entry.time).total_seconds(), age,
+                ))
+
+        await self.recent.load(self.tickets)
+        logger.info('Restored %i waiting users', len(self.tickets))
+        self._tasks.append(asyncio.create_task(self._writer()))
+        if self.tick_interval:
+            self._tasks.append(asyncio.create_task(self._ticker()))
+
+    async def close(self) -> None:
+        """Stop background jobs and flush the rest"""
+        # Running flushes and ticks are finished, cancelling them loses changes
+        self._closing.set()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.flush()
+
+    async def search(
+        self, session: AsyncSession, user: User,
+        target_man: Optional[bool], is_adult: bool,
+    ) -> Optional[int]:
+        """Take the longest waiting compatible partner or enqueue the user"""
+        # In a dialogue, or taken by a search or tick and not committed yet
+        if (
+            user.partner_id is not None
+            or self.claimed.get(user.id, 0) > time.monotonic()
+        ):
+            raise AlreadyPaired()
+
+        self._dequeue(user.id)
+        self.rates.arrived(get_bucket(is_adult, user.is_man, target_man))
+        await self.recent.get(user.id)
+
+        # Pairs are made by ticks
+        heads = [] if self.tick_interval else [
+            self._first_match(user.id, bucket)
+            for bucket in map(
+                self.buckets.get,
+                get_partner_buckets(is_adult, user.is_man, target_man),
+            )
+            if bucket
+        ]
+        heads = [head for head in heads if head]
+
+        if heads:
+            match = min(heads, key=lambda ticket: ticket.enqueued)
+            self._take(match)
+            self._observe([match])
+            return match.user_id
+
+        self._enqueue(Ticket(
+            user.id,
+            get_bucket(is_adult, user.is_man, target_man),
+            time.monotonic(),
+            user.age,
+        ))
+        self.pending[user.id] = dict(
+            id=user.id,
+            is_man=user.is_man,
+            target_man=target_man,
+            is_adult=is_adult,
+            time=datetime.now(),
+        )
+
+    async def leave(self, session: AsyncSession, *user_ids: int) -> None:
+        """Remove users from the queue"""
+        for user_id in user_ids:
+            if self._dequeue(user_id):
+                self.pending[user_id] = None
+
+    async def paired(self, first: int, second: int) -> None:
+        """Release claims of a committed pair"""
+        for user_id in (first, second):
+            self.claimed.pop(user_id, None)
+            self.taken.pop(user_id, None)
+        await super().paired(first, second)
+
+    def release(self, *user_ids: int) -> None:
+        """Requeue claimed users whose dialogue was not created"""
+        now, current_time = time.monotonic(), datetime.now()
+        for user_id in user_ids:
+            self.claimed.pop(user_id, None)
+            ticket = self.taken.pop(user_id, None)
+            # Committed, expired or searching again
+            if ticket is None or user_id in self.tickets:
+                continue
+
+            self._enqueue(ticket)
+            self.buckets[ticket.bucket].move_to_end(user_id, last=False)
+            self.ages[ticket.bucket][ticket.age].move_to_end(
+                user_id, last=False,
+            )
+            is_adult, is_man, target_man = ticket.bucket
+            self.pending[user_id] = dict(
+                id=user_id,
+                is_man=is_man,
+                target_man=target_man,
+                is_adult=is_adult,
+                time=current_time - timedelta(seconds=now - ticket.enqueued),
+            )
+
+    async def sweep(
+        self, session: AsyncSession, max_wait: float,
+    ) -> tuple[list[int], list[int]]:
+        """
+        Remove blocked users, found through the queue table so users
+        enqueued since the last flush wait for the next sweep. Buckets are
+        FIFO, expired tickets are the heads. Expired claims are dropped.
+        """
+
+        blocked = await session.scalars(
+            select(Queue.id)
+            .join(User, User.id == Queue.id)
+            .where(User.block_date != None)
+        )
+        pruned = [user_id for user_id in blocked if user_id in self.tickets]
+        await self.leave(session, *pruned)
+
+        expired = []
+        now = time.monotonic()
+        deadline = now - max_wait
+        for bucket in self.buckets.values():
+            for ticket in bucket.values():
+                if ticket.enqueued >= deadline:
+                    break
+                expired.append(ticket.user_id)
+        await self.leave(session, *expired)
+
+        self.claimed = {
+            user_id: expiry
+            for user_id, expiry in self.claimed.items()
+            if expiry > now
+        }
+        self.taken = {
+            user_id: ticket
+            for user_id, ticket in self.taken.items()
+            if user_id in self.claimed
+        }
+        return expired, pruned
+
+    async def is_waiting(self, context: UserContext) -> bool:
+        """Check the in-memory queue"""
+        return context.user.id in self.tickets
+
+    def _enqueue(self, ticket: Ticket) -> None:
+        """Add a ticket to the end of its bucket"""
+        self.buckets.setdefault(ticket.bucket, OrderedDict())[
+            ticket.user_id
+        ] = ticket
+        self.ages.setdefault(ticket.bucket, {}).setdefault(
+            ticket.age, OrderedDict(),
+        )[ticket.user_id] = ticket
+        self.tickets[ticket.user_id] = ticket
+
+    def _take(self, ticket: Ticket) -> None:
+        """Remove a matched ticket and claim its user"""
+        self._dequeue(ticket.user_id)
+        self.pending[ticket.user_id] = None
+        self.claimed[ticket.user_id] = time.monotonic() + self.CLAIM_TTL
+        self.taken[ticket.user_id] = ticket
+
+    def _observe(self, tickets: list[Ticket]) -> None:
+        """Count matched tickets and their wait time per bucket"""
+        now = time.monotonic()
+        waits: dict[Bucket, list[float]] = {}
+        for ticket in tickets:
+            wait = now - ticket.enqueued
+            waits.setdefault(ticket.bucket, []).append(wait)
+            self.rates.matched(ticket.bucket, wait)
+
+        for bucket, values in waits.items():
+            name = get_bucket_name(bucket)
+            MATCHES.inc(len(values), bucket=name)
+            WAIT_SECONDS.observe_many(values, bucket=name)
+
+    def waiting(self) -> dict[tuple, int]:
+        """Gauge callback with the amount of waiting users per bucket"""
+        return {
+            (get_bucket_name(key),): len(bucket)
+            for key, bucket in self.buckets.items()
+        }
+
+    def _dequeue(self, user_id: int) -> Optional[Ticket]:
+        """Remove a ticket of a user if there is one"""
+        ticket = self.tickets.pop(user_id, None)
+        if ticket is not None:
+            del self.buckets[ticket.bucket][user_id]
+            del self.ages[ticket.bucket][ticket.age][user_id]
+        return ticket
+
+    async def tick(self) -> list[tuple[int, int]]:
+        """
+        Pair waiting users of compatible buckets. Users are taken oldest
+        first, each with the longest waiting candidate of the closest age.
+        At most tick_limit users are handled, each looking at a bounded
+        amount of age groups of at most four buckets.
+
+        Other handlers run every TICK_CHUNK users. Paired users are claimed
+        right away, so their searches meanwhile fail, and tickets replaced
+        meanwhile are skipped.
+
+        :return list[tuple[int, int]]: Paired user ids
+        """
+
+        pairs, matched = [], []
+        budget, handled = self.tick_limit, 0
+        busy, started = 0.0, time.perf_counter()
+        buckets = [key for key, bucket in self.buckets.items() if bucket]
+        for key in buckets:
+            partners = [
+                partner for partner in buckets if is_compatible(key, partner)
+            ]
+            if not partners or budget <= 0:
+                continue
+
+            for ticket in list(islice(self.buckets[key].values(), budget)):
+                handled += 1
+                if handled % self.TICK_CHUNK == 0:
+                    self._observe(matched)
+                    matched = []
+                    busy += time.perf_counter() - started
+                    await asyncio.sleep(0)
+                    started = time.perf_counter()
+
+                # Taken as a candidate earlier in this tick or left meanwhile
+                if self.tickets.get(ticket.user_id) is not ticket:
+                    continue
+
+                budget -= 1
+                match = self._best_match(ticket, partners)
+                if match is not None:
+                    self._take(ticket)
+                    self._take(match)
+                    pairs.append((ticket.user_id, match.user_id))
+                    matched += (ticket, match)
+
+        self._observe(matched)
+        TICK_SECONDS.set(round(busy + time.perf_counter() - started, 6))
+        TICK_PAIRS.set(len(pairs))
+        return pairs
+
+    def _best_match(
+        self, ticket: Ticket, buckets: list[Bucket],
+    ) -> Optional[Ticket]:
+        """Get the candidate of the closest age, unknown ages match any"""
+        if ticket.age is not None:
+            for gap in range(AGE_UNKNOWN):
+                for bucket in buckets:
+                    ages = self.ages[bucket]
+                    for age in (ticket.age - gap, ticket.age + gap):
+                        group = ages.get(age)
+                        match = group and self._first_match(
+                            ticket.user_id, group,
+                        )
+                        if match:
+                            return match
+
+            for bucket in buckets:
+                group = self.ages[bucket].get(None)
+                match = group and self._first_match(ticket.user_id, group)
+                if match:
+                    return match
+
+        # Any age, the longest waiting
+        matches = [
+            match for match in (
+                self._first_match(ticket.user_id, self.buckets[bucket])
+                for bucket in buckets
+            )
+            if match
+        ]
+        return min(matches, key=lambda match: match.enqueued, default=None)
+
+    def _first_match(
+        self, user_id: int, group: OrderedDict[int, Ticket],
+    ) -> Optional[Ticket]:
+        """Get the longest waiting candidate that is not a recent partner"""
+        # Pairs are recorded for both users, one ring is enough
+        recent = self.recent.get_nowait(user_id)
+        for candidate in islice(group.values(), self.tick_window):
+            if (
+                candidate.user_id != user_id
+                and candidate.user_id not in recent
+            ):
+                return candidate
+
+    async def _ticker(self) -> None:
+        """Pair waiting users every tick until closed"""
+        while not await self._wait(self.tick_interval):
+            pairs = await self.tick()
+
+            if pairs and self.on_match is not None:
+                results = await asyncio.gather(
+                    *(self.on_match(*pair) for pair in pairs),
+                    return_exceptions=True,
+                )
+                for pair, result in zip(pairs, results):
+                    if isinstance(result, Exception):
+                        logger.error('Match handling failed', exc_info=result)
+                        self.release(*pair)
+
+    async def flush(self) -> None:
+        """Write pending changes to the queue table"""
+        if not self.pending:
+            return
+
+        pending, self.pending = self.pending, {}
+        rows = [row for row in pending.values() if row is not None]
+        try:
+            async with self.sessionmaker() as session:
+                await session.execute(
+                    delete(Queue)
+                    .where(Queue.id.in_(pending))
+                )
+                if rows:
+                    await session.execute(insert(Queue), rows)
+                await session.commit()
+
+        except BaseException:
+            # Keep changes made since for the next attempt
+            self.pending = {**pending, **self.pending}
+            raise
+
+    async def _writer(self) -> None:
+        """Write the queue table behind until closed"""
+        while not await self._wait(self.flush_interval):
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception('Queue write failed')
+
+    async def _wait(self, interval: float) -> bool:
+        """Wait for an interval, returns True once closing"""
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self._closing.wait(), interval)
+        return self._closing.is_set()
@@ -0,0 +1,126 @@
+"""Queue rates"""
+import time
+from typing import Hashable, Iterable, Optional
+
+
+class RollingCounter(object):
+    """
+    Sum of values added during the last ``window`` seconds, kept in fixed
+    time slots. Slots are cleared as time passes, so adding and reading are
+    O(1) amortized whatever the traffic.
+    """
+
+    __slots__ = ('width', 'values', 'total', 'slot')
+
+    def __init__(self, window: float = 600, slots: int = 60) -> None:
+        """
+        Initialize the RollingCounter class
+
+        :param float window: Window, in seconds
+        :param int slots: Slots per window
+        """
+
+        self.width = window / slots
+        self.values = [0.0] * slots
+        self.total = 0.0
+        self.slot = 0
+
+    def _advance(self, now: float) -> None:
+        """Clear slots that left the window"""
+        slot = int(now // self.width)
+        if slot == self.slot:
+            return
+
+        for passed in range(
+            max(self.slot + 1, slot - len(self.values) + 1), slot + 1,
+        ):
+            index = passed % len(self.values)
+            self.total -= self.values[index]
+            self.values[index] = 0.0
+        self.slot = slot
+
+    def add(self, value: float = 1, now: Optional[float] = None) -> None:
+        """Add a value"""
+        self._advance(time.monotonic() if now is None else now)
+        self.values[self.slot % len(self.values)] += value
+        self.total += value
+
+    def get(self, now: Optional[float] = None) -> float:
+        """Get the sum over the window"""
+        self._advance(time.monotonic() if now is None else now)
+        return self.total
+
+
+class QueueRates(object):
+    """
+    Search and match rates of every bucket over a rolling window, kept by
+    the matchmaker of this instance so estimates need no queries.
+    """
+
+    def __init__(self, window: float = 600) -> None:
+        """
+        Initialize the QueueRates class
+
+        :param float window: Window, in seconds
+        """
+
+        self.window = window
+        self.arrivals: dict[Hashable, RollingCounter] = {}
+        self.matches: dict[Hashable, RollingCounter] = {}
+        self.waited: dict[Hashable, RollingCounter] = {}
+
+    def _counter(
+        self, counters: dict[Hashable, RollingCounter], bucket: Hashable,
+    ) -> RollingCounter:
+        """Get the counter of a bucket"""
+        counter = counters.get(bucket)
+        if counter is None:
+            counter = counters[bucket] = RollingCounter(self.window)
+        return counter
+
+    def arrived(self, bucket: Hashable) -> None:
+        """Count a search of a user of a bucket"""
+        self._counter(self.arrivals, bucket).add()
+
+    def matched(self, bucket: Hashable, wait: float) -> None:
+        """Count a waiting user of a bucket taken after ``wait`` seconds"""
+        self._counter(self.matches, bucket).add()
+        self._counter(self.waited, bucket).add(wait)
+
+    def get_rates(self, bucket: Hashable) -> tuple[float, float]:
+        """
+        Get rates of a bucket.
+
+        :param Hashable bucket: Bucket
+        :return tuple[float, float]: Searches and matches per minute
+        """
+
+        return tuple(
+            self._counter(counters, bucket).get() * 60 / self.window
+            for counters in (self.arrivals, self.matches)
+        )
+
+    def estimate(
+        self, bucket: Hashable, partners: Iterable[Hashable],
+    ) -> Optional[float]:
+        """
+        Estimate the wait of a user enqueued into a bucket: the average wait
+        of users matched out of it lately, or without matches the time until
+        a compatible user searches.
+
+        :param Hashable bucket: Bucket of the waiting user
+        :param Iterable[Hashable] partners: Compatible buckets
+        :return Optional[float]: Wait in seconds, None if nobody searched
+        """
+
+        # Totals are floats, emptied counters may keep a rounding error
+        matches = self._counter(self.matches, bucket).get()
+        if matches >= 1:
+            return max(self._counter(self.waited, bucket).get(), 0) / matches
+
+        arrivals = sum(
+            self._counter(self.arrivals, partner).get()
+            for partner in partners
+        )
+        if arrivals >= 1:
+            return self.window / arrivals
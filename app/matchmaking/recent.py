@@ -0,0 +1,138 @@
+"""Recent partners"""
+import struct
+from typing import Iterable, Optional
+
+from redis.asyncio import Redis
+
+
+class RecentPartners(object):
+    """
+    Last partners of every user, not paired with them again.
+
+    A user takes a ring of ``size`` ids packed into one bytes object, most
+    recent first. Above ``capacity`` users the least recently matched are
+    forgotten, a user costs about 150 bytes with the default size of 5
+    (see benchmarks/recent_partners.py), so 1M users take about 150 MB.
+
+    With Redis rings are short lists shared by all instances for ``ttl``
+    seconds, the memory copy is then refreshed on reads.
+    """
+
+    KEY = 'recent:%s'
+
+    def __init__(
+        self, size: int = 5, capacity: int = 1000000,
+        redis: Optional[Redis] = None, ttl: int = 86400,
+    ) -> None:
+        """
+        Initialize the RecentPartners class
+
+        :param int size: Partners kept per user
+        :param int capacity: Users kept in memory
+        :param Optional[Redis] redis: Redis client, None to keep in memory
+        :param int ttl: Ring time to live in Redis, in seconds
+        """
+
+        self.size = size
+        self.capacity = capacity
+        self.redis = redis
+        self.ttl = ttl
+        self._struct = struct.Struct('<%iq' % size)
+        self._rings: dict[int, bytes] = {}
+
+    def get_nowait(self, user_id: int) -> tuple[int, ...]:
+        """
+        Get recent partners from memory.
+
+        :param int user_id: User id
+        :return tuple[int, ...]: Partner ids, most recent first
+        """
+
+        ring = self._rings.get(user_id)
+        if ring is None:
+            return ()
+        return tuple(filter(None, self._struct.unpack(ring)))
+
+    def is_recent(self, user_id: int, partner_id: int) -> bool:
+        """Check if two users were paired recently, memory only"""
+        ring = self._rings.get(user_id)
+        return ring is not None and partner_id in self._struct.unpack(ring)
+
+    async def get(self, user_id: int) -> tuple[int, ...]:
+        """
+        Get recent partners, from Redis if shared.
+
+        :param int user_id: User id
+        :return tuple[int, ...]: Partner ids, most recent first
+        """
+
+        if self.redis is None:
+            return self.get_nowait(user_id)
+
+        partner_ids = await self.redis.lrange(
+            self.KEY % user_id, 0, self.size - 1,
+        )
+        partner_ids = tuple(map(int, partner_ids))
+        self._store(user_id, partner_ids)
+        return partner_ids
+
+    async def load(self, user_ids: Iterable[int]) -> None:
+        """
+        Copy rings of users from Redis into memory.
+
+        :param Iterable[int] user_ids: User ids
+        """
+
+        user_ids = list(user_ids)
+        if self.redis is None or not user_ids:
+            return
+
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.lrange(self.KEY % user_id, 0, self.size - 1)
+            rings = await pipe.execute()
+
+        for user_id, partner_ids in zip(user_ids, rings):
+            self._store(user_id, tuple(map(int, partner_ids)))
+
+    def remember(self, first: int, second: int) -> None:
+        """Record a pair in memory"""
+        for user_id, partner_id in ((first, second), (second, first)):
+            self._store(user_id, (partner_id, *(
+                recent for recent in self.get_nowait(user_id)
+                if recent != partner_id
+            )))
+
+    async def add(self, first: int, second: int) -> None:
+        """
+        Record a pair.
+
+        :param int first: First user id
+        :param int second: Second user id
+        """
+
+        self.remember(first, second)
+        if self.redis is None:
+            return
+
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for user_id, partner_id in ((first, second), (second, first)):
+                key = self.KEY % user_id
+                pipe.lrem(key, 0, partner_id)
+                pipe.lpush(key, partner_id)
+                pipe.ltrim(key, 0, self.size - 1)
+                pipe.expire(key, self.ttl)
+            await pipe.execute()
+
+    def _store(self, user_id: int, partner_ids: tuple[int, ...]) -> None:
+        """Replace a ring in memory, evicting the oldest one if full"""
+        self._rings.pop(user_id, None)
+        if not partner_ids:
+            return
+
+        partner_ids = partner_ids[:self.size]
+        self._rings[user_id] = self._struct.pack(
+            *partner_ids, *(0,) * (self.size - len(partner_ids)),
+        )
+        if len(self._rings) > self.capacity:
+            del self._rings[next(iter(self._rings))]
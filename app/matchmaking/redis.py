@@ -0,0 +1,276 @@
+"""Redis matchmaking"""
+import time
+from typing import Iterable, Optional
+
+from redis.asyncio import Redis
+from sqlalchemy.future import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database.models import User
+from app.database.context import UserContext
+from .recent import RecentPartners
+from .base import (
+    AlreadyPaired, Bucket, Matchmaker, MATCHES, WAIT_SECONDS, WAITING,
+    get_bucket, get_bucket_name, get_partner_buckets,
+)
+
+# Every bucket has a fixed index, the key of a bucket is KEYS[index + 3]
+BUCKETS: tuple[Bucket, ...] = tuple(
+    get_bucket(is_adult, is_man, target_man)
+    for is_adult in (False, True)
+    for is_man in (True, False)
+    for target_man in (None, True, False)
+)
+
+# Leaves the previous bucket, then takes the longest waiting compatible
+# partner that is not a recent one or enqueues the user. A taken partner is
+# claimed until the dialogue is committed, its own search meanwhile fails.
+#
+# KEYS: users hash, claims hash, bucket sorted sets
+# ARGV: user id, bucket index, now, claim ttl, window, partner bucket count,
+#       partner bucket indexes..., recent partner ids...
+# Returns {partner id, enqueue time, partner bucket index}, 0 if enqueued,
+# -1 if claimed
+SEARCH_SCRIPT = """
+local users, claims = KEYS[1], KEYS[2]
+local user_id, now = ARGV[1], tonumber(ARGV[3])
+local window, count = tonumber(ARGV[5]), tonumber(ARGV[6])
+
+local previous = redis.call('HGET', users, user_id)
+if previous then
+    redis.call('ZREM', KEYS[tonumber(previous) + 3], user_id)
+    redis.call('HDEL', users, user_id)
+end
+
+local claim = redis.call('HGET', claims, user_id)
+if claim and tonumber(claim) > now then
+    return -1
+end
+
+local recent = {}
+for i = 7 + count, #ARGV do
+    recent[ARGV[i]] = true
+end
+
+local match, score, index
+for i = 7, 6 + count do
+    local heads = redis.call(
+        'ZRANGE', KEYS[tonumber(ARGV[i]) + 3], 0, window - 1, 'WITHSCORES'
+    )
+    for j = 1, #heads, 2 do
+        local candidate = heads[j]
+        if candidate ~= user_id and not recent[candidate] then
+            if not match or tonumber(heads[j + 1]) < tonumber(score) then
+                match, score, index = candidate, heads[j + 1], ARGV[i]
+            end
+            break
+        end
+    end
+end
+
+if match then
+    redis.call('ZREM', KEYS[tonumber(index) + 3], match)
+    redis.call('HDEL', users, match)
+    redis.call('HSET', claims, match, now + tonumber(ARGV[4]))
+    return {match, score, index}
+end
+
+redis.call('ZADD', KEYS[tonumber(ARGV[2]) + 3], now, user_id)
+redis.call('HSET', users, user_id, ARGV[2])
+return 0
+"""
+
+# KEYS: users hash, claims hash, bucket sorted sets
+# ARGV: user ids...
+LEAVE_SCRIPT = """
+for i = 1, #ARGV do
+    local bucket = redis.call('HGET', KEYS[1], ARGV[i])
+    if bucket then
+        redis.call('ZREM', KEYS[tonumber(bucket) + 3], ARGV[i])
+        redis.call('HDEL', KEYS[1], ARGV[i])
+    end
+end
+"""
+
+# Removes users enqueued before the deadline and expired claims
+#
+# KEYS: users hash, claims hash, bucket sorted sets
+# ARGV: deadline, now
+# Returns expired user ids
+EXPIRE_SCRIPT = """
+local expired = {}
+for i = 3, #KEYS do
+    local user_ids = redis.call('ZRANGEBYSCORE', KEYS[i], '-inf', ARGV[1])
+    for _, user_id in ipairs(user_ids) do
+        redis.call('ZREM', KEYS[i], user_id)
+        redis.call('HDEL', KEYS[1], user_id)
+        table.insert(expired, user_id)
+    end
+end
+
+local claims = redis.call('HGETALL', KEYS[2])
+for i = 1, #claims, 2 do
+    if tonumber(claims[i + 1]) <= tonumber(ARGV[2]) then
+        redis.call('HDEL', KEYS[2], claims[i])
+    end
+end
+return expired
+"""
+
+
+class RedisMatchmaker(Matchmaker):
+    """
+    Search queue shared by all instances through Redis: a sorted set per
+    bucket scored by the enqueue time and a hash of waiting users. Every
+    search is one script, so a partner is taken by exactly one instance.
+
+    Keys share a hash tag to stay on one Redis Cluster node.
+    """
+
+    KEY = 'matchmaking:{queue}:%s'
+
+    # Seconds a taken partner stays claimed if the dialogue never commits
+    CLAIM_TTL = 30
+
+    # Users checked for blocking per query
+    CHUNK_SIZE = 5000
+
+    def __init__(
+        self, recent: RecentPartners, redis: Redis, window: int = 32,
+    ) -> None:
+        """
+        Initialize the RedisMatchmaker class
+
+        :param RecentPartners recent: Recent partners of users
+        :param Redis redis: Redis client
+        :param int window: Candidates looked at per bucket
+        """
+
+        super().__init__(recent)
+        self.redis = redis
+        self.window = window
+        self.users_key = self.KEY % 'users'
+        self.claims_key = self.KEY % 'claims'
+        self.bucket_keys = [
+            self.KEY % get_bucket_name(bucket) for bucket in BUCKETS
+        ]
+        self.keys = [self.users_key, self.claims_key, *self.bucket_keys]
+        self._search = redis.register_script(SEARCH_SCRIPT)
+        self._leave = redis.register_script(LEAVE_SCRIPT)
+        self._expire = redis.register_script(EXPIRE_SCRIPT)
+        # Refreshed by sweeps, the gauge callback can not wait for Redis
+        self._waiting: dict[tuple, int] = {}
+        WAITING.callback = self.waiting
+
+    async def search(
+        self, session: AsyncSession, user: User,
+        target_man: Optional[bool], is_adult: bool,
+    ) -> Optional[int]:
+        """Take a partner with the search script or enqueue the user"""
+        paired = await session.scalar(
+            select(User.partner_id)
+            .where(User.id == user.id)
+        )
+        if paired is not None:
+            await session.commit()
+            raise AlreadyPaired()
+
+        return await self.pop_or_enqueue(
+            user.id,
+            get_bucket(is_adult, user.is_man, target_man),
+            get_partner_buckets(is_adult, user.is_man, target_man),
+            await self.recent.get(user.id),
+        )
+
+    async def pop_or_enqueue(
+        self, user_id: int, bucket: Bucket,
+        partners: Iterable[Bucket], recent: Iterable[int] = (),
+    ) -> Optional[int]:
+        """
+        Run the search script.
+
+        :param int user_id: Searching user id
+        :param Bucket bucket: Bucket of the searching user
+        :param Iterable[Bucket] partners: Compatible buckets
+        :param Iterable[int] recent: Partner ids to skip
+        :return Optional[int]: Partner id, None if the user was enqueued
+        :raises AlreadyPaired: The user was taken by a concurrent search
+        """
+
+        self.rates.arrived(bucket)
+        partners = [BUCKETS.index(partner) for partner in partners]
+        now = time.time()
+        result = await self._search(
+            keys=self.keys,
+            args=[
+                user_id, BUCKETS.index(bucket), now, self.CLAIM_TTL,
+                self.window, len(partners), *partners, *recent,
+            ],
+        )
+
+        if result == -1:
+            raise AlreadyPaired()
+        if not result:
+            return None
+
+        partner_id, enqueued, index = result
+        wait = max(now - float(enqueued), 0)
+        name = get_bucket_name(BUCKETS[int(index)])
+        MATCHES.inc(bucket=name)
+        WAIT_SECONDS.observe(wait, bucket=name)
+        self.rates.matched(BUCKETS[int(index)], wait)
+        return int(partner_id)
+
+    async def leave(self, session: AsyncSession, *user_ids: int) -> None:
+        """Remove users from the shared queue"""
+        if user_ids:
+            await self._leave(
+                keys=self.keys, args=user_ids,
+            )
+
+    async def paired(self, first: int, second: int) -> None:
+        """Release claims of a committed pair"""
+        await self.redis.hdel(self.claims_key, first, second)
+        await super().paired(first, second)
+
+    async def sweep(
+        self, session: AsyncSession, max_wait: float,
+    ) -> tuple[list[int], list[int]]:
+        """Remove blocked users, then expire the oldest ones"""
+        waiting = list(map(int, await self.redis.hkeys(self.users_key)))
+        pruned = []
+        for index in range(0, len(waiting), self.CHUNK_SIZE):
+            blocked = await session.scalars(
+                select(User.id)
+                .where(
+                    User.id.in_(waiting[index:index + self.CHUNK_SIZE]),
+                    User.block_date != None,
+                )
+            )
+            pruned += blocked.all()
+        await self.leave(session, *pruned)
+
+        now = time.time()
+        expired = await self._expire(
+            keys=self.keys,
+            args=[now - max_wait, now],
+        )
+
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key in self.bucket_keys:
+                pipe.zcard(key)
+            sizes = await pipe.execute()
+        self._waiting = {
+            (get_bucket_name(bucket),): size
+            for bucket, size in zip(BUCKETS, sizes)
+            if size
+        }
+        return list(map(int, expired)), pruned
+
+    def waiting(self) -> dict[tuple, int]:
+        """Gauge callback with the waiting users as of the last sweep"""
+        return self._waiting
+
+    async def is_waiting(self, context: UserContext) -> bool:
+        """Check the shared queue"""
+        return bool(await self.redis.hexists(self.users_key, context.user.id))
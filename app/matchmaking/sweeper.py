@@ -0,0 +1,93 @@
+"""Search queue sweeper"""
+import asyncio
+import logging
+from contextlib import suppress
+from typing import NoReturn
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError
+from sqlalchemy.future import select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from app.database.models import User
+from app.templates import texts
+from app.templates.keyboards import user as nav
+from .base import Matchmaker, SWEPT
+
+logger = logging.getLogger('matchmaking')
+
+
+class QueueSweeper(object):
+    """
+    Removes users who blocked the bot or walked away from the search queue,
+    so nobody gets paired with them. Users who waited too long are told
+    their search was stopped.
+    """
+
+    # Seconds between messages to expired users
+    NOTIFY_DELAY = 0.05
+
+    def __init__(
+        self, bot: Bot, matchmaker: Matchmaker,
+        sessionmaker: async_sessionmaker, interval: float, max_wait: float,
+    ) -> None:
+        """
+        Initialize the QueueSweeper class
+
+        :param Bot bot: Bot
+        :param Matchmaker matchmaker: Search queue
+        :param async_sessionmaker sessionmaker: Async sessionmaker
+        :param float interval: Sweep interval, in seconds
+        :param float max_wait: Longest allowed wait, in seconds
+        """
+
+        self.bot = bot
+        self.matchmaker = matchmaker
+        self.sessionmaker = sessionmaker
+        self.interval = interval
+        self.max_wait = max_wait
+
+    async def sweep(self) -> tuple[list[int], list[int]]:
+        """
+        Sweep the queue once.
+
+        :return tuple[list[int], list[int]]: Expired and pruned user ids
+        """
+
+        async with self.sessionmaker() as session:
+            expired, pruned = await self.matchmaker.sweep(
+                session, self.max_wait,
+            )
+            await session.commit()
+            users = list(await session.scalars(
+                select(User)
+                .where(User.id.in_(expired))
+            )) if expired else []
+
+        SWEPT.inc(len(expired), reason='expired')
+        SWEPT.inc(len(pruned), reason='pruned')
+        if expired or pruned:
+            logger.info(
+                'Swept the queue: %i expired, %i pruned',
+                len(expired), len(pruned),
+            )
+
+        await self.notify(users)
+        return expired, pruned
+
+    async def notify(self, users: list[User]) -> None:
+        """Tell expired users their search was stopped"""
+        for user in users:
+            with suppress(TelegramAPIError):
+                await self.bot.send_message(
+                    user.id,
+                    texts.user.SEARCH_EXPIRED,
+                    reply_markup=nav.reply.main_menu(user),
+                )
+            await asyncio.sleep(self.NOTIFY_DELAY)
+
+    async def sweeper(self) -> NoReturn:
+        """Sweep the queue every interval"""
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.sweep()
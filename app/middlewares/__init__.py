@@ -1,6 +1,9 @@
 """Middlewares package"""
 from aiogram import Dispatcher
 from app.utils.payments import TelegramStars
+from app.database.cache import UserCache, SponsorCache
+from app.utils.cache import MemoryCache
+from app.utils.config import Botstat
 from sqlalchemy.ext.asyncio import async_sessionmaker
 
 from .user import UserMiddleware
@@ -8,20 +11,45 @@ from .callback import CallbackMiddleware
 from .subscribe import SubMiddleware
 from .session import SessionMiddleware
 from .payment import PaymentMiddleware
+from .metrics import MetricsMiddleware
 
 
-def setup(dp: Dispatcher, sessionmaker: async_sessionmaker, payment: TelegramStars) -> None:
+def setup(
+    dp: Dispatcher,
+    sessionmaker: async_sessionmaker,
+    payment: TelegramStars,
+    user_cache: UserCache,
+    sub_cache: MemoryCache,
+    sponsor_cache: SponsorCache,
+    sub_negative_ttl: float,
+    botstat: Botstat,
+) -> None:
     """
     Initialises and binds all the middlewares.
 
     :param Dispatcher dp: Dispatcher (root Router)
     :param async_sessionmaker sessionmaker: Async Sessionmaker
+    :param TelegramStars payment: Payments provider
+    :param UserCache user_cache: Cache of users
+    :param MemoryCache sub_cache: Cache of subscription checks
+    :param SponsorCache sponsor_cache: Cache of active sponsors
+    :param float sub_negative_ttl: Time to remember a missing subscription
+    :param Botstat botstat: Botstat API settings
     """
 
+    subscribe = SubMiddleware(
+        sub_cache, sponsor_cache, sub_negative_ttl, botstat,
+    )
+
     dp.update.outer_middleware(SessionMiddleware(sessionmaker))
-    dp.update.outer_middleware(UserMiddleware())
-    dp.message.outer_middleware(SubMiddleware())
-    dp.callback_query.outer_middleware(SubMiddleware())
-    dp.inline_query.outer_middleware(SubMiddleware())
+    dp.update.outer_middleware(UserMiddleware(user_cache))
+    dp.message.outer_middleware(subscribe)
+    dp.callback_query.outer_middleware(subscribe)
+    dp.inline_query.outer_middleware(subscribe)
     dp.callback_query.outer_middleware(CallbackMiddleware())
     dp.update.outer_middleware(PaymentMiddleware(payment))
+
+    metrics = MetricsMiddleware()
+    for name, observer in dp.observers.items():
+        if name not in ('update', 'error'):
+            observer.middleware(metrics)
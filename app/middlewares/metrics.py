@@ -0,0 +1,74 @@
+"""Metrics middleware"""
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from app.utils.metrics import Histogram
+
+
+PARSE_SECONDS = Histogram(
+    'update_parse_seconds', 'Webhook body decoding and validation time',
+    ('update_type',),
+)
+PROCESS_SECONDS = Histogram(
+    'update_process_seconds', 'Dispatcher time of an update',
+    ('update_type',),
+)
+MIDDLEWARE_SECONDS = Histogram(
+    'update_middleware_seconds',
+    'Dispatcher time of an update outside of handlers', ('update_type',),
+)
+HANDLER_SECONDS = Histogram(
+    'update_handler_seconds', 'Handler time', ('update_type', 'handler'),
+)
+
+
+@dataclass
+class UpdateTimings:
+    """Handler time accumulated while an update is processed"""
+    handler: float = 0.0
+
+
+def get_handler_name(callback: Callable) -> str:
+    """
+    Get a short handler name, e.g. "dialogue.forward_message".
+
+    :param Callable callback: Handler callback
+    :return str: Handler name
+    """
+
+    return '%s.%s' % (
+        callback.__module__.rsplit('.', 1)[-1],
+        getattr(callback, '__name__', type(callback).__name__),
+    )
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """
+    Inner middleware measuring handler time.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        """Metrics middleware"""
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            elapsed = time.perf_counter() - started
+            HANDLER_SECONDS.observe(
+                elapsed,
+                update_type=data['event_update'].event_type,
+                handler=get_handler_name(data['handler'].callback),
+            )
+
+            timings: UpdateTimings = data.get('timings')
+            if timings is not None:
+                timings.handler += elapsed
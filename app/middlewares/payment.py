@@ -22,7 +22,5 @@ class PaymentMiddleware(BaseMiddleware):
         event: Update,
         data: Dict[str, Any],
     ) -> Any:
-        logger.info("PaymentMiddleware called")
         data["payment"] = self.payment
-        logger.info("Payment object injected into data")
         return await handler(event, data)
\ No newline at end of file
@@ -2,17 +2,37 @@
 from typing import Any, Awaitable, Callable, Dict
 from aiogram import BaseMiddleware
 from aiogram.types import Update
+from sqlalchemy import event
+from sqlalchemy.orm import Session
 from sqlalchemy.ext.asyncio import async_sessionmaker
 
+from app.utils.metrics import Counter
+
+
+DB_SESSIONS = Counter(
+    'db_sessions_total',
+    'Update sessions by whether they checked out a connection',
+    ('update_type', 'touched'),
+)
+
+
+def mark_touched(session: Session, *_: Any) -> None:
+    """Remember that the session began a transaction on a connection"""
+    session.info['touched'] = True
+
 
 class SessionMiddleware(BaseMiddleware):
     """
     Middleware for adding session.
+
+    The session checks a connection out of the pool on its first statement
+    only, so updates answered from caches do not touch the database.
     """
 
     def __init__(self, sessionmaker: async_sessionmaker) -> None:
         """Session middleware"""
         self.sessionmaker = sessionmaker
+        event.listen(Session, 'after_begin', mark_touched)
 
     async def __call__(
         self,
@@ -23,4 +43,10 @@ class SessionMiddleware(BaseMiddleware):
         """Session middleware"""
         async with self.sessionmaker() as session:
             data["session"] = session
-            return await handler(event, data)
+            try:
+                return await handler(event, data)
+            finally:
+                DB_SESSIONS.inc(
+                    update_type=event.event_type,
+                    touched='yes' if session.info.get('touched') else 'no',
+                )
@@ -1,36 +1,122 @@
 """Subscribe middleware"""
+import time
 import aiohttp
 import asyncio
+import logging
 
-from app.utils.config import Settings
+from app.utils.cache import MemoryCache
+from app.utils.breaker import CircuitBreaker
+from app.utils.metrics import Histogram
+from app.utils.config import Settings, Botstat
+from app.database.cache import SponsorCache
 from app.database.models import User, Sponsor
 
 from functools import lru_cache
 from contextlib import suppress
-from typing import Any, Awaitable, Callable, Dict, Optional
+from typing import Any, Awaitable, Callable, Dict, Generator, Optional
 
 from aiogram import BaseMiddleware, Bot
-from aiogram.types import Update, Chat
+from aiogram.types import Update, Chat, CallbackQuery
 from aiogram.exceptions import (
     TelegramNotFound,
     TelegramForbiddenError,
     TelegramBadRequest,
     TelegramAPIError,
 )
-from aiogram.fsm.context import FSMContext
 from aiogram.utils.token import TokenValidationError
-from sqlalchemy.future import select
 from sqlalchemy.ext.asyncio import AsyncSession
 
+logger = logging.getLogger('subscribe')
+
+SPONSOR_CHECK_SECONDS = Histogram(
+    'sponsor_check_seconds', 'Subscription check time', ('sponsor',),
+)
+
+# Check result that must not be cached: botstat was unavailable
+UNCHECKED = object()
+
+
+class LazySponsors(object):
+    """
+    Sponsors the user is not subscribed to, resolved on the first await and
+    memoised for the rest of the update.
+    """
+
+    def __init__(self, resolve: Callable[[], Awaitable[list[Sponsor]]]) -> None:
+        """
+        Initialize the LazySponsors class
+
+        :param Callable resolve: Coroutine function resolving the sponsors
+        """
+
+        self._resolve = resolve
+        self._future: Optional[asyncio.Future] = None
+
+    def __await__(self) -> Generator[Any, None, list[Sponsor]]:
+        """Resolve sponsors once"""
+        if self._future is None:
+            self._future = asyncio.ensure_future(self._resolve())
+        return self._future.__await__()
+
 
 class SubMiddleware(BaseMiddleware):
     """
     Middleware for checking user's subscription
     """
 
-    def __init__(self) -> None:
-        """Subscribe middleware"""
-        self.session = aiohttp.ClientSession()
+    def __init__(
+        self,
+        sub_cache: MemoryCache,
+        sponsor_cache: SponsorCache,
+        negative_ttl: float,
+        botstat: Botstat,
+    ) -> None:
+        """
+        Subscribe middleware
+
+        :param MemoryCache sub_cache: Cache of (user, sponsor) check results
+        :param SponsorCache sponsor_cache: Cache of active sponsors
+        :param float negative_ttl: Time to remember a missing subscription
+        :param Botstat botstat: Botstat API settings
+        """
+        self.sub_cache = sub_cache
+        self.sponsor_cache = sponsor_cache
+        self.negative_ttl = negative_ttl
+
+        # Sponsor bots by token, None for botstat tokens
+        self.bots: dict[str, Optional[Bot]] = {}
+
+        self.botstat = botstat
+        self.breaker = CircuitBreaker(
+            'botstat', botstat.failures, botstat.cooldown,
+        )
+        self.semaphore = asyncio.Semaphore(botstat.concurrency)
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """Botstat HTTP session, created on the running loop"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.botstat.timeout),
+            )
+        return self._session
+
+    def get_bot(self, token: str, bot: Bot) -> Optional[Bot]:
+        """
+        Get a sponsor bot sharing the HTTP session of the main bot.
+
+        :param str token: Sponsor bot token
+        :param Bot bot: Main bot
+        :return Optional[Bot]: Bot or None if the token is a botstat one
+        """
+
+        if token not in self.bots:
+            try:
+                self.bots[token] = Bot(token, session=bot.session)
+            except TokenValidationError:
+                self.bots[token] = None
+        return self.bots[token]
 
     async def __call__(
         self,
@@ -39,48 +125,47 @@ class SubMiddleware(BaseMiddleware):
         data: Dict[str, Any],
     ) -> Any:
         """Subscribe middleware"""
+        data['sponsors'] = LazySponsors(lambda: self.resolve(event, data))
+        return await handler(event, data)
+
+    async def resolve(
+        self, event: Update, data: Dict[str, Any],
+    ) -> list[Sponsor]:
+        """Get sponsors the user is not subscribed to"""
         user: Optional[User] = data.get('user')
         config: Settings = data['config']
-        state: FSMContext = data['state']
         session: AsyncSession = data['session']
         chat: Optional[Chat] = data.get('event_chat')
-        data["sponsors"] = []
 
         if (
             not chat
             or getattr(user, 'id', 0) in config.bot.admins
             or user.is_admin
         ):
-            return await handler(event, data)
-
-        state_data = await state.get_data()
+            return []
 
         if chat.type != 'private' or user.is_vip:
-            return await handler(event, data)
+            return []
 
         user = user or data.get('event_from_user')
 
-        sponsors = await session.scalars(
-            select(Sponsor)
-            .where(Sponsor.is_active == True)
-        )
-        sponsors = sponsors.all()
-        available_sponsors = await self.get_sponsors(
-            sponsors, user, data['bot']
-        )
-        data['sponsors'] = available_sponsors
-        return await handler(event, data)
+        # "Check subscription" button must not trust a negative result
+        fresh = isinstance(event, CallbackQuery) and event.data == 'checksub'
+
+        sponsors = await self.sponsor_cache.get(session)
+        return await self.get_sponsors(sponsors, user, data['bot'], fresh)
 
     async def get_sponsors(
         self,
         sponsors: list[Sponsor],
         user: User,
-        bot: Bot
+        bot: Bot,
+        fresh: bool = False,
     ) -> list[Sponsor]:
         """Get sponsors"""
         response = await asyncio.gather(
             *(
-                self._check_sub(sponsor, user, bot)
+                self._check_sub_cached(sponsor, user, bot, fresh)
                 for sponsor in [
                     obj for obj in sponsors
                     if obj.check
@@ -101,6 +186,33 @@ class SubMiddleware(BaseMiddleware):
 
         return []
 
+    async def _check_sub_cached(
+        self,
+        sponsor: Sponsor,
+        user: User,
+        bot: Bot,
+        fresh: bool,
+    ) -> Optional[Sponsor]:
+        """Check subscription, remembering the result"""
+        key = '%i:%i' % (user.id, sponsor.id)
+        subbed = await self.sub_cache.get(key)
+        if subbed or (subbed is not None and not fresh):
+            return None if subbed else sponsor
+
+        started = time.perf_counter()
+        result = await self._check_sub(sponsor, user, bot)
+        SPONSOR_CHECK_SECONDS.observe(
+            time.perf_counter() - started, sponsor=sponsor.id,
+        )
+
+        if result is UNCHECKED:
+            return None
+        if result is None:
+            await self.sub_cache.set(key, True)
+        else:
+            await self.sub_cache.set(key, False, self.negative_ttl)
+        return result
+
     async def _check_sub(
         self,
         sponsor: Sponsor,
@@ -109,23 +221,16 @@ class SubMiddleware(BaseMiddleware):
     ) -> Optional[Sponsor]:
         """Check subscription"""
         if sponsor.is_bot:
+            bot_ = self.get_bot(sponsor.access_id, bot)
+            if bot_ is None:
+                with suppress(ValueError):
+                    self._validate_botstat_token(sponsor.access_id)
+                    return await self._check_botstat(sponsor, user)
+                return None
 
             try:
-                bot_ = Bot(sponsor.access_id, session=bot.session)
                 await bot_.send_chat_action(user.id, 'typing')
 
-            except TokenValidationError:
-                with suppress(ValueError):
-                    self._validate_botstat_token(sponsor.access_id)
-                    async with self.session.get(
-                        'https://api.botstat.io/checksub/%s/%i' % (
-                            sponsor.access_id, user.id,
-                        )
-                    ) as response:
-                        data = await response.json(content_type=None)
-                        if not data['ok']:
-                            return sponsor
-
             except (
                 TelegramNotFound,
                 TelegramBadRequest,
@@ -143,6 +248,44 @@ class SubMiddleware(BaseMiddleware):
                 if member.status in ('left', 'kicked', None):
                     return sponsor
 
+    async def _check_botstat(self, sponsor: Sponsor, user: User) -> Any:
+        """Check subscription through botstat, failing open"""
+        if not self.breaker.allow():
+            return UNCHECKED
+
+        try:
+            # Waiting for a free slot counts against the timeout too
+            subbed = await asyncio.wait_for(
+                self._fetch_botstat(sponsor, user), self.botstat.timeout,
+            )
+
+        except (
+            aiohttp.ClientError,
+            asyncio.TimeoutError,
+            ValueError,
+            KeyError,
+            TypeError,
+        ) as exc:
+            logger.warning(
+                'Botstat check of sponsor %i failed: %r', sponsor.id, exc,
+            )
+            self.breaker.failure()
+            return UNCHECKED
+
+        self.breaker.success()
+        return None if subbed else sponsor
+
+    async def _fetch_botstat(self, sponsor: Sponsor, user: User) -> bool:
+        """Request a botstat subscription check"""
+        async with self.semaphore:
+            async with self.session.get(
+                'https://api.botstat.io/checksub/%s/%i' % (
+                    sponsor.access_id, user.id,
+                )
+            ) as response:
+                data = await response.json(content_type=None)
+                return data['ok']
+
     @staticmethod
     @lru_cache
     def _validate_botstat_token(token: str) -> None:
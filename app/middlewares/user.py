@@ -1,5 +1,7 @@
 """User middleware"""
 from app.database.models import User, Referral
+from app.database.cache import UserCache
+from app.database.context import UserContext, load_context
 from app.utils.text import get_ref
 
 from typing import Any, Awaitable, Callable, Dict, Optional
@@ -9,7 +11,6 @@ from aiogram import BaseMiddleware, Bot, types
 from aiogram.types import Update
 from aiogram.exceptions import TelegramAPIError
 
-from sqlalchemy.orm import selectinload
 from sqlalchemy.future import select
 from sqlalchemy.ext.asyncio import AsyncSession
 
@@ -19,6 +20,17 @@ class UserMiddleware(BaseMiddleware):
     Middleware for registering user.
     """
 
+    # Update types whose handlers do not use the user
+    SKIP_UPDATES = ('chat_join_request', 'pre_checkout_query')
+
+    def __init__(self, cache: UserCache) -> None:
+        """
+        User middleware
+
+        :param UserCache cache: Cache of users
+        """
+        self.cache = cache
+
     @staticmethod
     async def user_ref(link: str, bot: Bot, session: AsyncSession) -> None:
 
@@ -52,7 +64,7 @@ class UserMiddleware(BaseMiddleware):
         event_user: Optional[types.User] = data.get("event_from_user")
         event_chat: Optional[types.Chat] = data.get("event_chat")
 
-        if not event_user or event.chat_join_request:
+        if not event_user or event.event_type in self.SKIP_UPDATES:
             return await handler(event, data)
 
         session: AsyncSession = data['session']
@@ -61,13 +73,22 @@ class UserMiddleware(BaseMiddleware):
         bot_info = await data['bot'].me()
         data['bot_info'] = bot_info
 
-        user = await session.scalar(
-            select(User)
-            .where(User.id == event_user.id)
-            .options(selectinload(User.partner))
-        )
-
-        if user:
+        context = await self.cache.get(session, event_user.id)
+        if not context:
+            # Read first, a change committed while loading skips caching
+            version = await self.cache.version(event_user.id)
+            context = await load_context(session, event_user.id)
+            if context:
+                await self.cache.set(context, version)
+
+        user = context and context.user
+
+        # Write the profile only when Telegram reports a change
+        if user and (
+            user.username != event_user.username
+            or user.first_name != event_user.first_name
+            or user.last_name != event_user.last_name
+        ):
             user.username = event_user.username
             user.first_name = event_user.first_name
             user.last_name = event_user.last_name
@@ -97,11 +118,12 @@ class UserMiddleware(BaseMiddleware):
             )
             session.add(user)
             await session.commit()
-            await session.refresh(user, ['partner'])
+            context = UserContext(user, False)
 
         elif getattr(event_chat, 'type', None) == 'private' and user.chat_only:
             user.chat_only = False
             await session.commit()
         data["user"] = user
+        data["context"] = context
 
         return await handler(event, data)
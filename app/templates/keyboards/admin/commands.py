@@ -58,5 +58,9 @@ ADMIN_COMMANDS = [
     BotCommand(
         command="dump_dialogue",
         description="Выгрузка диалога",
+    ),
+    BotCommand(
+        command="perf",
+        description="Профайлер обработки обновлений",
     )
 ]
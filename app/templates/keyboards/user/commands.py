@@ -15,6 +15,10 @@ USER_COMMANDS = [
         command="next",
         description="🔄 Növbəti həmsöhbət",
     ),
+    BotCommand(
+        command="status",
+        description="⏳ Axtarışın vəziyyəti",
+    ),
     BotCommand(
         command="profile",
         description="👤 Profil",
@@ -67,6 +67,15 @@ Növbəti həmsöhbəti tapmaq üçün - /next
 </i>
 '''
 
+SEARCH_EXPIRED = '''
+<i>⌛ Uzun müddət həmsöhbət tapılmadı, axtarış dayandırıldı
+
+Yenidən axtarmaq üçün - /next
+
+<code>https://t.me/meetbakubot</code>
+</i>
+'''
+
 DIALOGUE_END_SELF = '''
 <i>Siz söhbəti bitirdiniz 🙄
 
@@ -95,6 +104,18 @@ Axtarışı dayandırmaq üçün - /stop
 </i>
 '''
 
+SEARCH_WAIT = '<i>⏳ Təxmini gözləmə: %s</i>'
+WAIT_SHORT = 'bir dəqiqədən az'
+WAIT_MINUTES = '~%i dəqiqə'
+WAIT_LONG = 'bir saatdan çox'
+
+STATUS_DIALOGUE = '''
+<i>💬 Siz həmsöhbətlə danışırsınız
+
+Çatı bitirmək üçün - /stop
+</i>
+'''
+
 DIALOGUE_GENDER = '<i>Həmsöhbətin cinsini seçin! ❤️‍🔥</i>'
 DIALOGUE_FOUND = '''
 <b>Həmsöhbət tapıldı! 🎁</b>
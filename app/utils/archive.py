@@ -0,0 +1,280 @@
+"""Photo archive utils"""
+import json
+import time
+import asyncio
+import logging
+from pathlib import Path
+from typing import Optional, TextIO
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from redis.asyncio import Redis
+
+from app.utils.metrics import Counter, Gauge, Histogram
+
+logger = logging.getLogger('archive')
+
+ARCHIVE_PHOTOS = Counter(
+    'archive_photos_total', 'Dialogue photos by archiving result',
+    ('result',),
+)
+ARCHIVE_DELAY = Histogram(
+    'archive_delay_seconds', 'Time from relaying a photo until it is archived',
+    buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600),
+)
+ARCHIVE_LAG = Gauge(
+    'archive_lag_seconds', 'Age of the oldest photo waiting to be archived',
+)
+ARCHIVE_BACKLOG = Gauge(
+    'archive_backlog', 'Photos waiting to be archived',
+)
+
+
+class PhotoArchiver(object):
+    """
+    Downloads dialogue photos into the archive directory in the background,
+    so relaying a photo never waits for a download.
+
+    Failed downloads are retried with a growing delay. Every scheduled photo
+    is saved as it comes, in Redis if shared or in a log file next to the
+    archive, and removed once archived or given up on. Photos left by a
+    shutdown or a crash are archived after the next start. Instances
+    sharing Redis may download such a photo twice, into the same file.
+    """
+
+    KEY = 'archive:pending'
+    BACKLOG = '.pending.jsonl'
+
+    # Log lines over the pending photos that trigger a rewrite of the log
+    COMPACT_LINES = 1000
+
+    def __init__(
+        self, bot: Bot, directory: str = 'photo', workers: int = 4,
+        retries: int = 5, max_pending: int = 10000,
+        redis: Optional[Redis] = None,
+    ) -> None:
+        """
+        Initialize the PhotoArchiver class
+
+        :param Bot bot: Aiogram bot instance
+        :param str directory: Archive directory
+        :param int workers: Concurrent downloads
+        :param int retries: Retries of a failed download
+        :param int max_pending: Maximum amount of photos waiting
+        :param Optional[Redis] redis: Redis client to keep the backlog in
+        """
+
+        self.bot = bot
+        self.directory = Path(directory)
+        self.workers = workers
+        self.retries = retries
+        self.max_pending = max_pending
+        self.redis = redis
+        # Photos not archived yet, oldest first:
+        # image id -> [file id, relay time, failed attempts]
+        self.jobs: dict[str, list] = {}
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._tasks: list[asyncio.Task] = []
+        self._log: Optional[TextIO] = None
+        self._lines = 0
+        ARCHIVE_LAG.callback = self.lag
+        ARCHIVE_BACKLOG.callback = lambda: len(self.jobs)
+
+    async def start(self) -> None:
+        """Load the backlog and start workers"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        for image_id, file_id, relayed in await self._load():
+            self.jobs[image_id] = [file_id, relayed, 0]
+            self._queue.put_nowait(image_id)
+
+        if self.redis is None:
+            self._compact()
+
+        if self.jobs:
+            logger.info('Loaded %i photos to archive', len(self.jobs))
+        self._tasks = [
+            asyncio.create_task(self.worker(index))
+            for index in range(self.workers)
+        ]
+
+    async def close(self) -> None:
+        """Stop workers, photos left stay in the backlog"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        if self.jobs:
+            logger.info('Left %i photos to archive later', len(self.jobs))
+
+    async def put(self, file_id: str, image_id: str) -> bool:
+        """
+        Schedule and save a photo. Returns False if too many photos are
+        waiting.
+
+        :param str file_id: Telegram file id
+        :param str image_id: Archive name of the photo
+        :return bool: True if the photo will be archived
+        """
+
+        if image_id in self.jobs:
+            return True
+
+        if len(self.jobs) >= self.max_pending:
+            ARCHIVE_PHOTOS.inc(result='dropped')
+            return False
+
+        relayed = time.time()
+        self.jobs[image_id] = [file_id, relayed, 0]
+        self._queue.put_nowait(image_id)
+        try:
+            await self._save(image_id, file_id, relayed)
+        except Exception as e:
+            logger.warning(
+                'Photo %s was not saved to the backlog: %s', image_id, e,
+            )
+        return True
+
+    def lag(self) -> float:
+        """Gauge callback with the age of the oldest waiting photo"""
+        if not self.jobs:
+            return 0
+        _, relayed, _ = next(iter(self.jobs.values()))
+        return round(time.time() - relayed, 3)
+
+    async def worker(self, index: int) -> None:
+        """Archive photos until cancelled"""
+        while True:
+            image_id = await self._queue.get()
+            job = self.jobs.get(image_id)
+            if job is None:
+                continue
+
+            file_id, relayed, attempts = job
+            try:
+                await self.archive(file_id, image_id)
+
+            # The file is gone or too big, retrying would not help
+            except TelegramBadRequest as e:
+                self._fail(image_id, e)
+
+            except Exception as e:
+                job[2] = attempts = attempts + 1
+                if attempts > self.retries:
+                    self._fail(image_id, e)
+                else:
+                    ARCHIVE_PHOTOS.inc(result='retried')
+                    asyncio.get_running_loop().call_later(
+                        2 ** attempts, self._queue.put_nowait, image_id,
+                    )
+
+            else:
+                del self.jobs[image_id]
+                ARCHIVE_PHOTOS.inc(result='archived')
+                ARCHIVE_DELAY.observe(max(time.time() - relayed, 0))
+
+            if image_id not in self.jobs:
+                try:
+                    await self._forget(image_id)
+                except Exception as e:
+                    logger.warning(
+                        'Photo %s was not removed from the backlog: %s',
+                        image_id, e,
+                    )
+
+    async def archive(self, file_id: str, image_id: str) -> None:
+        """
+        Download a photo into the archive.
+
+        :param str file_id: Telegram file id
+        :param str image_id: Archive name of the photo
+        """
+
+        file = await self.bot.get_file(file_id)
+        await self.bot.download_file(
+            file.file_path, self.directory / f'{image_id}.jpg',
+        )
+
+    def _fail(self, image_id: str, error: Exception) -> None:
+        """Give up on a photo"""
+        del self.jobs[image_id]
+        ARCHIVE_PHOTOS.inc(result='failed')
+        logger.warning('Photo %s was not archived: %s', image_id, error)
+
+    async def _load(self) -> list[list]:
+        """Read the saved backlog, oldest first"""
+        if self.redis is not None:
+            jobs = await self.redis.hgetall(self.KEY)
+            return sorted(
+                (
+                    [image_id.decode(), *json.loads(job)]
+                    for image_id, job in jobs.items()
+                ),
+                key=lambda job: job[2],
+            )
+
+        path = self.directory / self.BACKLOG
+        if not path.exists():
+            return []
+
+        jobs = {}
+        with path.open() as file:
+            for line in file:
+                try:
+                    action, image_id, *job = json.loads(line)
+                # The last line may be cut by a crash
+                except ValueError:
+                    continue
+
+                if action == 'put':
+                    jobs[image_id] = job
+                else:
+                    jobs.pop(image_id, None)
+        return [[image_id, *job] for image_id, job in jobs.items()]
+
+    async def _save(self, image_id: str, file_id: str, relayed: float) -> None:
+        """Save a scheduled photo"""
+        if self.redis is not None:
+            await self.redis.hset(
+                self.KEY, image_id, json.dumps([file_id, relayed]),
+            )
+            return
+
+        self._write('put', image_id, file_id, relayed)
+
+    async def _forget(self, image_id: str) -> None:
+        """Remove a photo from the backlog"""
+        if self.redis is not None:
+            await self.redis.hdel(self.KEY, image_id)
+            return
+
+        self._write('done', image_id)
+        if self._lines > len(self.jobs) + self.COMPACT_LINES:
+            self._compact()
+
+    def _write(self, *entry) -> None:
+        """Append an entry to the backlog log"""
+        if self._log is None:
+            return
+
+        self._log.write(json.dumps(entry) + '\n')
+        self._log.flush()
+        self._lines += 1
+
+    def _compact(self) -> None:
+        """Rewrite the backlog log with the pending photos only"""
+        if self._log is not None:
+            self._log.close()
+
+        path = self.directory / self.BACKLOG
+        temporary = path.with_suffix('.tmp')
+        temporary.write_text(''.join(
+            json.dumps(['put', image_id, file_id, relayed]) + '\n'
+            for image_id, (file_id, relayed, _) in self.jobs.items()
+        ))
+        temporary.replace(path)
+        self._log = path.open('a')
+        self._lines = len(self.jobs)
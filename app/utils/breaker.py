@@ -0,0 +1,73 @@
+"""Circuit breaker utils"""
+import time
+import logging
+
+from app.utils.metrics import Gauge
+
+logger = logging.getLogger('breaker')
+
+BREAKER_OPEN = Gauge(
+    'circuit_breaker_open', 'Circuit breaker state, 1 if open', ('name',),
+)
+
+
+class CircuitBreaker(object):
+    """
+    Consecutive failures circuit breaker.
+
+    After ``threshold`` failures in a row calls are refused for ``cooldown``
+    seconds, then a single trial call decides whether to close it again.
+    """
+
+    def __init__(self, name: str, threshold: int, cooldown: float) -> None:
+        """
+        Initialize the CircuitBreaker class
+
+        :param str name: Breaker name, for logs and metrics
+        :param int threshold: Failures in a row to open the breaker
+        :param float cooldown: Time to keep the breaker open, in seconds
+        """
+
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = 0.0
+        BREAKER_OPEN.set(0, name=name)
+
+    @property
+    def is_open(self) -> bool:
+        """True if the breaker is open"""
+        return self.failures >= self.threshold
+
+    def allow(self) -> bool:
+        """
+        Check if a call may be made.
+
+        :return bool: False while the breaker is open
+        """
+
+        if not self.is_open:
+            return True
+
+        if time.monotonic() - self.opened < self.cooldown:
+            return False
+
+        # Trial call, another failure reopens the breaker for a cooldown
+        self.opened = time.monotonic()
+        return True
+
+    def success(self) -> None:
+        """Record a successful call"""
+        if self.is_open:
+            logger.info('Circuit "%s" closed', self.name)
+            BREAKER_OPEN.set(0, name=self.name)
+        self.failures = 0
+
+    def failure(self) -> None:
+        """Record a failed call"""
+        self.failures += 1
+        if self.failures == self.threshold:
+            logger.warning('Circuit "%s" opened', self.name)
+            BREAKER_OPEN.set(1, name=self.name)
+            self.opened = time.monotonic()
@@ -0,0 +1,272 @@
+"""Cache utils"""
+import time
+import pickle
+import asyncio
+import logging
+
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+from redis.asyncio import Redis
+
+from app.utils.metrics import Counter
+
+logger = logging.getLogger('cache')
+
+CACHE_REQUESTS = Counter(
+    'cache_requests_total', 'Cache lookups', ('cache', 'result'),
+)
+
+
+class MemoryCache(object):
+    """
+    Process-local cache with a TTL per entry and LRU eviction.
+
+    Every deletion bumps the version of the key. A value loaded from the
+    source is set with the version read before loading, so a value that was
+    invalidated meanwhile is not cached.
+    """
+
+    def __init__(self, name: str, ttl: float, size: int) -> None:
+        """
+        Initialize the MemoryCache class
+
+        :param str name: Cache name, for metrics
+        :param float ttl: Entry time to live, in seconds
+        :param int size: Maximum amount of entries
+        """
+
+        self.name = name
+        self.ttl = ttl
+        self.size = size
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        # Versions of deleted keys, at most size of them. Evicted keys share
+        # the highest evicted version, so a version never goes back.
+        self._versions: OrderedDict[Hashable, int] = OrderedDict()
+        self._clock = 0
+        self._floor = 0
+
+    async def get(self, key: Hashable) -> Optional[Any]:
+        """
+        Get a value, None on a miss.
+
+        :param Hashable key: Key
+        :return Optional[Any]: Cached value
+        """
+
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self._entries.pop(key, None)
+            CACHE_REQUESTS.inc(cache=self.name, result='miss')
+            return None
+
+        self._entries.move_to_end(key)
+        CACHE_REQUESTS.inc(cache=self.name, result='hit')
+        return entry[1]
+
+    async def version(self, key: Hashable) -> int:
+        """
+        Get the version of a key, read it before loading a value to set.
+
+        :param Hashable key: Key
+        :return int: Version
+        """
+
+        return self._versions.get(key, self._floor)
+
+    async def set(
+        self, key: Hashable, value: Any, ttl: Optional[float] = None,
+        version: Optional[int] = None,
+    ) -> None:
+        """
+        Set a value.
+
+        :param Hashable key: Key
+        :param Any value: Value, must not be None
+        :param Optional[float] ttl: Time to live, defaults to the cache TTL
+        :param Optional[int] version: Version read before loading the value,
+            the value is not set if the key was deleted since
+        """
+
+        if version is not None and version != await self.version(key):
+            return
+
+        self._entries[key] = (time.monotonic() + (ttl or self.ttl), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    async def delete(self, *keys: Hashable) -> None:
+        """
+        Delete values.
+
+        :param Hashable keys: Keys
+        """
+
+        self.delete_nowait(*keys)
+
+    def delete_nowait(self, *keys: Hashable) -> None:
+        """
+        Delete values from synchronous code.
+
+        :param Hashable keys: Keys
+        """
+
+        for key in keys:
+            self._entries.pop(key, None)
+            self._clock += 1
+            self._versions[key] = self._clock
+            self._versions.move_to_end(key)
+
+        while len(self._versions) > self.size:
+            _, self._floor = self._versions.popitem(last=False)
+
+
+# Sets a value unless its version changed since it was read
+#
+# KEYS: value key, version key
+# ARGV: value, ttl in milliseconds, version
+SET_SCRIPT = """
+if tonumber(redis.call('GET', KEYS[2]) or 0) == tonumber(ARGV[3]) then
+    redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+end
+"""
+
+
+class RedisCache(MemoryCache):
+    """
+    Cache shared between instances, values are pickled into Redis.
+
+    Versions are counters next to the values, kept for a TTL since the last
+    deletion. A value loaded for longer than the TTL may be set stale.
+    """
+
+    def __init__(self, name: str, ttl: float, redis: Redis) -> None:
+        """
+        Initialize the RedisCache class
+
+        :param str name: Cache name, also the key prefix
+        :param float ttl: Entry time to live, in seconds
+        :param Redis redis: Redis client
+        """
+
+        self.name = name
+        self.ttl = ttl
+        self.redis = redis
+        self._set = redis.register_script(SET_SCRIPT)
+        self._tasks: set[asyncio.Task] = set()
+
+    def _key(self, key: Hashable) -> str:
+        """Get Redis key, sharing a hash slot with the version key"""
+        return 'cache:%s:{%s}' % (self.name, key)
+
+    def _version_key(self, key: Hashable) -> str:
+        """Get Redis key of a version"""
+        return 'cache:%s:{%s}:version' % (self.name, key)
+
+    async def get(self, key: Hashable) -> Optional[Any]:
+        """
+        Get a value, None on a miss.
+
+        :param Hashable key: Key
+        :return Optional[Any]: Cached value
+        """
+
+        value = await self.redis.get(self._key(key))
+        if value is None:
+            CACHE_REQUESTS.inc(cache=self.name, result='miss')
+            return None
+
+        CACHE_REQUESTS.inc(cache=self.name, result='hit')
+        return pickle.loads(value)
+
+    async def version(self, key: Hashable) -> int:
+        """
+        Get the version of a key, read it before loading a value to set.
+
+        :param Hashable key: Key
+        :return int: Version
+        """
+
+        return int(await self.redis.get(self._version_key(key)) or 0)
+
+    async def set(
+        self, key: Hashable, value: Any, ttl: Optional[float] = None,
+        version: Optional[int] = None,
+    ) -> None:
+        """
+        Set a value.
+
+        :param Hashable key: Key
+        :param Any value: Value, must not be None
+        :param Optional[float] ttl: Time to live, defaults to the cache TTL
+        :param Optional[int] version: Version read before loading the value,
+            the value is not set if the key was deleted since
+        """
+
+        ttl = int((ttl or self.ttl) * 1000)
+        if version is None:
+            await self.redis.set(self._key(key), pickle.dumps(value), px=ttl)
+            return
+
+        await self._set(
+            keys=[self._key(key), self._version_key(key)],
+            args=[pickle.dumps(value), ttl, version],
+        )
+
+    async def delete(self, *keys: Hashable) -> None:
+        """
+        Delete values.
+
+        :param Hashable keys: Keys
+        """
+
+        if not keys:
+            return
+
+        # The version is bumped first, a set running in between is skipped
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.incr(self._version_key(key))
+                pipe.pexpire(self._version_key(key), int(self.ttl * 1000))
+                pipe.delete(self._key(key))
+            await pipe.execute()
+
+    def delete_nowait(self, *keys: Hashable) -> None:
+        """
+        Delete values from synchronous code, the deletion is scheduled on the
+        running loop.
+
+        :param Hashable keys: Keys
+        """
+
+        task = asyncio.get_running_loop().create_task(self.delete(*keys))
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+
+    def _done(self, task: asyncio.Task) -> None:
+        """Forget a finished deletion"""
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(
+                'Cache "%s" invalidation failed', self.name,
+                exc_info=task.exception(),
+            )
+
+
+def create_cache(
+    name: str, ttl: float, size: int, redis: Optional[Redis] = None,
+) -> MemoryCache:
+    """
+    Create a cache: Redis backed if a client is given, in-memory otherwise.
+
+    :param str name: Cache name
+    :param float ttl: Entry time to live, in seconds
+    :param int size: Maximum amount of entries for the in-memory cache
+    :param Optional[Redis] redis: Redis client
+    :return MemoryCache: Cache instance
+    """
+
+    if redis is not None:
+        return RedisCache(name, ttl, redis)
+    return MemoryCache(name, ttl, size)
@@ -0,0 +1,159 @@
+"""Cluster utils"""
+import uuid
+import asyncio
+import logging
+from contextlib import suppress
+from typing import Any, Awaitable, Callable, Optional
+
+from redis.asyncio import Redis
+
+logger = logging.getLogger('cluster')
+
+
+# Compare-and-set scripts, a lease is only touched by its owner
+RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class Cluster(object):
+    """
+    Coordination of bot instances (processes or nodes) through Redis.
+
+    Without Redis the instance is alone: every lease is granted.
+    """
+
+    KEY = 'cluster:%s'
+
+    def __init__(self, redis: Optional[Redis] = None) -> None:
+        """
+        Initialize the Cluster class
+
+        :param Optional[Redis] redis: Redis client, None for a single instance
+        """
+
+        self.redis = redis
+        self.instance_id = uuid.uuid4().hex
+        self._tasks: list[asyncio.Task] = []
+
+    @property
+    def is_shared(self) -> bool:
+        """True if state is shared through Redis"""
+        return self.redis is not None
+
+    async def acquire(self, name: str, ttl: int) -> bool:
+        """
+        Try to acquire a lease. Returns True if this instance holds it.
+
+        :param str name: Lease name
+        :param int ttl: Lease time to live, in seconds
+        :return bool: True on success
+        """
+
+        if self.redis is None:
+            return True
+
+        return bool(
+            await self.redis.set(
+                self.KEY % name, self.instance_id, nx=True, ex=ttl,
+            )
+        )
+
+    async def renew(self, name: str, ttl: int) -> bool:
+        """
+        Prolong a lease held by this instance.
+
+        :param str name: Lease name
+        :param int ttl: Lease time to live, in seconds
+        :return bool: False if the lease was lost
+        """
+
+        if self.redis is None:
+            return True
+
+        return bool(
+            await self.redis.eval(
+                RENEW_SCRIPT, 1, self.KEY % name, self.instance_id, ttl,
+            )
+        )
+
+    async def release(self, name: str) -> None:
+        """
+        Release a lease held by this instance.
+
+        :param str name: Lease name
+        """
+
+        if self.redis is not None:
+            await self.redis.eval(
+                RELEASE_SCRIPT, 1, self.KEY % name, self.instance_id,
+            )
+
+    def run_as_leader(
+        self,
+        name: str,
+        job: Callable[[], Awaitable[Any]],
+        ttl: int = 30,
+    ) -> None:
+        """
+        Run a singleton job on exactly one instance. Other instances wait and
+        take it over if the leader dies.
+
+        :param str name: Job name
+        :param Callable job: Coroutine function, runs until cancelled
+        :param int ttl: Leadership lease, in seconds
+        """
+
+        self._tasks.append(asyncio.create_task(self._leader(name, job, ttl)))
+
+    async def _leader(
+        self, name: str, job: Callable[[], Awaitable[Any]], ttl: int,
+    ) -> None:
+        """Leader election loop"""
+        lease = 'leader:' + name
+        while True:
+            if not await self.acquire(lease, ttl):
+                await asyncio.sleep(ttl / 3)
+                continue
+
+            logger.info('Instance %s runs "%s"', self.instance_id, name)
+            task = asyncio.create_task(job())
+            try:
+                while not task.done():
+                    await asyncio.wait({task}, timeout=ttl / 3)
+                    if not task.done() and not await self.renew(lease, ttl):
+                        logger.warning('Lost "%s" leadership', name)
+                        break
+            finally:
+                task.cancel()
+                with suppress(asyncio.CancelledError, Exception):
+                    await task
+                with suppress(Exception):
+                    await self.release(lease)
+
+            if task.cancelled():
+                continue
+
+            if task.exception() is None:
+                return
+
+            logger.error(
+                '"%s" failed, restarting', name, exc_info=task.exception(),
+            )
+            await asyncio.sleep(ttl / 3)
+
+    async def close(self) -> None:
+        """Stop singleton jobs and release leases"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
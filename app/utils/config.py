@@ -54,6 +54,95 @@ class Bot(BaseConfig):
         return json.loads(value) if isinstance(value, str) else value
 
 
+class Webhook(BaseConfig):
+    """Webhook settings"""
+    workers: int = 0
+    max_pending: int = 10000
+    dedup_size: int = 10000
+    dedup_ttl: int = 3600
+    fast_runtime: bool = False
+    log_sample_rate: float = 0.0
+    slow_threshold: float = 5.0
+    processes: int = 1
+    shed_depth: int = 1000
+    shed_lag: float = 0.5
+    drain_timeout: float = 8.0
+
+    class Config:
+        env_prefix = 'WEBHOOK_'
+
+
+class Cache(BaseConfig):
+    """Cache settings"""
+    size: int = 100000
+    user_ttl: int = 60
+    sub_ttl: int = 600
+    sub_negative_ttl: int = 30
+    sponsors_ttl: int = 60
+
+    class Config:
+        env_prefix = 'CACHE_'
+
+
+class Botstat(BaseConfig):
+    """Botstat API settings"""
+    timeout: float = 3.0
+    concurrency: int = 10
+    failures: int = 5
+    cooldown: float = 30.0
+
+    class Config:
+        env_prefix = 'BOTSTAT_'
+
+
+class Profiler(BaseConfig):
+    """Profiler settings"""
+    enabled: bool = False
+    window: int = 1000
+    top: int = 10
+
+    class Config:
+        env_prefix = 'PROFILER_'
+
+
+class Matchmaking(BaseConfig):
+    """Matchmaking settings"""
+    backend: str = 'database'
+    flush_interval: float = 1.0
+    tick_interval: float = 0.0
+    tick_window: int = 32
+    tick_limit: int = 5000
+    recent_size: int = 5
+    recent_capacity: int = 1000000
+    recent_ttl: int = 86400
+    sweep_interval: float = 60.0
+    max_wait: int = 3600
+
+    class Config:
+        env_prefix = 'MATCHMAKING_'
+
+
+class Archive(BaseConfig):
+    """Photo archive settings"""
+    directory: str = 'photo'
+    workers: int = 4
+    retries: int = 5
+    max_pending: int = 10000
+
+    class Config:
+        env_prefix = 'ARCHIVE_'
+
+
+class History(BaseConfig):
+    """Dialogue history settings"""
+    flush_interval: float = 0.5
+    batch_size: int = 500
+    max_pending: int = 50000
+
+    class Config:
+        env_prefix = 'HISTORY_'
+
+
 class Payments(BaseConfig):
     """Payments settings"""
     api_id: int
@@ -72,6 +161,13 @@ class Settings(BaseConfig):
     db: DB = DB()
     redis: Redis = Redis()
     payments: Payments = Payments()
+    webhook: Webhook = Webhook()
+    cache: Cache = Cache()
+    botstat: Botstat = Botstat()
+    profiler: Profiler = Profiler()
+    matchmaking: Matchmaking = Matchmaking()
+    archive: Archive = Archive()
+    history: History = History()
 
 
 @lru_cache
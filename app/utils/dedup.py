@@ -0,0 +1,123 @@
+"""Duplicate updates utils"""
+from collections import OrderedDict
+from typing import Optional
+
+from redis.asyncio import Redis
+
+from app.utils.metrics import Counter
+
+
+SEEN_UPDATES = Counter(
+    'webhook_seen_updates_total',
+    'Seen-set lookups, hit means a dropped redelivery', ('result',),
+)
+
+
+class SeenUpdates(object):
+    """
+    Bounded set of recently seen update ids.
+
+    Ids are kept in insertion order and the oldest one is evicted, so memory
+    is capped at ``size`` ids and lookups stay O(1). A forgotten id leaves
+    no trace, seen again it counts as new.
+    """
+
+    def __init__(self, size: int) -> None:
+        """
+        Initialize the SeenUpdates class
+
+        :param int size: Amount of remembered update ids
+        """
+
+        if size < 1:
+            raise ValueError('Seen update ids size must be at least 1')
+
+        self.size = size
+        self._ids: OrderedDict[int, None] = OrderedDict()
+
+    async def seen(self, update_id: int) -> bool:
+        """
+        Check an update id and remember it. Returns True for a duplicate.
+
+        :param int update_id: Telegram update id
+        :return bool: True if the update id was already seen
+        """
+
+        if update_id in self._ids:
+            SEEN_UPDATES.inc(result='hit')
+            return True
+
+        SEEN_UPDATES.inc(result='miss')
+        self._ids[update_id] = None
+        if len(self._ids) > self.size:
+            self._ids.popitem(last=False)
+        return False
+
+    async def forget(self, update_id: int) -> None:
+        """
+        Forget an update id, so a redelivery of it will be processed.
+
+        :param int update_id: Telegram update id
+        """
+
+        self._ids.pop(update_id, None)
+
+
+class RedisSeenUpdates(SeenUpdates):
+    """
+    Seen update ids stored in Redis with a TTL, shared between instances.
+    """
+
+    KEY = 'updates:seen:%i'
+
+    def __init__(self, redis: Redis, ttl: int) -> None:
+        """
+        Initialize the RedisSeenUpdates class
+
+        :param Redis redis: Redis client
+        :param int ttl: Time to remember an update id, in seconds
+        """
+
+        self.redis = redis
+        self.ttl = ttl
+
+    async def seen(self, update_id: int) -> bool:
+        """
+        Check an update id and remember it. Returns True for a duplicate.
+
+        :param int update_id: Telegram update id
+        :return bool: True if the update id was already seen
+        """
+
+        if await self.redis.set(self.KEY % update_id, 1, nx=True, ex=self.ttl):
+            SEEN_UPDATES.inc(result='miss')
+            return False
+
+        SEEN_UPDATES.inc(result='hit')
+        return True
+
+    async def forget(self, update_id: int) -> None:
+        """
+        Forget an update id, so a redelivery of it will be processed.
+
+        :param int update_id: Telegram update id
+        """
+
+        await self.redis.delete(self.KEY % update_id)
+
+
+def create_seen_updates(
+    size: int, ttl: int, redis: Optional[Redis] = None,
+) -> SeenUpdates:
+    """
+    Create a seen-set: Redis backed if a client is given, in-memory otherwise.
+
+    :param int size: Amount of remembered ids for the in-memory set
+    :param int ttl: Time to remember an id in Redis, in seconds
+    :param Optional[Redis] redis: Redis client
+    :return SeenUpdates: Seen-set instance
+    """
+
+    if redis is not None:
+        return RedisSeenUpdates(redis, ttl)
+    return SeenUpdates(size)
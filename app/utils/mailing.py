@@ -1,25 +1,39 @@
 """Mailing utils"""
+import json
 import time
+import uuid
 import asyncio
+import logging
 
 from typing import Optional
 from contextlib import suppress
 
 from aiogram import Bot
 from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter
+from redis.asyncio import Redis
+
+from app.utils.cluster import RELEASE_SCRIPT
+
+logger = logging.getLogger('mailing')
 
 
 class MailerSingleton(object):
     """Mailer singleton class"""
     DEFAULT_DELAY = 1/25
+    REGISTRY_KEY = 'mailing:active'
+    CHECKPOINT_KEY = 'mailing:checkpoint'
     __instance = None
 
-    def __init__(self, delay: int | float = None) -> None:
+    def __init__(
+        self, delay: int | float = None, redis: Optional[Redis] = None,
+    ) -> None:
         """
         Creator of MailerSingleton. Raises an exception if an instance already
         exists.
 
         :param int | float delay: Delay between messages, optional.
+        :param Optional[Redis] redis: Redis client to share the running
+        mailing between instances, optional.
         :raises Exception: If an instance already exists.
         """
 
@@ -27,6 +41,10 @@ class MailerSingleton(object):
             raise Exception('MailingSingleton is a singleton!')
 
         self.delay = delay or self.DEFAULT_DELAY
+        self.redis = redis
+        self.TIME_STARTED = 0
+        self.job: Optional[dict] = None
+        self.task: Optional[asyncio.Task] = None
         MailerSingleton.__instance = self
 
     @staticmethod
@@ -99,11 +117,24 @@ class MailerSingleton(object):
         """
 
         self.TIME_STARTED = time.monotonic()
+        self.task = asyncio.current_task()
+        self.job = job = {
+            'message_id': message_id,
+            'reply_markup': reply_markup,
+            'chat_id': chat_id,
+            'scope': scope,
+            'sent': 0,
+        }
 
         time_started = self.TIME_STARTED
         blocked = 0
         delay = self.delay
 
+        # Register the mailing, a newer one on any instance replaces it
+        token = uuid.uuid4().hex
+        if self.redis is not None:
+            await self.redis.set(self.REGISTRY_KEY, token)
+
         message = await bot.send_message(
             chat_id,
             self.get_text(scope, 1, delay),
@@ -117,6 +148,9 @@ class MailerSingleton(object):
 
             if time.monotonic() - self.last_update > 2:
                 self.last_update = time.monotonic()
+                if not await self._is_registered(token):
+                    break
+
                 with suppress(TelegramAPIError):
                     await message.edit_text(
                         self.get_text(
@@ -140,8 +174,17 @@ class MailerSingleton(object):
             except TelegramAPIError:
                 blocked += 1
 
+            job['sent'] = sent
             await asyncio.sleep(delay)
 
+        if self.job is not job:
+            return
+        self.job = None
+        self.task = None
+
+        if self.redis is not None:
+            await self.redis.eval(RELEASE_SCRIPT, 1, self.REGISTRY_KEY, token)
+
         with suppress(TelegramAPIError):
             await message.edit_text(
                 self.get_text(
@@ -155,25 +198,104 @@ class MailerSingleton(object):
             ),
         )
 
-    def stop_mailing(self) -> bool:
+    async def checkpoint(self) -> int:
         """
-        Stops mailing. Returns True on success.
+        Interrupt mailing before shutdown and save its progress to Redis,
+        so it can be resumed by resume_mailing.
 
-        :return bool: True on successful stop.
+        :return int: Amount of users left.
         """
 
-        if self.TIME_STARTED == 0:
-            return False
+        job, task = self.job, self.task
+        if job is None:
+            return 0
 
+        self.job = None
         self.TIME_STARTED = 0
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+
+        job['scope'] = job['scope'][job.pop('sent'):]
+        if self.redis is None:
+            logger.warning(
+                'Mailing interrupted, %i users left', len(job['scope']),
+            )
+        else:
+            await self.redis.delete(self.REGISTRY_KEY)
+            await self.redis.set(self.CHECKPOINT_KEY, json.dumps(job))
+            logger.info(
+                'Mailing checkpointed, %i users left', len(job['scope']),
+            )
+
+        return len(job['scope'])
+
+    async def resume_mailing(self, bot: Bot, cancel_keyboard: dict) -> bool:
+        """
+        Resume a checkpointed mailing. Returns True if one was resumed.
+
+        :param Bot bot: An instance of Bot.
+        :param dict cancel_keyboard: Cancel keyboard.
+        :return bool: True if a mailing was resumed.
+        """
+
+        if self.redis is None:
+            return False
+
+        job = await self.redis.getdel(self.CHECKPOINT_KEY)
+        if job is None:
+            return False
+
+        job = json.loads(job)
+        if not job['scope']:
+            return False
+
+        logger.info('Resuming mailing, %i users left', len(job['scope']))
+        asyncio.create_task(self.start_mailing(
+            job['message_id'], job['reply_markup'],
+            job['chat_id'], bot, job['scope'],
+            cancel_keyboard=cancel_keyboard,
+        ))
         return True
 
-    @property
-    def is_mailing(self) -> bool:
+    async def _is_registered(self, token: str) -> bool:
+        """
+        Check if the mailing is still the active one in the registry.
+
+        :param str token: Mailing token.
+        :return bool: True if the mailing was not stopped or replaced.
+        """
+
+        if self.redis is None:
+            return True
+
+        active = await self.redis.get(self.REGISTRY_KEY)
+        return active is not None and active.decode() == token
+
+    async def stop_mailing(self) -> bool:
         """
-        Check if mailing is in progress.
+        Stops mailing on any instance. Returns True on success.
+
+        :return bool: True on successful stop.
+        """
+
+        stopped = self.TIME_STARTED != 0
+        self.TIME_STARTED = 0
+
+        if self.redis is not None:
+            stopped = bool(await self.redis.delete(self.REGISTRY_KEY)) or stopped
+
+        return stopped
+
+    async def is_mailing(self) -> bool:
+        """
+        Check if mailing is in progress on any instance.
 
         :return bool: True if mailing is in progress.
         """
 
+        if self.redis is not None:
+            return bool(await self.redis.exists(self.REGISTRY_KEY))
+
         return self.TIME_STARTED != 0
@@ -0,0 +1,187 @@
+"""Metrics utils"""
+from bisect import bisect_left
+from typing import Callable, Iterable, Iterator, Optional
+
+
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+)
+
+
+class Metric(object):
+    """
+    Base metric rendered in Prometheus text format.
+
+    Label values are passed as keyword arguments matching ``labelnames``.
+    """
+
+    TYPE = 'untyped'
+    registry: list['Metric'] = []
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: tuple[str, ...] = (),
+    ) -> None:
+        """
+        Create and register a metric
+
+        :param str name: Metric name
+        :param str documentation: Help text
+        :param tuple[str, ...] labelnames: Label names
+        """
+
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: dict[tuple, object] = {}
+        if not labelnames and self.TYPE in ('counter', 'gauge'):
+            self._values[()] = 0
+        Metric.registry.append(self)
+
+    def _key(self, labels: dict[str, object]) -> tuple:
+        """Get label values tuple"""
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: tuple, extra: str = '') -> str:
+        """Render labels"""
+        pairs = [
+            '%s="%s"' % (name, value.replace('\\', '\\\\').replace('"', '\\"'))
+            for name, value in zip(self.labelnames, key)
+        ]
+        if extra:
+            pairs.append(extra)
+        return '{%s}' % ','.join(pairs) if pairs else ''
+
+    def samples(self) -> Iterator[str]:
+        """Method to be remapped in child classes."""
+        for key, value in self._values.items():
+            yield '%s%s %s' % (self.name, self._labels(key), value)
+
+    def render(self) -> str:
+        """Render metric with HELP and TYPE lines"""
+        return '\n'.join(
+            (
+                '# HELP %s %s' % (self.name, self.documentation),
+                '# TYPE %s %s' % (self.name, self.TYPE),
+                *self.samples(),
+            )
+        )
+
+
+class Counter(Metric):
+    """Monotonic counter"""
+    TYPE = 'counter'
+
+    def inc(self, amount: float = 1, **labels: object) -> None:
+        """Increase counter"""
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels: object) -> float:
+        """Get current value"""
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    """
+    Gauge, either set explicitly or read from a callback on render.
+    The callback returns a value, or a dict of label values tuple to value.
+    """
+    TYPE = 'gauge'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        callback: Optional[Callable[[], object]] = None,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def set(self, value: float, **labels: object) -> None:
+        """Set gauge value"""
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels: object) -> None:
+        """Increase gauge"""
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: object) -> None:
+        """Decrease gauge"""
+        self.inc(-amount, **labels)
+
+    def samples(self) -> Iterator[str]:
+        """Gauge samples"""
+        if self.callback is None:
+            yield from super().samples()
+            return
+
+        values = self.callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+
+        for key, value in values.items():
+            key = tuple(str(item) for item in key)
+            yield '%s%s %s' % (self.name, self._labels(key), value)
+
+
+class Histogram(Metric):
+    """Histogram with cumulative buckets"""
+    TYPE = 'histogram'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels: object) -> None:
+        """Observe a value"""
+        self.observe_many((value,), **labels)
+
+    def observe_many(self, values: Iterable[float], **labels: object) -> None:
+        """Observe several values with the same labels"""
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # Bucket counters + overflow bucket, then sum
+            state = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+
+        for value in values:
+            state[bisect_left(self.buckets, value)] += 1
+            state[-1] += value
+
+    def samples(self) -> Iterator[str]:
+        """Histogram samples"""
+        for key, state in self._values.items():
+            total = 0
+            for bound, count in zip(self.buckets, state):
+                total += count
+                yield '%s_bucket%s %i' % (
+                    self.name, self._labels(key, 'le="%s"' % bound), total,
+                )
+
+            total += state[-2]
+            yield '%s_bucket%s %i' % (
+                self.name, self._labels(key, 'le="+Inf"'), total,
+            )
+            yield '%s_sum%s %s' % (self.name, self._labels(key), state[-1])
+            yield '%s_count%s %i' % (self.name, self._labels(key), total)
+
+
+def render() -> str:
+    """
+    Render all registered metrics in Prometheus text format.
+
+    :return str: Exposition text
+    """
+
+    return '\n'.join(
+        metric.render()
+        for metric in Metric.registry
+    ) + '\n'
@@ -0,0 +1,332 @@
+"""Update processing profiler"""
+import time
+import heapq
+
+from itertools import count
+from collections import deque
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiogram.dispatcher.event.handler import CallableMixin
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app.utils.metrics import Counter, Gauge
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+STAGE_SECONDS = Gauge(
+    'profile_stage_seconds', 'Stage self time quantiles over the window',
+    ('stage', 'quantile'),
+)
+STAGE_CALLS = Counter(
+    'profile_stage_calls_total', 'Profiled stage calls', ('stage',),
+)
+STAGE_STATEMENTS = Counter(
+    'profile_stage_db_statements_total', 'SQL statements run by a stage',
+    ('stage',),
+)
+STAGE_REQUESTS = Counter(
+    'profile_stage_api_requests_total', 'Bot API requests made by a stage',
+    ('stage',),
+)
+
+
+class UpdateProfile(object):
+    """Stages of one update with their self time, SQL and Bot API counts"""
+    __slots__ = ('update_id', 'update_type', 'statements', 'requests', 'stages')
+
+    def __init__(self, update_id: int, update_type: str) -> None:
+        self.update_id = update_id
+        self.update_type = update_type
+        self.statements = 0
+        self.requests = 0
+        self.stages: list[tuple[str, float, int, int]] = []
+
+    def mark(self) -> list:
+        """Get the current time and counters"""
+        return [time.perf_counter(), self.statements, self.requests]
+
+    def spent(self, started: list) -> list:
+        """Get the time and counters spent since a mark"""
+        return [
+            time.perf_counter() - started[0],
+            self.statements - started[1],
+            self.requests - started[2],
+        ]
+
+    def record(self, name: str, started: list, inner: list = None) -> None:
+        """
+        Record a stage.
+
+        :param str name: Stage name
+        :param list started: Mark taken when the stage started
+        :param list inner: Spent by nested stages, excluded from self cost
+        """
+
+        seconds, statements, requests = self.spent(started)
+        if inner:
+            seconds -= inner[0]
+            statements -= inner[1]
+            requests -= inner[2]
+        self.stages.append((name, seconds, statements, requests))
+
+
+CURRENT: ContextVar[Optional[UpdateProfile]] = ContextVar(
+    'profile', default=None,
+)
+
+
+def count_statement(*_: Any) -> None:
+    """Count an SQL statement of the current update"""
+    profile = CURRENT.get()
+    if profile is not None:
+        profile.statements += 1
+
+
+async def count_request(make_request: Callable, bot: Bot, method: Any) -> Any:
+    """Count a Bot API request of the current update"""
+    profile = CURRENT.get()
+    if profile is not None:
+        profile.requests += 1
+    return await make_request(bot, method)
+
+
+class ProfiledMiddleware(object):
+    """Middleware wrapper recording its self cost"""
+
+    def __init__(self, name: str, middleware: Callable) -> None:
+        self.name = name
+        self.middleware = middleware
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any],
+    ) -> Any:
+        """Run the middleware, excluding the rest of the chain"""
+        profile = CURRENT.get()
+        if profile is None:
+            return await self.middleware(handler, event, data)
+
+        inner = [0.0, 0, 0]
+
+        async def timed(event: Any, data: Dict[str, Any]) -> Any:
+            started = profile.mark()
+            try:
+                return await handler(event, data)
+            finally:
+                for index, value in enumerate(profile.spent(started)):
+                    inner[index] += value
+
+        started = profile.mark()
+        try:
+            return await self.middleware(timed, event, data)
+        finally:
+            profile.record(self.name, started, inner)
+
+
+def profile_call(name: str, callable_: CallableMixin) -> None:
+    """
+    Record every call of a handler or a filter as a stage.
+
+    :param str name: Stage name
+    :param CallableMixin callable_: Aiogram handler or filter object
+    """
+
+    call = callable_.call
+
+    async def profiled(*args: Any, **kwargs: Any) -> Any:
+        profile = CURRENT.get()
+        if profile is None:
+            return await call(*args, **kwargs)
+
+        started = profile.mark()
+        try:
+            return await call(*args, **kwargs)
+        finally:
+            profile.record(name, started)
+
+    callable_.call = profiled
+
+
+def get_name(callback: Callable) -> str:
+    """Get a short callable name"""
+    if hasattr(callback, '__self__'):
+        callback = callback.__self__
+    return getattr(callback, '__name__', type(callback).__name__)
+
+
+class Profiler(object):
+    """
+    Opt-in profiler of middlewares, filters and handlers.
+
+    Self time of every stage is kept in a sliding window for quantiles, the
+    slowest updates are kept with their whole chain.
+    """
+
+    def __init__(self, window: int, top: int) -> None:
+        """
+        Initialize the Profiler class
+
+        :param int window: Amount of last calls kept per stage
+        :param int top: Amount of slowest chains kept
+        """
+
+        self.window = window
+        self.top = top
+        self.stages: dict[str, deque] = {}
+        self.totals: dict[str, list] = {}
+        self.chains: list[tuple] = []
+        self._order = count()
+        STAGE_SECONDS.callback = self.quantiles
+
+    def install(self, dp: Dispatcher, bot: Bot) -> None:
+        """
+        Wrap every registered middleware, filter and handler. Call after all
+        of them are registered.
+
+        :param Dispatcher dp: Dispatcher (root Router)
+        :param Bot bot: Bot whose API requests are counted
+        """
+
+        for router in dp.chain_tail:
+            for observer_name, observer in router.observers.items():
+                for manager in (observer.outer_middleware, observer.middleware):
+                    manager._middlewares[:] = [
+                        ProfiledMiddleware(
+                            '%s:%s' % (observer_name, get_name(middleware)),
+                            middleware,
+                        )
+                        for middleware in manager._middlewares
+                    ]
+
+                for handler in (observer._handler, *observer.handlers):
+                    for filter_ in handler.filters or ():
+                        profile_call(
+                            'filter:%s' % get_name(filter_.callback), filter_,
+                        )
+
+                for handler in observer.handlers:
+                    # The dispatcher's own update handler runs the whole chain
+                    if handler.callback == dp._listen_update:
+                        continue
+
+                    profile_call(
+                        'handler:%s.%s' % (
+                            handler.callback.__module__.rsplit('.', 1)[-1],
+                            get_name(handler.callback),
+                        ),
+                        handler,
+                    )
+
+        dp.update.outer_middleware._middlewares.insert(0, self.middleware)
+        event.listen(Engine, 'before_cursor_execute', count_statement)
+        bot.session.middleware(count_request)
+
+    async def middleware(
+        self,
+        handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        """Profile an update"""
+        profile = UpdateProfile(event.update_id, event.event_type)
+        token = CURRENT.set(profile)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            CURRENT.reset(token)
+            self.observe(profile, time.perf_counter() - started)
+
+    def observe(self, profile: UpdateProfile, seconds: float) -> None:
+        """
+        Aggregate a finished update.
+
+        :param UpdateProfile profile: Update profile
+        :param float seconds: Total processing time
+        """
+
+        for name, spent, statements, requests in profile.stages:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = deque(maxlen=self.window)
+                self.totals[name] = [0, 0, 0]
+
+            stage.append(spent)
+            totals = self.totals[name]
+            totals[0] += 1
+            totals[1] += statements
+            totals[2] += requests
+            STAGE_CALLS.inc(stage=name)
+            if statements:
+                STAGE_STATEMENTS.inc(statements, stage=name)
+            if requests:
+                STAGE_REQUESTS.inc(requests, stage=name)
+
+        chain = (seconds, next(self._order), profile)
+        if len(self.chains) < self.top:
+            heapq.heappush(self.chains, chain)
+        elif seconds > self.chains[0][0]:
+            heapq.heapreplace(self.chains, chain)
+
+    def percentiles(self, name: str) -> tuple[float, ...]:
+        """Get stage self time quantiles"""
+        values = sorted(self.stages[name])
+        return tuple(
+            values[min(int(quantile * len(values)), len(values) - 1)]
+            for quantile in QUANTILES
+        )
+
+    def quantiles(self) -> dict[tuple, float]:
+        """Gauge callback with quantiles of every stage"""
+        return {
+            (name, quantile): round(value, 6)
+            for name in self.stages
+            for quantile, value in zip(QUANTILES, self.percentiles(name))
+        }
+
+    def reset(self) -> None:
+        """Forget collected stages and chains"""
+        self.stages.clear()
+        self.totals.clear()
+        self.chains.clear()
+
+    def report(self, limit: int = 15) -> str:
+        """
+        Get a text report: slowest stages by p95 and slowest chains.
+
+        :param int limit: Amount of stages shown
+        :return str: Report
+        """
+
+        stages = sorted(
+            ((self.percentiles(name), name) for name in self.stages),
+            reverse=True,
+        )[:limit]
+
+        lines = ['stage: p50 / p95 / p99 ms, sql, api per call']
+        for (p50, p95, p99), name in stages:
+            calls, statements, requests = self.totals[name]
+            lines.append('%s: %.1f / %.1f / %.1f, %.2f, %.2f' % (
+                name, p50 * 1000, p95 * 1000, p99 * 1000,
+                statements / calls, requests / calls,
+            ))
+
+        lines.append('')
+        lines.append('slowest updates:')
+        for seconds, _, profile in sorted(self.chains, reverse=True):
+            lines.append('%.3fs %s #%i: %s' % (
+                seconds, profile.update_type, profile.update_id,
+                ' > '.join(
+                    '%s %.1fms' % (name, spent * 1000)
+                    for name, spent, _, _ in profile.stages
+                    if spent >= 0.0005
+                ),
+            ))
+
+        return '\n'.join(lines)
@@ -12,6 +12,7 @@ from sqlalchemy.future import select
 from sqlalchemy.ext.asyncio import async_sessionmaker
 
 from app.database.models import Request
+from app.utils.cluster import Cluster
 
 logger = logging.getLogger('joinrequest')
 
@@ -68,13 +69,16 @@ class JoinRequestChecker(object):
             )
 
 
-async def setup(bot: Bot, sessionmaker: async_sessionmaker) -> None:
+async def setup(
+    bot: Bot, sessionmaker: async_sessionmaker, cluster: Cluster,
+) -> None:
     """
-    Start polling the database for JoinRequests
+    Start polling the database for JoinRequests on the leader instance
 
     :param Bot bot: Aiogram bot instance
     :param async_sessionmaker sessionmaker: Async sessionmaker
+    :param Cluster cluster: Cluster of bot instances
     """
 
     joinrequest = JoinRequestChecker(bot, sessionmaker)
-    asyncio.create_task(joinrequest.checker())
+    cluster.run_as_leader('joinrequest', joinrequest.checker)
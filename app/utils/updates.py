@@ -0,0 +1,129 @@
+"""Updates utils"""
+import json
+from typing import Any, Callable
+
+from aiogram import types
+from aiogram.types.update import UpdateTypeLookupError
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+# Message sub-objects no handler reads. The fast path drops them before
+# validation, reply_to_message alone is a whole nested Message. Entities
+# must stay, html_text is built from them.
+UNUSED_MESSAGE_FIELDS = (
+    'reply_to_message',
+    'forward_from',
+    'forward_from_chat',
+    'via_bot',
+)
+MESSAGE_EVENTS = (
+    'message',
+    'edited_message',
+    'channel_post',
+    'edited_channel_post',
+)
+
+
+def get_loads(fast: bool) -> Callable[[bytes], Any]:
+    """
+    Get JSON decoder: orjson in the fast runtime if installed, json otherwise.
+
+    :param bool fast: Use the fast runtime
+    :return Callable[[bytes], Any]: loads function
+    """
+
+    if fast and orjson is not None:
+        return orjson.loads
+    return json.loads
+
+
+def get_update_type(update: dict[str, Any]) -> str:
+    """
+    Get update type from a raw update without parsing it.
+
+    :param dict[str, Any] update: Raw update
+    :return str: Update type, e.g. "message", or "unknown"
+    """
+
+    for key in update:
+        if key != 'update_id':
+            return key
+    return 'unknown'
+
+
+def get_event_type(update: types.Update) -> str:
+    """
+    Get event type of a parsed update.
+
+    :param types.Update update: Parsed update
+    :return str: Event type, e.g. "message", or "unknown"
+    """
+
+    try:
+        return update.event_type
+    except UpdateTypeLookupError:
+        return 'unknown'
+
+
+def _strip_message(message: dict[str, Any]) -> dict[str, Any]:
+    """Drop unused sub-objects of a raw message"""
+    return {
+        key: value
+        for key, value in message.items()
+        if key not in UNUSED_MESSAGE_FIELDS
+    }
+
+
+def parse_update(update: dict[str, Any]) -> types.Update:
+    """
+    Build an Update with full validation.
+
+    :param dict[str, Any] update: Raw update
+    :return types.Update: Update model
+    """
+
+    return types.Update(**update)
+
+
+def build_update(update: dict[str, Any]) -> types.Update:
+    """
+    Build an Update validating only the event it carries, without the
+    sub-objects handlers never read.
+
+    :param dict[str, Any] update: Raw update
+    :return types.Update: Update model
+    """
+
+    update_type = get_update_type(update)
+    field = types.Update.__fields__.get(update_type)
+    if field is None:
+        return types.Update(**update)
+
+    event = update[update_type]
+    if update_type in MESSAGE_EVENTS:
+        event = _strip_message(event)
+
+    elif update_type == 'callback_query' and 'message' in event:
+        event = {**event, 'message': _strip_message(event['message'])}
+
+    return types.Update.construct(
+        update_id=update['update_id'],
+        **{update_type: field.type_.parse_obj(event)},
+    )
+
+
+def get_builder(fast: bool) -> Callable[[dict[str, Any]], types.Update]:
+    """
+    Get Update builder: partial validation in the fast runtime, full otherwise.
+
+    :param bool fast: Use the fast runtime
+    :return Callable[[dict[str, Any]], types.Update]: Builder function
+    """
+
+    if fast:
+        return build_update
+    return parse_update
@@ -0,0 +1,323 @@
+"""Update workers utils"""
+import time
+import asyncio
+import logging
+
+from itertools import count
+from collections import deque
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+from aiogram import types
+from aiogram.dispatcher.middlewares.user_context import UserContextMiddleware
+
+from app.utils.metrics import Counter, Gauge, Histogram
+
+logger = logging.getLogger('workers')
+
+QUEUE_DEPTH = Gauge(
+    'webhook_queue_depth', 'Updates waiting for a worker',
+)
+QUEUE_IN_FLIGHT = Gauge(
+    'webhook_queue_in_flight', 'Updates being processed by workers',
+)
+QUEUE_WAIT = Histogram(
+    'webhook_queue_wait_seconds', 'Time an update waits for a worker',
+)
+WORKER_UTILISATION = Gauge(
+    'webhook_worker_utilisation', 'Share of time a worker is busy',
+    ('worker',),
+)
+LOOP_LAG = Gauge(
+    'event_loop_lag_seconds', 'Event loop scheduling delay',
+)
+SHED_UPDATES = Counter(
+    'webhook_shed_updates_total', 'Low priority updates dropped on overload',
+    ('update_type',),
+)
+
+# Update priorities, lower goes first
+PRIORITY_HIGH = 0
+PRIORITY_DIALOGUE = 1
+PRIORITY_LOW = 2
+
+
+def get_priority(update: types.Update) -> int:
+    """
+    Get the priority of an update.
+
+    Payments and callback queries go first, private messages (dialogue
+    traffic) next, everything else last.
+
+    :param types.Update update: Parsed update
+    :return int: Priority, lower goes first
+    """
+
+    if update.pre_checkout_query or update.callback_query:
+        return PRIORITY_HIGH
+
+    if update.message:
+        if update.message.successful_payment:
+            return PRIORITY_HIGH
+        # Whether the sender is in a dialogue is known only to the user
+        # cache or the database, a lookup per update (a Redis round trip or
+        # a query) before admission costs more than shedding saves. So any
+        # private message counts as dialogue traffic and is never shed: a
+        # dropped menu press is tapped again, a dropped dialogue message is
+        # lost without the partner knowing.
+        if update.message.chat.type == 'private':
+            return PRIORITY_DIALOGUE
+
+    return PRIORITY_LOW
+
+
+def get_chat_key(update: types.Update) -> int:
+    """
+    Get the ordering key of an update: chat id, user id or update id.
+
+    :param types.Update update: Parsed update
+    :return int: Key of the lane the update belongs to
+    """
+
+    chat, user = UserContextMiddleware.resolve_event_context(update)
+    if chat:
+        return chat.id
+    if user:
+        return user.id
+    return update.update_id
+
+
+class UpdateWorkerPool(object):
+    """
+    Pool of asyncio workers draining webhook updates.
+
+    Updates are kept in per-chat lanes. A lane is taken by one worker at a
+    time, so updates of the same chat run in order, while different chats
+    are processed concurrently. Ready lanes are served by the priority of
+    their next update.
+    """
+
+    def __init__(
+        self,
+        callback: Callable[[Any], Awaitable[Any]],
+        workers: int,
+        max_pending: int,
+    ) -> None:
+        """
+        Initialize the UpdateWorkerPool class
+
+        :param Callable callback: Coroutine function processing one update
+        :param int workers: Amount of workers
+        :param int max_pending: Maximum amount of queued updates
+        """
+
+        self.callback = callback
+        self.workers = workers
+        self.max_pending = max_pending
+
+        self._lanes: dict[Hashable, deque] = {}
+        self._ready: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        self._order = count()
+        self._tasks: list[asyncio.Task] = []
+
+        self.depth = 0
+        self.in_flight = 0
+        self.busy = [0.0] * workers
+        self.started = time.monotonic()
+
+    def start(self) -> None:
+        """Start workers"""
+        self.started = time.monotonic()
+        self._tasks = [
+            asyncio.create_task(self.worker(index))
+            for index in range(self.workers)
+        ]
+        logger.info('Started %i update workers', self.workers)
+
+    def put(
+        self, key: Hashable, item: Any, priority: int = PRIORITY_LOW,
+    ) -> bool:
+        """
+        Enqueue an update. Returns False if the queue is full.
+
+        :param Hashable key: Lane key, see get_chat_key
+        :param Any item: Update to process
+        :param int priority: Update priority, see get_priority
+        :return bool: True if the update was enqueued
+        """
+
+        if self.depth >= self.max_pending:
+            return False
+
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = self._lanes[key] = deque()
+            self._ready.put_nowait((priority, next(self._order), key))
+
+        lane.append((time.monotonic(), priority, item))
+        self.depth += 1
+        QUEUE_DEPTH.set(self.depth)
+        return True
+
+    async def worker(self, index: int) -> None:
+        """Drain lanes until cancelled"""
+        while True:
+            _, _, key = await self._ready.get()
+            lane = self._lanes[key]
+            enqueued, _, item = lane.popleft()
+            self.depth -= 1
+            self.in_flight += 1
+            QUEUE_DEPTH.set(self.depth)
+            QUEUE_IN_FLIGHT.set(self.in_flight)
+
+            started = time.monotonic()
+            QUEUE_WAIT.observe(started - enqueued)
+
+            try:
+                await self.callback(item)
+            except Exception:
+                logger.exception('Update worker %i failed', index)
+            finally:
+                finished = time.monotonic()
+                self.in_flight -= 1
+                self.busy[index] += finished - started
+                QUEUE_IN_FLIGHT.set(self.in_flight)
+                WORKER_UTILISATION.set(
+                    round(self.busy[index] / (finished - self.started), 4),
+                    worker=index,
+                )
+
+                if lane:
+                    self._ready.put_nowait((lane[0][1], next(self._order), key))
+                else:
+                    del self._lanes[key]
+
+    async def drain(self, timeout: float) -> int:
+        """
+        Wait for queued and in-flight updates, then stop workers.
+
+        :param float timeout: Deadline, in seconds
+        :return int: Amount of updates abandoned at the deadline
+        """
+
+        deadline = time.monotonic() + timeout
+        while (self.depth or self.in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+        abandoned = self.depth + self.in_flight
+        await self.close()
+        return abandoned
+
+    async def close(self) -> None:
+        """Stop workers"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+class LagMonitor(object):
+    """
+    Event loop lag probe: measures how late a periodic sleep wakes up.
+    """
+
+    def __init__(self, interval: float = 0.5) -> None:
+        """
+        Initialize the LagMonitor class
+
+        :param float interval: Probe interval, in seconds
+        """
+
+        self.interval = interval
+        self.lag = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        """Start probing"""
+        self._task = asyncio.create_task(self.probe())
+
+    async def probe(self) -> None:
+        """Measure lag until cancelled"""
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.lag = max(time.monotonic() - started - self.interval, 0)
+            LOOP_LAG.set(round(self.lag, 4))
+
+    async def close(self) -> None:
+        """Stop probing"""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+class LoadShedder(object):
+    """
+    Admission control in front of the dispatcher. Low priority updates are
+    dropped while the queue is deep or the event loop lags.
+    """
+
+    def __init__(
+        self,
+        pool: Optional[UpdateWorkerPool],
+        monitor: LagMonitor,
+        max_depth: int,
+        max_lag: float,
+    ) -> None:
+        """
+        Initialize the LoadShedder class
+
+        :param Optional[UpdateWorkerPool] pool: Worker pool, None if inline
+        :param LagMonitor monitor: Event loop lag monitor
+        :param int max_depth: Queue depth to start shedding at, 0 disables
+        :param float max_lag: Loop lag to start shedding at, 0 disables
+        """
+
+        self.pool = pool
+        self.monitor = monitor
+        self.max_depth = max_depth
+        self.max_lag = max_lag
+
+    @property
+    def is_overloaded(self) -> bool:
+        """True if a threshold is crossed"""
+        if self.max_depth and self.pool and self.pool.depth >= self.max_depth:
+            return True
+        return bool(self.max_lag) and self.monitor.lag >= self.max_lag
+
+    def admit(self, update_type: str, priority: int) -> bool:
+        """
+        Check if an update should be processed, count it if shed.
+
+        :param str update_type: Update type, for metrics
+        :param int priority: Update priority, see get_priority
+        :return bool: False if the update is shed
+        """
+
+        if priority < PRIORITY_LOW or not self.is_overloaded:
+            return True
+
+        SHED_UPDATES.inc(update_type=update_type)
+        return False
+
+
+def create_pool(
+    callback: Callable[[Any], Awaitable[Any]],
+    workers: int,
+    max_pending: int,
+) -> Optional[UpdateWorkerPool]:
+    """
+    Create and start a worker pool, or return None for inline processing.
+
+    :param Callable callback: Coroutine function processing one update
+    :param int workers: Amount of workers, 0 disables the pool
+    :param int max_pending: Maximum amount of queued updates
+    :return Optional[UpdateWorkerPool]: Started pool or None
+    """
+
+    if workers <= 0:
+        return None
+
+    pool = UpdateWorkerPool(callback, workers, max_pending)
+    pool.start()
+    return pool
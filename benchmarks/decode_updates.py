@@ -0,0 +1,59 @@
+"""
+Benchmark of webhook update decoding: json + full validation against
+orjson + the fast builder, over recorded update payloads.
+
+Run from the project root with the bot's .env present:
+
+    python benchmarks/decode_updates.py [rounds]
+"""
+import sys
+import json
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app.utils import updates  # noqa: E402
+
+
+PAYLOADS = Path(__file__).parent / 'payloads' / 'updates.json'
+
+
+def run(loads, build, bodies: list[bytes], rounds: int) -> float:
+    """Decode all bodies ``rounds`` times, return updates per second"""
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for body in bodies:
+            build(loads(body))
+    return rounds * len(bodies) / (time.perf_counter() - started)
+
+
+def main() -> None:
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    bodies = [
+        json.dumps(update).encode()
+        for update in json.loads(PAYLOADS.read_text())
+    ]
+
+    # Both paths must produce the same events for handlers
+    for body in bodies:
+        full = updates.parse_update(json.loads(body))
+        fast = updates.build_update(updates.get_loads(True)(body))
+        assert full.event_type == fast.event_type
+        assert full.update_id == fast.update_id
+
+    current = run(
+        updates.get_loads(False), updates.get_builder(False), bodies, rounds,
+    )
+    fast = run(
+        updates.get_loads(True), updates.get_builder(True), bodies, rounds,
+    )
+
+    print('payloads: %i, rounds: %i' % (len(bodies), rounds))
+    print('current  (json + Update(**)): %10.0f updates/s' % current)
+    print('fast (orjson + build_update): %10.0f updates/s' % fast)
+    print('speedup: x%.2f' % (fast / current))
+
+
+if __name__ == '__main__':
+    main()
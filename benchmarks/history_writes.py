@@ -0,0 +1,143 @@
+"""
+Benchmark of dialogue history writes: a commit per relayed message, as
+forward_message used to do, against the HistoryWriter buffer. Messages are
+written by concurrent tasks, the buffer is timed until its last flush.
+
+Needs the bot's Postgres (DB_* settings in .env). Test users get ids far
+above Telegram ids, they and their history are removed afterwards.
+
+Run from the project root:
+
+    python benchmarks/history_writes.py [messages] [concurrency]
+"""
+import sys
+import time
+import asyncio
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sqlalchemy import delete, func  # noqa: E402
+from sqlalchemy.future import select  # noqa: E402
+from sqlalchemy.ext.asyncio import async_sessionmaker  # noqa: E402
+
+from app.database import create_sessionmaker  # noqa: E402
+from app.database.history import HistoryWriter  # noqa: E402
+from app.database.models import User, DialogueHistory  # noqa: E402
+from app.utils.config import DB  # noqa: E402
+
+
+FIRST_ID = 10 ** 15
+DIALOGUE_ID = -1
+
+
+async def commit_each(
+    sessionmaker: async_sessionmaker, semaphore: asyncio.Semaphore,
+    index: int,
+) -> None:
+    """Write a message in its own transaction"""
+    async with semaphore, sessionmaker() as session:
+        session.add(
+            DialogueHistory(
+                dialogue_id=DIALOGUE_ID,
+                first=FIRST_ID + index % 2,
+                second=FIRST_ID + (index + 1) % 2,
+                message='message %i' % index,
+            )
+        )
+        await session.commit()
+
+
+async def buffer(
+    writer: HistoryWriter, semaphore: asyncio.Semaphore, index: int,
+) -> None:
+    """Hand a message to the writer, like forward_message does"""
+    async with semaphore:
+        writer.add(
+            dialogue_id=DIALOGUE_ID,
+            first=FIRST_ID + index % 2,
+            second=FIRST_ID + (index + 1) % 2,
+            message='message %i' % index,
+        )
+        # Let other handlers run, as between updates
+        await asyncio.sleep(0)
+
+
+async def count_rows(sessionmaker: async_sessionmaker) -> int:
+    """Count test history rows"""
+    async with sessionmaker() as session:
+        return await session.scalar(
+            select(func.count())
+            .select_from(DialogueHistory)
+            .where(DialogueHistory.dialogue_id == DIALOGUE_ID)
+        )
+
+
+async def cleanup(sessionmaker: async_sessionmaker) -> None:
+    """Remove test users and their history"""
+    async with sessionmaker() as session:
+        await session.execute(
+            delete(DialogueHistory)
+            .where(DialogueHistory.dialogue_id == DIALOGUE_ID)
+        )
+        await session.execute(
+            delete(User)
+            .where(User.id.in_((FIRST_ID, FIRST_ID + 1)))
+        )
+        await session.commit()
+
+
+async def main() -> None:
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    sessionmaker = await create_sessionmaker(DB())
+    semaphore = asyncio.Semaphore(concurrency)
+
+    await cleanup(sessionmaker)
+    async with sessionmaker() as session:
+        session.add_all((User(id=FIRST_ID), User(id=FIRST_ID + 1)))
+        await session.commit()
+
+    try:
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            commit_each(sessionmaker, semaphore, index)
+            for index in range(messages)
+        ))
+        commit_time = time.perf_counter() - started
+        committed = await count_rows(sessionmaker)
+
+        await cleanup(sessionmaker)
+        async with sessionmaker() as session:
+            session.add_all((User(id=FIRST_ID), User(id=FIRST_ID + 1)))
+            await session.commit()
+
+        writer = HistoryWriter(sessionmaker)
+        writer.start()
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            buffer(writer, semaphore, index) for index in range(messages)
+        ))
+        await writer.close()
+        buffer_time = time.perf_counter() - started
+        buffered = await count_rows(sessionmaker)
+
+    finally:
+        await cleanup(sessionmaker)
+        await sessionmaker.kw['bind'].dispose()
+
+    print('messages: %i, concurrency: %i' % (messages, concurrency))
+    print('commit per message: %.0f rows/s (%.2fs)' % (
+        messages / commit_time, commit_time,
+    ))
+    print('write-behind buffer: %.0f rows/s (%.2fs), %.1fx' % (
+        messages / buffer_time, buffer_time, commit_time / buffer_time,
+    ))
+
+    assert committed == messages, 'rows lost committing one by one'
+    assert buffered == messages, 'rows lost by the buffer'
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,160 @@
+"""
+Concurrency stress test of the database search queue: many users search at
+once, then every user must be in at most one dialogue and nobody in a
+dialogue may still be waiting.
+
+Needs the bot's Postgres (DB_* settings in .env). Test users get ids far
+above Telegram ids and are removed afterwards.
+
+tests/test_matchmaking.py runs a smaller race against every backend, the
+database one only when Postgres is reachable.
+
+Run from the project root:
+
+    python benchmarks/matchmaking_race.py [users] [rounds] [concurrency]
+"""
+import sys
+import time
+import random
+import asyncio
+from collections import Counter
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sqlalchemy import delete, or_  # noqa: E402
+from sqlalchemy.future import select  # noqa: E402
+from sqlalchemy.ext.asyncio import async_sessionmaker  # noqa: E402
+
+from app.database import create_sessionmaker  # noqa: E402
+from app.database.models import User, Dialogue, Queue  # noqa: E402
+from app.handlers.user.dialogue import open_dialogue  # noqa: E402
+from app.matchmaking import (  # noqa: E402
+    AlreadyPaired, DatabaseMatchmaker, RecentPartners,
+)
+from app.utils.config import DB  # noqa: E402
+
+
+FIRST_ID = 10 ** 15
+
+
+async def search(
+    sessionmaker: async_sessionmaker, matchmaker: DatabaseMatchmaker,
+    semaphore: asyncio.Semaphore, user_id: int,
+) -> bool:
+    """Search like the queue handler, return True on a match"""
+    async with semaphore, sessionmaker() as session:
+        user = await session.get(User, user_id)
+        try:
+            partner_id = await matchmaker.search(
+                session, user, random.choice((None, True, False)), False,
+            )
+        except AlreadyPaired:
+            return False
+
+        if partner_id is None:
+            return False
+
+        await open_dialogue(session, matchmaker, user_id, partner_id)
+        return True
+
+
+async def cleanup(sessionmaker: async_sessionmaker, ids: list[int]) -> None:
+    """Remove test users"""
+    async with sessionmaker() as session:
+        await session.execute(
+            delete(Dialogue)
+            .where(or_(Dialogue.first.in_(ids), Dialogue.second.in_(ids)))
+        )
+        await session.execute(delete(Queue).where(Queue.id.in_(ids)))
+        await session.execute(delete(User).where(User.id.in_(ids)))
+        await session.commit()
+
+
+async def main() -> None:
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+
+    sessionmaker = await create_sessionmaker(DB())
+    matchmaker = DatabaseMatchmaker(RecentPartners())
+    semaphore = asyncio.Semaphore(concurrency)
+    ids = list(range(FIRST_ID, FIRST_ID + users))
+
+    await cleanup(sessionmaker, ids)
+    async with sessionmaker() as session:
+        session.add_all(
+            User(id=user_id, is_man=bool(user_id % 2)) for user_id in ids
+        )
+        await session.commit()
+
+    matches = 0
+    started = time.perf_counter()
+    try:
+        for _ in range(rounds):
+            # Everybody not in a dialogue yet searches again, all at once
+            async with sessionmaker() as session:
+                paired = set(await session.scalars(
+                    select(Dialogue.first).where(Dialogue.first.in_(ids))
+                    .union_all(
+                        select(Dialogue.second)
+                        .where(Dialogue.second.in_(ids))
+                    )
+                ))
+
+            searching = [user_id for user_id in ids if user_id not in paired]
+            random.shuffle(searching)
+            results = await asyncio.gather(*(
+                search(sessionmaker, matchmaker, semaphore, user_id)
+                for user_id in searching
+            ))
+            matches += sum(results)
+
+        elapsed = time.perf_counter() - started
+
+        async with sessionmaker() as session:
+            dialogues = (await session.execute(
+                select(Dialogue.first, Dialogue.second)
+                .where(Dialogue.first.in_(ids))
+            )).all()
+            waiting = set(await session.scalars(
+                select(Queue.id).where(Queue.id.in_(ids))
+            ))
+            partners = dict((await session.execute(
+                select(User.id, User.partner_id)
+                .where(User.id.in_(ids), User.partner_id != None)
+            )).all())
+
+    finally:
+        await cleanup(sessionmaker, ids)
+        await sessionmaker.kw['bind'].dispose()
+
+    members = Counter(
+        user_id for dialogue in dialogues for user_id in dialogue
+    )
+    doubled = [user_id for user_id, count in members.items() if count > 1]
+    stale = waiting & set(members)
+    expected = {
+        **{first: second for first, second in dialogues},
+        **{second: first for first, second in dialogues},
+    }
+    mismatched = set(expected.items()) ^ set(partners.items())
+
+    print('users: %i, rounds: %i, concurrency: %i' % (
+        users, rounds, concurrency,
+    ))
+    print('matches: %i (%.1f/s), dialogues: %i, waiting: %i' % (
+        matches, matches / elapsed, len(dialogues), len(waiting),
+    ))
+    print('users in several dialogues: %i' % len(doubled))
+    print('users in a dialogue and the queue: %i' % len(stale))
+    print('partner ids out of sync: %i' % len(mismatched))
+
+    assert matches == len(dialogues), 'reported and stored matches differ'
+    assert not doubled, 'users paired twice: %s' % doubled[:10]
+    assert not stale, 'paired users still waiting: %s' % sorted(stale)[:10]
+    assert not mismatched, 'partner ids differ from dialogues'
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,106 @@
+"""
+Benchmark of the Redis search queue: concurrent searches of random users
+through the search script, then every user must be in at most one pair and
+nobody paired may still be waiting.
+
+Runs against fakeredis (pip install "fakeredis[lua]") unless a Redis URL is
+given, a real Redis is much faster. The queue keys are removed afterwards.
+
+Run from the project root (no database needed):
+
+    python benchmarks/matchmaking_redis.py [users] [concurrency] [redis url]
+"""
+import sys
+import time
+import random
+import asyncio
+from collections import Counter
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from redis.asyncio import Redis  # noqa: E402
+
+from app.matchmaking import (  # noqa: E402
+    AlreadyPaired, RecentPartners, RedisMatchmaker,
+)
+from app.matchmaking.base import get_bucket, get_partner_buckets  # noqa: E402
+
+
+FIRST_ID = 10 ** 15
+
+
+async def search(
+    matchmaker: RedisMatchmaker, semaphore: asyncio.Semaphore, user_id: int,
+) -> tuple[int, int]:
+    """Search with random preferences, return the pair or (user id, 0)"""
+    is_adult = random.random() < 0.2
+    is_man = random.random() < 0.6
+    target_man = random.choice((None, None, True, False))
+    async with semaphore:
+        try:
+            partner_id = await matchmaker.pop_or_enqueue(
+                user_id,
+                get_bucket(is_adult, is_man, target_man),
+                get_partner_buckets(is_adult, is_man, target_man),
+            )
+        except AlreadyPaired:
+            return user_id, 0
+
+    if partner_id is None:
+        return user_id, 0
+
+    await matchmaker.paired(user_id, partner_id)
+    return user_id, partner_id
+
+
+async def main() -> None:
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    if len(sys.argv) > 3:
+        redis = Redis.from_url(sys.argv[3])
+    else:
+        from fakeredis.aioredis import FakeRedis
+        redis = FakeRedis()
+
+    random.seed(users)
+    matchmaker = RedisMatchmaker(RecentPartners(), redis)
+    semaphore = asyncio.Semaphore(concurrency)
+    ids = list(range(FIRST_ID, FIRST_ID + users))
+    await redis.delete(*matchmaker.keys)
+
+    try:
+        started = time.perf_counter()
+        results = await asyncio.gather(*(
+            search(matchmaker, semaphore, user_id) for user_id in ids
+        ))
+        elapsed = time.perf_counter() - started
+        waiting = set(map(int, await redis.hkeys(matchmaker.users_key)))
+    finally:
+        await redis.delete(*matchmaker.keys)
+        await redis.close()
+
+    pairs = [pair for pair in results if pair[1]]
+    members = Counter(user_id for pair in pairs for user_id in pair)
+    doubled = [user_id for user_id, count in members.items() if count > 1]
+    stale = waiting & set(members)
+
+    print('users: %i, concurrency: %i, %s' % (
+        users, concurrency, 'redis' if len(sys.argv) > 3 else 'fakeredis',
+    ))
+    print('searches: %.0f/s, %.3f ms each' % (
+        users / elapsed, elapsed / users * 1000,
+    ))
+    print('matches: %i (%.0f/s), waiting: %i' % (
+        len(pairs), len(pairs) / elapsed, len(waiting),
+    ))
+    print('users in several pairs: %i' % len(doubled))
+    print('users paired and waiting: %i' % len(stale))
+
+    assert len(waiting) + 2 * len(pairs) == users, 'users lost'
+    assert not doubled, 'users paired twice: %s' % doubled[:10]
+    assert not stale, 'paired users still waiting: %s' % sorted(stale)[:10]
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,98 @@
+"""
+Benchmark of the batch matching tick of the in-memory search queue: pairs
+made and time spent per tick against the amount of waiting users, and the
+longest stretch the tick kept the event loop busy between yields.
+
+Run from the project root (no database needed):
+
+    python benchmarks/matchmaking_tick.py [window] [limit]
+"""
+import sys
+import time
+import random
+import asyncio
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app.matchmaking import MemoryMatchmaker, RecentPartners  # noqa: E402
+from app.matchmaking.memory import Ticket  # noqa: E402
+
+
+SIZES = (1000, 10000, 50000, 100000)
+
+
+def fill(matchmaker: MemoryMatchmaker, size: int) -> None:
+    """Enqueue random users, a tenth of them without an age"""
+    now = time.monotonic()
+    for user_id in range(size):
+        matchmaker._enqueue(Ticket(
+            user_id,
+            (
+                random.random() < 0.2,
+                random.random() < 0.6,
+                random.choice((None, None, True, False)),
+            ),
+            now,
+            None if random.random() < 0.1 else random.randint(16, 45),
+        ))
+        # Some users were just paired with each other
+        if user_id % 10 == 1:
+            matchmaker.recent.remember(user_id, user_id - 1)
+
+
+async def longest_block(task: asyncio.Task) -> float:
+    """Longest gap between turns of the event loop while a task runs"""
+    longest = 0.0
+    last = time.perf_counter()
+    while not task.done():
+        await asyncio.sleep(0)
+        now = time.perf_counter()
+        longest = max(longest, now - last)
+        last = now
+    return longest
+
+
+async def main() -> None:
+    window = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    limit = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+
+    print('window: %i, limit: %i' % (window, limit))
+    print(
+        'waiting    pairs/tick    ms/tick    max ms blocked    age gap    '
+        'recent pairs'
+    )
+    for size in SIZES:
+        random.seed(size)
+        matchmaker = MemoryMatchmaker(
+            RecentPartners(), None, 1, 0.25, window, limit,
+        )
+        fill(matchmaker, size)
+        ages = {
+            ticket.user_id: ticket.age
+            for ticket in matchmaker.tickets.values()
+        }
+
+        started = time.perf_counter()
+        task = asyncio.create_task(matchmaker.tick())
+        blocked = await longest_block(task)
+        pairs = await task
+        elapsed = time.perf_counter() - started
+
+        gaps = [
+            abs(ages[first] - ages[second])
+            for first, second in pairs
+            if ages[first] is not None and ages[second] is not None
+        ]
+        repeated = sum(
+            matchmaker.recent.is_recent(first, second)
+            for first, second in pairs
+        )
+        print('%7i    %10i    %7.1f    %14.1f    %7.2f    %12i' % (
+            size, len(pairs), elapsed * 1000, blocked * 1000,
+            sum(gaps) / len(gaps) if gaps else 0, repeated,
+        ))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,72 @@
+"""
+Benchmark of the recent partners rings: memory per user and the cost of
+recording a pair and checking a candidate, for 1M users by default.
+
+Run from the project root (no database or Redis needed):
+
+    python benchmarks/recent_partners.py [users] [size]
+"""
+import sys
+import time
+import random
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app.matchmaking import RecentPartners  # noqa: E402
+
+
+# Telegram ids do not fit small ints
+FIRST_ID = 5 * 10 ** 9
+
+
+def fill(recent: RecentPartners, ids: list[int], size: int) -> int:
+    """Give every user a full ring, return the amount of pairs recorded"""
+    pairs, users = 0, len(ids)
+    for round_ in range(1, size + 1):
+        for index in range(0, users, 2):
+            recent.remember(ids[index], ids[(index + 2 * round_ + 1) % users])
+            pairs += 1
+    return pairs
+
+
+def main() -> None:
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    ids = list(range(FIRST_ID, FIRST_ID + users))
+
+    recent = RecentPartners(size, users)
+    started = time.perf_counter()
+    pairs = fill(recent, ids, size)
+    elapsed = time.perf_counter() - started
+
+    # Measured apart, tracing slows allocations down
+    tracemalloc.start()
+    traced = RecentPartners(size, users)
+    fill(traced, ids, size)
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del traced
+
+    random.seed(users)
+    checks = [
+        (random.choice(ids), random.choice(ids)) for _ in range(100000)
+    ]
+    started = time.perf_counter()
+    for user_id, partner_id in checks:
+        recent.is_recent(user_id, partner_id)
+    check_time = time.perf_counter() - started
+
+    print('users: %i, ring size: %i' % (users, size))
+    print('memory: %.1f MB, %.0f bytes per user' % (
+        memory / 2 ** 20, memory / users,
+    ))
+    print('remember: %.2f us per pair' % (elapsed / pairs * 10 ** 6))
+    print('is_recent: %.2f us per check' % (
+        check_time / len(checks) * 10 ** 6
+    ))
+
+
+if __name__ == '__main__':
+    main()
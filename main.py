@@ -2,10 +2,10 @@
 import os
 import sys
 import time
-import signal
+import random
 import logging
 import asyncio
-from datetime import datetime
+from functools import partial
 
 from aiogram import Bot, Dispatcher, types
 from aiogram.fsm.storage.memory import MemoryStorage
@@ -16,7 +16,18 @@ from fastapi.responses import JSONResponse
 
 from app import middlewares, handlers
 from app.database import create_sessionmaker
-from app.utils import set_commands, load_config, schedule, payments
+from app.database.cache import UserCache, SponsorCache
+from app.database.history import HistoryWriter
+from app.matchmaking import QueueSweeper, create_matchmaker
+from app.handlers.user import dialogue
+from app.utils import set_commands, load_config, schedule, payments, workers, dedup, updates, metrics, cache, archive
+from app.utils.cluster import Cluster
+from app.utils.mailing import MailerSingleton
+from app.utils.profiler import Profiler
+from app.templates.keyboards import admin as admin_nav
+from app.middlewares.metrics import (
+    UpdateTimings, PARSE_SECONDS, PROCESS_SECONDS, MIDDLEWARE_SECONDS,
+)
 
 # Logger setup
 logging.basicConfig(
@@ -32,25 +43,112 @@ bot = None
 dp = None
 sessionmaker = None
 payment = None
+cluster = None
+matchmaker = None
+archiver = None
+history = None
+pool = None
+lag_monitor = None
+shedder = None
+seen_updates = None
+loads = updates.get_loads(False)
+build_update = updates.get_builder(False)
+log_sample_rate = 0.0
+slow_threshold = 5.0
+drain_timeout = 8.0
+inline_updates = 0
 is_ready = False
 
+DRAIN_SECONDS = metrics.Gauge(
+    'shutdown_drain_seconds', 'Duration of the last shutdown drain',
+)
+ABANDONED = metrics.Gauge(
+    'shutdown_abandoned', 'Updates and tasks left unfinished by the drain',
+    ('kind',),
+)
+
+def split_drain_timeout(timeout: float) -> tuple[int, float]:
+    """
+    Split the shutdown deadline: uvicorn first waits for open requests,
+    then cleanup drains queued updates with the rest.
+
+    :param float timeout: Whole drain deadline, in seconds
+    :return tuple[int, float]: Request grace period and update drain time
+    """
+
+    grace = int(timeout / 2)
+    return grace, timeout - grace
+
 async def cleanup():
-    """Cleanup function to close all sessions and connections"""
-    global bot, dp, is_ready
+    """
+    Drain updates and jobs, then close all sessions and connections. Runs
+    after uvicorn stopped accepting requests and waited for open ones, so
+    Telegram retries new updates elsewhere or after the restart, and only
+    updates already queued are left to process.
+    """
+    global bot, dp, pool, lag_monitor, cluster, matchmaker, archiver, history
+    global is_ready
     is_ready = False
+    drain_start = time.monotonic()
     
-    logger.info("Starting cleanup...")
+    logger.info("Draining updates...")
+
+    # Wait for in-flight updates up to the deadline
+    abandoned = 0
+    if pool:
+        abandoned += await pool.drain(drain_timeout)
+        pool = None
+
+    deadline = drain_start + drain_timeout
+    while inline_updates and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    abandoned += inline_updates
+
+    # Persist waiting users
+    if matchmaker:
+        try:
+            await matchmaker.close()
+        except Exception as e:
+            logger.error(f"Error closing matchmaker: {e}")
+        matchmaker = None
+
+    # Keep photos not archived yet for the next start
+    if archiver:
+        try:
+            await archiver.close()
+        except Exception as e:
+            logger.error(f"Error closing archiver: {e}")
+        archiver = None
+
+    # Write buffered dialogue history
+    if history:
+        try:
+            await history.close()
+        except Exception as e:
+            logger.error(f"Error flushing history: {e}")
+        history = None
+
+    # Save long-running jobs for the next start
+    try:
+        await MailerSingleton.get_instance().checkpoint()
+    except Exception as e:
+        logger.error(f"Error checkpointing mailing: {e}")
+
+    if lag_monitor:
+        await lag_monitor.close()
+        lag_monitor = None
+
+    if cluster:
+        await cluster.close()
     
     if bot:
         try:
+            # Remove webhook, other instances keep serving it
+            if not (cluster and cluster.is_shared):
+                await bot.delete_webhook()
+                logger.info("Bot webhook removed")
             # Close bot session
-            if hasattr(bot, 'session') and not bot.session.closed:
-                await bot.session.close()
-            if hasattr(bot, '_session') and not bot._session.closed:
-                await bot._session.close()
-            # Remove webhook
-            await bot.delete_webhook()
-            logger.info("Bot webhook removed")
+            await bot.session.close()
         except Exception as e:
             logger.error(f"Error during bot cleanup: {e}")
     
@@ -61,40 +159,46 @@ async def cleanup():
             logger.info("FSM storage closed")
         except Exception as e:
             logger.error(f"Error closing FSM storage: {e}")
-    
-    # Close all pending tasks
-    tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
-    for task in tasks:
-        task.cancel()
+
+    if sessionmaker:
         try:
-            await task
-        except asyncio.CancelledError:
-            pass
+            # Close database connections
+            await sessionmaker.kw['bind'].dispose()
+            logger.info("Database engine disposed")
         except Exception as e:
-            logger.error(f"Error cancelling task: {e}")
-    
-    logger.info("Cleanup complete")
-
-# Signal handlers
-def handle_sigterm(*_):
-    """Handle SIGTERM signal"""
-    logger.info("Received SIGTERM signal")
-    loop = asyncio.get_event_loop()
-    loop.create_task(cleanup())
-    loop.stop()
+            logger.error(f"Error disposing database engine: {e}")
 
-# Register signal handlers
-signal.signal(signal.SIGTERM, handle_sigterm)
+    # Report what did not finish in time
+    tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+    drain_time = time.monotonic() - drain_start
+    DRAIN_SECONDS.set(round(drain_time, 3))
+    ABANDONED.set(abandoned, kind='updates')
+    ABANDONED.set(len(tasks), kind='tasks')
+    
+    logger.info(
+        "Cleanup complete in %.3fs, abandoned %i updates and %i tasks",
+        drain_time, abandoned, len(tasks),
+    )
 
 async def init_bot():
     """Initialize bot and dispatcher"""
-    global bot, dp, sessionmaker, payment, is_ready
+    global bot, dp, sessionmaker, payment, cluster, pool, seen_updates, is_ready
+    global lag_monitor, shedder, matchmaker, archiver, history
+    global loads, build_update, log_sample_rate, slow_threshold, drain_timeout
     
     config = load_config()
     os.environ['TZ'] = config.bot.timezone
     time.tzset()
     logger.info(f'Set timezone to "{config.bot.timezone}"')
 
+    if config.webhook.processes > 1 and not config.bot.use_redis:
+        raise RuntimeError('WEBHOOK_PROCESSES > 1 requires BOT_USE_REDIS')
+
+    if config.webhook.processes > 1 and config.matchmaking.backend == 'memory':
+        raise RuntimeError(
+            'MATCHMAKING_BACKEND=memory requires WEBHOOK_PROCESSES=1'
+        )
+
     # Setup storage
     if config.bot.use_redis:
         storage = RedisStorage.from_url(
@@ -103,6 +207,24 @@ async def init_bot():
     else:
         storage = MemoryStorage()
 
+    # Instances share FSM, mailing and locks through Redis
+    cluster = Cluster(storage.redis if config.bot.use_redis else None)
+    MailerSingleton(redis=cluster.redis)
+
+    # Setup updates decoding
+    loads = updates.get_loads(config.webhook.fast_runtime)
+    build_update = updates.get_builder(config.webhook.fast_runtime)
+    log_sample_rate = config.webhook.log_sample_rate
+    slow_threshold = config.webhook.slow_threshold
+    _, drain_timeout = split_drain_timeout(config.webhook.drain_timeout)
+
+    # Setup duplicate updates suppression
+    seen_updates = dedup.create_seen_updates(
+        config.webhook.dedup_size,
+        config.webhook.dedup_ttl,
+        cluster.redis,
+    )
+
     # Create sessionmaker
     sessionmaker = await create_sessionmaker(config.db)
 
@@ -115,28 +237,110 @@ async def init_bot():
 
     dp = Dispatcher(storage=storage)
     dp["config"] = config  # Store config in dispatcher context
-    middlewares.setup(dp, sessionmaker, payment)
+    user_cache = UserCache(cache.create_cache(
+        'user', config.cache.user_ttl, config.cache.size, cluster.redis,
+    ))
+    sub_cache = cache.create_cache(
+        'sub', config.cache.sub_ttl, config.cache.size, cluster.redis,
+    )
+    middlewares.setup(
+        dp, sessionmaker, payment, user_cache,
+        sub_cache, SponsorCache(config.cache.sponsors_ttl),
+        config.cache.sub_negative_ttl, config.botstat,
+    )
     handlers.setup(dp)
 
-    # Set webhook
-    webhook_url = f"https://{config.bot.domain}/webhook"
-    await bot.set_webhook(
-        webhook_url,
-        allowed_updates=[
-            "message",
-            "edited_message",
-            "callback_query",
-            "message_reaction",
-            "message_reaction_count",
-            "pre_checkout_query",
-            "successful_payment"
-        ]
+    # Search queue, restored from the database
+    matchmaker = create_matchmaker(
+        config.matchmaking, sessionmaker, cluster.redis,
+    )
+    matchmaker.on_match = partial(
+        dialogue.create_matched_dialogue,
+        bot, sessionmaker, matchmaker, dp.fsm.storage,
+    )
+    await matchmaker.start()
+    dp["matchmaker"] = matchmaker
+
+    # Dialogue photos are downloaded after relaying
+    archiver = archive.PhotoArchiver(
+        bot,
+        config.archive.directory,
+        config.archive.workers,
+        config.archive.retries,
+        config.archive.max_pending,
+        cluster.redis,
+    )
+    await archiver.start()
+    dp["archiver"] = archiver
+
+    # Dialogue history is written behind in batches
+    history = HistoryWriter(
+        sessionmaker,
+        config.history.flush_interval,
+        config.history.batch_size,
+        config.history.max_pending,
+    )
+    history.start()
+    dp["history"] = history
+
+    # Profile middlewares, filters and handlers on demand
+    if config.profiler.enabled:
+        profiler = Profiler(config.profiler.window, config.profiler.top)
+        profiler.install(dp, bot)
+        dp["profiler"] = profiler
+
+    # Set webhook and commands by one of the instances starting together.
+    # The lease is released right after, so a restart sets them again.
+    if await cluster.acquire('startup', 60):
+        try:
+            webhook_url = f"https://{config.bot.domain}/webhook"
+            await bot.set_webhook(
+                webhook_url,
+                allowed_updates=[
+                    "message",
+                    "callback_query",
+                    "pre_checkout_query",
+                    "successful_payment"
+                ]
+            )
+            logger.info(f"Webhook set: {webhook_url}")
+
+            await set_commands(bot, config, sessionmaker)
+            logger.info("Bot commands set")
+
+            # Continue a mailing interrupted by the previous shutdown, the
+            # checkpoint is taken atomically
+            await MailerSingleton.get_instance().resume_mailing(
+                bot, admin_nav.inline.STOPMAIL,
+            )
+        finally:
+            await cluster.release('startup')
+
+    # Check join requests on the leader instance
+    await schedule.setup(bot, sessionmaker, cluster)
+
+    # Drop blocked and long waiting users from the queue
+    if config.matchmaking.sweep_interval:
+        sweeper = QueueSweeper(
+            bot, matchmaker, sessionmaker,
+            config.matchmaking.sweep_interval, config.matchmaking.max_wait,
+        )
+        cluster.run_as_leader('sweeper', sweeper.sweeper)
+
+    pool = workers.create_pool(
+        lambda item: process_update(*item),
+        config.webhook.workers,
+        config.webhook.max_pending,
+    )
+
+    # Shed low priority updates on overload
+    lag_monitor = workers.LagMonitor()
+    lag_monitor.start()
+    shedder = workers.LoadShedder(
+        pool, lag_monitor,
+        config.webhook.shed_depth,
+        config.webhook.shed_lag,
     )
-    logger.info(f"Webhook set: {webhook_url}")
-    
-    # Set bot commands
-    await set_commands(bot, config, sessionmaker)
-    logger.info("Bot commands set")
 
     is_ready = True
     logger.info("Bot startup complete and ready to handle requests")
@@ -151,52 +355,118 @@ async def startup_event():
 async def shutdown_event():
     await cleanup()
 
+async def process_update(update: types.Update, trace: bool = False) -> None:
+    """Feed a parsed update to the dispatcher"""
+    update_type = updates.get_event_type(update)
+    timings = UpdateTimings()
+    process_start = time.perf_counter()
+    try:
+        await dp.feed_update(bot, update, timings=timings)
+    except Exception:
+        logger.exception("[%s] Update processing error", update.update_id)
+
+    process_time = time.perf_counter() - process_start
+    PROCESS_SECONDS.observe(process_time, update_type=update_type)
+    MIDDLEWARE_SECONDS.observe(
+        max(process_time - timings.handler, 0), update_type=update_type,
+    )
+
+    if trace:
+        logger.info(
+            "[%s] Update processed in %.3fs, handlers took %.3fs",
+            update.update_id, process_time, timings.handler,
+        )
+
+    if process_time > slow_threshold:
+        logger.warning(
+            "[%s] Update %s processing took %.3fs",
+            update.update_id, update_type, process_time,
+        )
+
 # Webhook endpoint
 @app.post("/webhook")
 async def telegram_webhook(request: Request):
+    global inline_updates
     if not is_ready:
         logger.warning("Received webhook request while bot is not ready")
         return JSONResponse(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             content={"status": "not_ready"}
         )
-        
-    start_time = time.time()
-    request_id = f"{datetime.now().strftime('%Y%m%d%H%M%S')}-{int(start_time * 1000)}"
-    logger.info(f"[{request_id}] Webhook request received at {datetime.now().isoformat()}")
-    
+
+    start_time = time.perf_counter()
+    trace = random.random() < log_sample_rate
+
     try:
         # Parse the update
-        update = await request.json()
-        parse_time = time.time() - start_time
-        logger.info(f"[{request_id}] Update parsed in {parse_time:.3f}s")
-        
-        # Log update type and details
-        update_type = update.get('message', {}).get('text') or update.get('callback_query', {}).get('data') or update.get('pre_checkout_query', {}).get('invoice_payload') or 'unknown'
-        logger.info(f"[{request_id}] Update type: {update_type}")
-        
-        # Process the update
-        process_start = time.time()
-        config = dp["config"]
-        logger.info(f"[{request_id}] Starting update processing")
-        
-        await dp.feed_update(bot, types.Update(**update))
-        process_time = time.time() - process_start
-        logger.info(f"[{request_id}] Update processed in {process_time:.3f}s")
-        
-        # Calculate total time
-        total_time = time.time() - start_time
-        logger.info(f"[{request_id}] Total webhook processing time: {total_time:.3f}s")
-        
-        if total_time > 5:  # Warning if processing takes more than 5 seconds
-            logger.warning(f"[{request_id}] Webhook processing took longer than 5 seconds!")
-            
-    except Exception as e:
-        error_time = time.time() - start_time
-        logger.error(f"[{request_id}] Webhook processing error after {error_time:.3f}s: {str(e)}", exc_info=True)
+        update = loads(await request.body())
+
+        # Drop updates redelivered by Telegram
+        if await seen_updates.seen(update['update_id']):
+            if trace:
+                logger.info("[%s] Duplicate update dropped", update['update_id'])
+            return {"ok": True}
+
+        update_type = updates.get_update_type(update)
+        update = build_update(update)
+    except Exception:
+        logger.exception("Webhook parsing error")
+        return {"ok": True}
+
+    parse_time = time.perf_counter() - start_time
+    PARSE_SECONDS.observe(parse_time, update_type=update_type)
+    if trace:
+        logger.info(
+            "[%s] Update %s parsed in %.3fs",
+            update.update_id, update_type, parse_time,
+        )
+
+    # Drop low priority updates on overload
+    priority = workers.get_priority(update)
+    if not shedder.admit(update_type, priority):
+        if trace:
+            logger.info("[%s] Update %s shed", update.update_id, update_type)
+        return {"ok": True}
+
+    # Hand the update to the workers and answer Telegram right away
+    if pool:
+        if not pool.put(workers.get_chat_key(update), (update, trace), priority):
+            await seen_updates.forget(update.update_id)
+            logger.warning("[%s] Update queue is full, asking Telegram to retry", update.update_id)
+            return JSONResponse(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                content={"status": "overloaded"}
+            )
+        return {"ok": True}
+
+    # Process the update
+    inline_updates += 1
+    try:
+        await process_update(update, trace)
+    finally:
+        inline_updates -= 1
     return {"ok": True}
 
+# Metrics endpoint
+@app.get("/metrics")
+async def metrics_endpoint():
+    return Response(
+        content=metrics.render(),
+        media_type="text/plain; version=0.0.4",
+    )
+
 # Run locally with uvicorn for debugging (optional)
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8080)
\ No newline at end of file
+    from importlib.util import find_spec
+
+    config = load_config().webhook
+    grace, _ = split_drain_timeout(config.drain_timeout)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8080,
+        workers=config.processes,
+        timeout_graceful_shutdown=grace,
+        loop="uvloop" if config.fast_runtime and find_spec("uvloop") else "asyncio",
+    )
\ No newline at end of file
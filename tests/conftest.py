@@ -0,0 +1,25 @@
+"""Test settings"""
+import os
+
+# Settings are read on import, required ones get placeholders
+for name, value in {
+    'BOT_TOKEN': '123:token',
+    'BOT_TIMEZONE': 'UTC',
+    'BOT_ADMINS': '[]',
+    'BOT_MODERS': '[]',
+    'BOT_USE_REDIS': 'false',
+    'BOT_DOMAIN': 'localhost',
+    'DB_HOST': 'localhost',
+    'DB_PORT': '5432',
+    'DB_NAME': 'test',
+    'DB_USER': 'test',
+    'DB_PASSWORD': 'test',
+    'REDIS_HOST': 'localhost',
+    'REDIS_DB': '0',
+    'PAYMENTS_API_ID': '0',
+    'PAYMENTS_API_KEY': 'test',
+    'PAYMENTS_PROJECT_ID': '0',
+    'PAYMENTS_PROJECT_SECRET': 'test',
+    'PAYMENTS_ENABLED': 'false',
+}.items():
+    os.environ.setdefault(name, value)
@@ -0,0 +1,50 @@
+"""Circuit breaker"""
+import time
+
+from app.utils.breaker import CircuitBreaker
+
+
+def test_opens_after_threshold() -> None:
+    breaker = CircuitBreaker('test', 3, 60)
+    for _ in range(2):
+        breaker.failure()
+        assert breaker.allow()
+
+    breaker.failure()
+    assert breaker.is_open
+    assert not breaker.allow()
+
+
+def test_success_resets_failures() -> None:
+    breaker = CircuitBreaker('test', 2, 60)
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    assert not breaker.is_open and breaker.allow()
+
+
+def test_trial_after_cooldown() -> None:
+    breaker = CircuitBreaker('test', 1, 0.05)
+    breaker.failure()
+    assert not breaker.allow()
+
+    # One trial call, the next waits for it
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert not breaker.allow()
+
+    breaker.success()
+    assert not breaker.is_open and breaker.allow()
+
+
+def test_failed_trial_reopens() -> None:
+    breaker = CircuitBreaker('test', 1, 0.05)
+    breaker.failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+
+    breaker.failure()
+    assert breaker.is_open
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()
@@ -0,0 +1,70 @@
+"""Dialogue history writer"""
+import asyncio
+
+from app.database.history import HistoryWriter
+
+
+class SlowSession(object):
+    """Session writing rows after a delay"""
+
+    def __init__(self, written: list, fail: bool = False) -> None:
+        self.written = written
+        self.fail = fail
+
+    async def __aenter__(self) -> 'SlowSession':
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        pass
+
+    async def execute(self, _, rows: list[dict]) -> None:
+        await asyncio.sleep(0.05)
+        if self.fail:
+            raise ConnectionError('database is down')
+        self.pending = rows
+
+    async def commit(self) -> None:
+        self.written += self.pending
+
+
+def add(writer: HistoryWriter, count: int) -> None:
+    """Buffer messages"""
+    for index in range(count):
+        writer.add(1, 1, 2, 'message %i' % index)
+
+
+def test_close_during_flush() -> None:
+    written = []
+
+    async def run() -> None:
+        writer = HistoryWriter(lambda: SlowSession(written), 0.01, 10)
+        writer.start()
+        add(writer, 10)
+        # The writer took the batch and waits for the database
+        await asyncio.sleep(0.02)
+        assert not writer.rows
+        add(writer, 3)
+        await writer.close()
+
+    asyncio.run(run())
+    assert len(written) == 13
+
+
+def test_failed_flush_keeps_rows() -> None:
+    sessions = [SlowSession([], fail=True)]
+
+    async def run() -> None:
+        writer = HistoryWriter(lambda: sessions[0], 10, 100)
+        add(writer, 5)
+        try:
+            await writer.flush()
+        except ConnectionError:
+            pass
+        assert len(writer.rows) == 5
+
+        written = []
+        sessions[0] = SlowSession(written)
+        await writer.close()
+        assert len(written) == 5
+
+    asyncio.run(run())
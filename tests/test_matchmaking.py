@@ -0,0 +1,278 @@
+"""Matchmaking backends"""
+import random
+import asyncio
+from collections import Counter
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import delete, or_
+from sqlalchemy.future import select
+
+from app.database.models import User, Dialogue, Queue
+from app.handlers.user.dialogue import open_dialogue
+from app.matchmaking import (
+    AlreadyPaired, DatabaseMatchmaker, MemoryMatchmaker, RecentPartners,
+    RedisMatchmaker,
+)
+
+# Users searching at once and the rounds they search again in
+RACE_USERS = 200
+RACE_ROUNDS = 5
+
+# Test users of a real database get ids far above Telegram ids
+FIRST_ID = 10 ** 15
+
+
+class SlowSession(object):
+    """Session committing statements after a delay"""
+
+    def __init__(self, committed: list) -> None:
+        self.committed = committed
+        self.statements = []
+
+    async def __aenter__(self) -> 'SlowSession':
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        pass
+
+    async def execute(self, statement, *_) -> None:
+        await asyncio.sleep(0.05)
+        self.statements.append(statement)
+
+    async def commit(self) -> None:
+        self.committed += self.statements
+
+
+class UserSession(object):
+    """Session over users kept in a dict"""
+
+    def __init__(self, users: dict) -> None:
+        self.users = users
+
+    async def __aenter__(self) -> 'UserSession':
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        pass
+
+    async def get(self, _, user_id: int):
+        return self.users[user_id]
+
+    async def scalar(self, statement):
+        # Only the partner id of a user is selected
+        user_id, = statement.compile().params.values()
+        return self.users[user_id].partner_id
+
+    async def commit(self) -> None:
+        pass
+
+
+def get_user(user_id: int, is_man: bool = True, partner_id=None):
+    """Get a searching user"""
+    return SimpleNamespace(
+        id=user_id, is_man=is_man, age=None, partner_id=partner_id,
+    )
+
+
+async def pair_users(session: UserSession, matchmaker, first, second) -> None:
+    """Commit a dialogue like open_dialogue, other searches run meanwhile"""
+    await matchmaker.leave(session, first, second)
+    await asyncio.sleep(0.001)
+    for user_id, partner_id in ((first, second), (second, first)):
+        assert session.users[user_id].partner_id is None
+        session.users[user_id].partner_id = partner_id
+    await matchmaker.paired(first, second)
+
+
+async def race(
+    matchmaker, sessionmaker, pair, user_ids: list[int],
+) -> list[tuple[int, int]]:
+    """
+    Let users search at once like the queue handler, everybody searches
+    again at random moments until paired, up to RACE_ROUNDS times.
+
+    :return list[tuple[int, int]]: Created dialogues
+    """
+
+    dialogues = []
+
+    async def search(user_id: int) -> None:
+        for _ in range(RACE_ROUNDS):
+            await asyncio.sleep(random.random() / 100)
+            async with sessionmaker() as session:
+                user = await session.get(User, user_id)
+                try:
+                    partner_id = await matchmaker.search(
+                        session, user, random.choice((None, True, False)),
+                        False,
+                    )
+                except AlreadyPaired:
+                    return
+
+                if partner_id is not None:
+                    await pair(session, matchmaker, user_id, partner_id)
+                    dialogues.append((user_id, partner_id))
+                    return
+
+    await asyncio.gather(*map(search, user_ids))
+    return dialogues
+
+
+def get_members(dialogues: list[tuple[int, int]]) -> set[int]:
+    """Get users of dialogues, each must be in one"""
+    members = Counter(
+        user_id for dialogue in dialogues for user_id in dialogue
+    )
+    assert dialogues
+    assert max(members.values()) == 1
+    return set(members)
+
+
+def test_memory_close_during_flush() -> None:
+    committed = []
+
+    async def run() -> None:
+        matchmaker = MemoryMatchmaker(
+            RecentPartners(), lambda: SlowSession(committed), 0.01,
+        )
+        matchmaker._tasks.append(asyncio.create_task(matchmaker._writer()))
+        await matchmaker.search(None, get_user(1), None, False)
+        # The writer took the change and waits for the database
+        await asyncio.sleep(0.03)
+        assert not matchmaker.pending
+        await matchmaker.close()
+
+    asyncio.run(run())
+    assert committed
+
+
+def test_memory_paired_user() -> None:
+    async def run() -> None:
+        matchmaker = MemoryMatchmaker(RecentPartners(), None, 1)
+        await matchmaker.search(None, get_user(1), None, False)
+        with pytest.raises(AlreadyPaired):
+            await matchmaker.search(
+                None, get_user(2, partner_id=3), None, False,
+            )
+        assert 2 not in matchmaker.tickets
+
+    asyncio.run(run())
+
+
+def test_memory_failed_match() -> None:
+    async def fail(*_) -> None:
+        raise ConnectionError('database is down')
+
+    async def run() -> None:
+        matchmaker = MemoryMatchmaker(RecentPartners(), None, 1, 0.01)
+        matchmaker.on_match = fail
+        await matchmaker.search(None, get_user(1), None, False)
+        await matchmaker.search(None, get_user(2, is_man=False), None, False)
+        matchmaker._tasks.append(asyncio.create_task(matchmaker._ticker()))
+        await asyncio.sleep(0.05)
+        matchmaker._closing.set()
+        await asyncio.gather(*matchmaker._tasks)
+
+        # Both wait again and may search
+        assert set(matchmaker.tickets) == {1, 2}
+        assert not matchmaker.claimed and not matchmaker.taken
+        assert matchmaker.pending[1]['is_man']
+        await matchmaker.search(None, get_user(1), None, False)
+
+    asyncio.run(run())
+
+
+def test_memory_race() -> None:
+    users = {
+        user_id: get_user(user_id, bool(user_id % 2))
+        for user_id in range(1, RACE_USERS + 1)
+    }
+
+    async def run() -> None:
+        matchmaker = MemoryMatchmaker(RecentPartners(), None, 1)
+        dialogues = await race(
+            matchmaker, lambda: UserSession(users), pair_users, list(users),
+        )
+        assert not get_members(dialogues) & set(matchmaker.tickets)
+
+    asyncio.run(run())
+
+
+def test_redis_race() -> None:
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa')
+    users = {
+        user_id: get_user(user_id, bool(user_id % 2))
+        for user_id in range(1, RACE_USERS + 1)
+    }
+
+    async def run() -> None:
+        redis = fakeredis.aioredis.FakeRedis()
+        matchmaker = RedisMatchmaker(RecentPartners(), redis)
+        dialogues = await race(
+            matchmaker, lambda: UserSession(users), pair_users, list(users),
+        )
+        waiting = set(map(int, await redis.hkeys(matchmaker.users_key)))
+        assert not get_members(dialogues) & waiting
+
+    asyncio.run(run())
+
+
+async def cleanup(sessionmaker, ids: list[int]) -> None:
+    """Remove test users"""
+    async with sessionmaker() as session:
+        await session.execute(
+            delete(Dialogue)
+            .where(or_(Dialogue.first.in_(ids), Dialogue.second.in_(ids)))
+        )
+        await session.execute(delete(Queue).where(Queue.id.in_(ids)))
+        await session.execute(delete(User).where(User.id.in_(ids)))
+        await session.commit()
+
+
+def test_database_race() -> None:
+    from app.database import create_sessionmaker
+    from app.utils.config import DB
+
+    ids = list(range(FIRST_ID, FIRST_ID + RACE_USERS))
+
+    async def run() -> None:
+        # Postgres from the DB_* settings, row locks are what is tested
+        try:
+            sessionmaker = await asyncio.wait_for(
+                create_sessionmaker(DB()), 5,
+            )
+        except Exception as error:
+            pytest.skip('No database: %s' % error)
+
+        try:
+            await cleanup(sessionmaker, ids)
+            async with sessionmaker() as session:
+                session.add_all(
+                    User(id=user_id, is_man=bool(user_id % 2))
+                    for user_id in ids
+                )
+                await session.commit()
+
+            dialogues = await race(
+                DatabaseMatchmaker(RecentPartners()), sessionmaker,
+                open_dialogue, ids,
+            )
+            async with sessionmaker() as session:
+                stored = (await session.execute(
+                    select(Dialogue.first, Dialogue.second)
+                    .where(Dialogue.first.in_(ids))
+                )).all()
+                waiting = set(await session.scalars(
+                    select(Queue.id).where(Queue.id.in_(ids))
+                ))
+
+            assert len(stored) == len(dialogues)
+            assert not get_members(stored) & waiting
+
+        finally:
+            await cleanup(sessionmaker, ids)
+            await sessionmaker.kw['bind'].dispose()
+
+    asyncio.run(run())
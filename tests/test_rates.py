@@ -0,0 +1,64 @@
+"""Queue rates"""
+from types import SimpleNamespace
+
+import pytest
+
+from app.matchmaking import rates
+from app.matchmaking.rates import QueueRates, RollingCounter
+
+MAN, WOMAN = (False, True, False), (False, False, True)
+
+
+@pytest.fixture
+def clock(monkeypatch) -> SimpleNamespace:
+    """Monotonic time moved by the test"""
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(
+        rates, 'time', SimpleNamespace(monotonic=lambda: clock.now),
+    )
+    return clock
+
+
+def test_window_rollover() -> None:
+    # Slots of 10 seconds
+    counter = RollingCounter(600, 60)
+    counter.add(now=0)
+    counter.add(now=5)
+    counter.add(2, now=15)
+    assert counter.get(now=599) == 4
+
+    assert counter.get(now=605) == 2
+    assert counter.get(now=615) == 0
+
+    # Idle longer than the window
+    counter.add(now=700)
+    assert counter.get(now=10 ** 6) == 0
+    counter.add(now=10 ** 6)
+    assert counter.get(now=10 ** 6) == 1
+
+
+def test_estimate_from_matches(clock) -> None:
+    queue = QueueRates(600)
+    queue.matched(MAN, 30)
+    queue.matched(MAN, 90)
+    assert queue.estimate(MAN, [WOMAN]) == 60
+    assert queue.get_rates(MAN) == (0, 0.2)
+
+
+def test_estimate_empty_bucket(clock) -> None:
+    queue = QueueRates(600)
+    queue.arrived(WOMAN)
+    queue.arrived(WOMAN)
+    # Nobody matched out of the bucket, a partner searches every 300 s
+    assert queue.estimate(MAN, [WOMAN]) == 300
+
+
+def test_estimate_without_searches(clock) -> None:
+    queue = QueueRates(600)
+    assert queue.estimate(MAN, [WOMAN]) is None
+
+    queue.arrived(WOMAN)
+    queue.matched(MAN, 30)
+    clock.now += 601
+    assert queue.estimate(MAN, [WOMAN]) is None
+    assert queue.get_rates(MAN) == (0, 0)
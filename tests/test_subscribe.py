@@ -0,0 +1,27 @@
+"""Subscription checks"""
+import time
+import asyncio
+from types import SimpleNamespace
+
+from app.middlewares.subscribe import SubMiddleware, UNCHECKED
+from app.utils.cache import MemoryCache
+from app.utils.config import Botstat
+
+
+def test_botstat_busy() -> None:
+    middleware = SubMiddleware(
+        MemoryCache('subs', 60, 100), None, 30,
+        Botstat(timeout=0.05, concurrency=1, failures=2),
+    )
+    sponsor = SimpleNamespace(id=1, access_id='token')
+    user = SimpleNamespace(id=1)
+
+    async def run() -> None:
+        # Every slot is taken by a hanging request
+        await middleware.semaphore.acquire()
+        started = time.monotonic()
+        assert await middleware._check_botstat(sponsor, user) is UNCHECKED
+        assert time.monotonic() - started < 1
+        assert middleware.breaker.failures == 1
+
+    asyncio.run(run())
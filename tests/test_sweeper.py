@@ -0,0 +1,62 @@
+"""Search queue sweeper"""
+import asyncio
+import time
+from types import SimpleNamespace
+
+from app.matchmaking import MemoryMatchmaker, QueueSweeper, RecentPartners
+from app.templates import texts
+
+
+class FakeSession(object):
+    """Session returning prepared results in order"""
+
+    def __init__(self, *results: list) -> None:
+        self.results = list(results)
+
+    async def __aenter__(self) -> 'FakeSession':
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        pass
+
+    async def scalars(self, _) -> list:
+        return self.results.pop(0)
+
+    async def commit(self) -> None:
+        pass
+
+
+class FakeBot(object):
+    """Bot recording sent messages"""
+
+    def __init__(self) -> None:
+        self.sent = []
+
+    async def send_message(self, chat_id: int, text: str, **_) -> None:
+        self.sent.append((chat_id, text))
+
+
+def get_user(user_id: int):
+    """Get a searching user"""
+    return SimpleNamespace(
+        id=user_id, is_man=True, age=None, partner_id=None, is_vip=False,
+    )
+
+
+def test_notify_expired() -> None:
+    bot = FakeBot()
+
+    async def run() -> None:
+        matchmaker = MemoryMatchmaker(RecentPartners(), None, 1)
+        await matchmaker.search(None, get_user(1), False, False)
+        await matchmaker.search(None, get_user(2), False, False)
+        matchmaker.tickets[1].enqueued = time.monotonic() - 120
+
+        # No blocked users, then the expired ones
+        session = FakeSession([], [get_user(1)])
+        sweeper = QueueSweeper(bot, matchmaker, lambda: session, 60, 60)
+        assert await sweeper.sweep() == ([1], [])
+        assert set(matchmaker.tickets) == {2}
+
+    asyncio.run(run())
+    assert bot.sent == [(1, texts.user.SEARCH_EXPIRED)]
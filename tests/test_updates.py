@@ -0,0 +1,70 @@
+"""Fast-path update decoding against full validation"""
+from app.utils.updates import (
+    UNUSED_MESSAGE_FIELDS, build_update, parse_update,
+)
+
+USER = {'id': 1, 'is_bot': False, 'first_name': 'User'}
+CHAT = {'id': 1, 'type': 'private', 'first_name': 'User'}
+
+
+def get_message(message_id: int, **fields) -> dict:
+    """Get a raw private message"""
+    return {
+        'message_id': message_id,
+        'from': USER,
+        'chat': CHAT,
+        'date': 1700000000,
+        **fields,
+    }
+
+
+def test_formatted_text() -> None:
+    payload = {
+        'update_id': 1,
+        'message': get_message(
+            1, text='hi bold',
+            entities=[{'type': 'bold', 'offset': 3, 'length': 4}],
+        ),
+    }
+
+    update = build_update(payload)
+    assert update == parse_update(payload)
+    assert update.message.html_text == 'hi <b>bold</b>'
+
+
+def test_formatted_caption() -> None:
+    payload = {
+        'update_id': 2,
+        'message': get_message(
+            2, caption='see here',
+            caption_entities=[{'type': 'italic', 'offset': 4, 'length': 4}],
+            photo=[{
+                'file_id': 'file', 'file_unique_id': 'unique',
+                'width': 90, 'height': 90,
+            }],
+        ),
+    }
+
+    update = build_update(payload)
+    assert update == parse_update(payload)
+    assert update.message.html_text == 'see <i>here</i>'
+
+
+def test_unused_fields() -> None:
+    payload = {
+        'update_id': 3,
+        'message': get_message(
+            4, text='hi bold',
+            entities=[{'type': 'bold', 'offset': 3, 'length': 4}],
+            reply_to_message=get_message(3, text='earlier'),
+            forward_from=USER,
+            via_bot={'id': 2, 'is_bot': True, 'first_name': 'Bot'},
+        ),
+    }
+
+    message = build_update(payload).message
+    expected = parse_update(payload).message
+    assert message.reply_to_message is None
+    assert message.dict(exclude=set(UNUSED_MESSAGE_FIELDS)) == \
+        expected.dict(exclude=set(UNUSED_MESSAGE_FIELDS))
+    assert message.html_text == expected.html_text
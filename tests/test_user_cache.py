@@ -0,0 +1,94 @@
+"""User cache invalidation"""
+import asyncio
+
+from sqlalchemy import case, create_engine, delete, update
+from sqlalchemy.orm import Session
+
+from app.database.cache import UserCache
+from app.database.context import UserContext
+from app.database.models import Base, User, Queue
+from app.utils.cache import MemoryCache
+
+# Listeners are global, the tests share one cache like the bot does
+CACHE = UserCache(MemoryCache('users', 60, 100))
+
+
+def create_engine_with_users():
+    """Create an in-memory database with two waiting users, empty the cache"""
+    CACHE.cache = MemoryCache('users', 60, 100)
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine, tables=[User.__table__, Queue.__table__])
+    with Session(engine) as session:
+        session.add_all((
+            User(id=1, ref='ads'), User(id=2),
+            Queue(id=1, is_man=True, is_adult=False),
+            Queue(id=2, is_man=False, is_adult=False),
+        ))
+        session.commit()
+    return engine
+
+
+def load(engine, user_id: int) -> UserContext:
+    """Load a context like load_context does"""
+    with Session(engine) as session:
+        return UserContext(
+            session.get(User, user_id),
+            session.get(Queue, user_id) is not None,
+        )
+
+
+def pair(engine) -> None:
+    """Commit a dialogue of both users with bulk statements only"""
+    with Session(engine) as session:
+        session.execute(delete(Queue).where(Queue.id.in_((1, 2))))
+        session.execute(
+            update(User)
+            .where(User.id.in_((1, 2)))
+            .values(partner_id=case((User.id == 1, 2), else_=1))
+        )
+        session.commit()
+
+
+def test_fill() -> None:
+    engine = create_engine_with_users()
+
+    async def fill() -> None:
+        version = await CACHE.version(1)
+        await CACHE.set(load(engine, 1), version)
+        assert await CACHE.cache.get(1) is not None
+
+    asyncio.run(fill())
+
+
+def test_commit_while_loading() -> None:
+    engine = create_engine_with_users()
+
+    async def fill() -> None:
+        version = await CACHE.version(1)
+        context = load(engine, 1)
+        pair(engine)
+        await CACHE.set(context, version)
+
+        assert await CACHE.cache.get(1) is None
+        context = load(engine, 1)
+        assert context.partner_id == 2 and not context.in_queue
+
+    asyncio.run(fill())
+
+
+def test_bulk_update() -> None:
+    engine = create_engine_with_users()
+
+    async def fill() -> None:
+        await CACHE.set(load(engine, 1), await CACHE.version(1))
+        with Session(engine) as session:
+            session.execute(
+                update(User)
+                .where(User.ref == 'ads')
+                .values(ref=None)
+            )
+            session.commit()
+
+        assert await CACHE.cache.get(1) is None
+
+    asyncio.run(fill())
@@ -0,0 +1,153 @@
+"""Update worker pool and load shedding"""
+import random
+import asyncio
+
+from app.utils.updates import build_update
+from app.utils.workers import (
+    PRIORITY_DIALOGUE, PRIORITY_HIGH, PRIORITY_LOW, LagMonitor, LoadShedder,
+    UpdateWorkerPool, get_chat_key, get_priority,
+)
+
+USER = {'id': 1, 'is_bot': False, 'first_name': 'User'}
+
+
+def get_message(chat: dict, **fields) -> dict:
+    """Get a raw message of a chat"""
+    return {
+        'message_id': 1, 'from': USER, 'chat': chat, 'date': 1700000000,
+        **fields,
+    }
+
+
+def test_priority() -> None:
+    private = {'id': 1, 'type': 'private', 'first_name': 'User'}
+    group = {'id': -100, 'type': 'supergroup', 'title': 'Group'}
+    cases = [
+        ({'message': get_message(private, text='hi')}, PRIORITY_DIALOGUE),
+        ({'message': get_message(group, text='hi')}, PRIORITY_LOW),
+        ({
+            'callback_query': {
+                'id': '1', 'from': USER, 'chat_instance': '1', 'data': 'vip',
+            },
+        }, PRIORITY_HIGH),
+        ({
+            'message': get_message(private, successful_payment={
+                'currency': 'AZN', 'total_amount': 100,
+                'invoice_payload': 'vip', 'telegram_payment_charge_id': '1',
+                'provider_payment_charge_id': '1',
+            }),
+        }, PRIORITY_HIGH),
+    ]
+
+    for update_id, (payload, priority) in enumerate(cases, 1):
+        update = build_update({'update_id': update_id, **payload})
+        assert get_priority(update) == priority
+
+    update = build_update({'update_id': 5, 'message': get_message(group)})
+    assert get_chat_key(update) == -100
+
+
+def test_lane_order() -> None:
+    processed = []
+
+    async def process(item: tuple[int, int]) -> None:
+        await asyncio.sleep(random.random() / 100)
+        processed.append(item)
+
+    async def run() -> None:
+        pool = UpdateWorkerPool(process, 4, 100)
+        pool.start()
+        for index in range(10):
+            for chat_id in range(5):
+                assert pool.put(chat_id, (chat_id, index))
+        assert await pool.drain(5) == 0
+
+    asyncio.run(run())
+    assert len(processed) == 50
+    for chat_id in range(5):
+        assert [
+            index for chat, index in processed if chat == chat_id
+        ] == list(range(10))
+
+
+def test_priority_order() -> None:
+    processed = []
+
+    async def process(item: str) -> None:
+        processed.append(item)
+
+    async def run() -> None:
+        pool = UpdateWorkerPool(process, 1, 100)
+        pool.put(1, 'low', PRIORITY_LOW)
+        pool.put(2, 'dialogue', PRIORITY_DIALOGUE)
+        pool.put(3, 'high', PRIORITY_HIGH)
+        pool.start()
+        await pool.drain(1)
+
+    asyncio.run(run())
+    assert processed == ['high', 'dialogue', 'low']
+
+
+def test_full_queue() -> None:
+    async def run() -> None:
+        pool = UpdateWorkerPool(None, 1, 2)
+        assert pool.put(1, 'first') and pool.put(2, 'second')
+        assert not pool.put(3, 'third')
+        assert pool.depth == 2
+
+    asyncio.run(run())
+
+
+def test_drain_deadline() -> None:
+    processed = []
+
+    async def process(item: int) -> None:
+        await asyncio.sleep(0.2)
+        processed.append(item)
+
+    async def run() -> None:
+        pool = UpdateWorkerPool(process, 2, 100)
+        pool.start()
+        for chat_id in range(4):
+            pool.put(chat_id, chat_id)
+
+        # Two in flight and two queued are abandoned, workers are stopped
+        assert await pool.drain(0.1) == 4
+        assert not pool._tasks
+
+    asyncio.run(run())
+    assert not processed
+
+
+def test_shed_on_depth() -> None:
+    pool = UpdateWorkerPool(None, 1, 100)
+    shedder = LoadShedder(pool, LagMonitor(), 3, 0)
+    for chat_id in range(2):
+        pool.put(chat_id, chat_id)
+    assert shedder.admit('message', PRIORITY_LOW)
+
+    pool.put(2, 2)
+    assert not shedder.admit('message', PRIORITY_LOW)
+    assert shedder.admit('message', PRIORITY_DIALOGUE)
+    assert shedder.admit('callback_query', PRIORITY_HIGH)
+
+
+def test_shed_on_lag() -> None:
+    monitor = LagMonitor()
+    shedder = LoadShedder(None, monitor, 3, 0.5)
+    monitor.lag = 0.4
+    assert shedder.admit('chat_member', PRIORITY_LOW)
+
+    monitor.lag = 0.5
+    assert not shedder.admit('chat_member', PRIORITY_LOW)
+    assert shedder.admit('message', PRIORITY_DIALOGUE)
+
+
+def test_shedding_disabled() -> None:
+    pool = UpdateWorkerPool(None, 1, 100)
+    monitor = LagMonitor()
+    shedder = LoadShedder(pool, monitor, 0, 0)
+    for chat_id in range(50):
+        pool.put(chat_id, chat_id)
+    monitor.lag = 10
+    assert shedder.admit('message', PRIORITY_LOW)